@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+import sys
+def eprint(*args, **kwargs): print(*args, file=sys.stderr, **kwargs)
+
+import os
+import time
+import asyncio
+
+from response import Response
+
+
+class AsyncJobEngine:
+
+    # Class variables
+    read_chunk_size = 65536
+
+
+    ###############################################################################################
+    # Constructor
+    def __init__(self, agent):
+        """Create an engine that runs the agent's jobs as asyncio subprocesses. The agent still decides
+        what to launch and when (through its JobScheduler and limits), while this engine starts each job,
+        streams its output to the job's log file, watches it for staleness, and reports back to the agent
+        as soon as the process exits, so that no per-tick polling of the running jobs is needed
+
+        :param agent: The AutomationAgent whose jobs are being run
+        :type agent: AutomationAgent
+        """
+        self.status = 'OK'
+        self.response = Response()
+        self.agent = agent
+        self.tasks = {}
+        self.wake_callback = None
+
+
+    ###############################################################################################
+    def start(self, job_id, job):
+        """Public method that starts running a job. Must be called from within the running event loop
+
+        :param job_id: Index of the job in the agent's queue
+        :type job_id: int
+        :param job: The job dict, following the same contract as the Popen-based engine
+        :type job: dict
+        """
+        loop = asyncio.get_running_loop()
+        self.tasks[job_id] = loop.create_task(self.run_job(job_id, job))
+
+
+    ###############################################################################################
+    async def run_job(self, job_id, job):
+        """Public coroutine that runs one job to completion and hands the result back to the agent
+        """
+
+        try:
+            os.makedirs(os.path.dirname(job['log_file']), exist_ok=True)
+            log_file = open(job['log_file'],'ab')
+        except OSError as error:
+            self.response.warning(f"Unable to open log file {job['log_file']} for job {job_id} - {error}")
+            log_file = None
+
+        # Downloads for the native engine run in its threads, and we just wait for them to finish
+        if job.get('engine') == 'native':
+            if log_file is not None:
+                log_file.close()
+            task = self.agent.start_native_download(job)
+            exit_future = asyncio.wrap_future(task.future)
+            watchdog = asyncio.ensure_future(self.watch_staleness(job_id, job, task, lambda: exit_future))
+            return_code = await asyncio.shield(exit_future)
+            watchdog.cancel()
+            self.finish(job_id, job, return_code)
+            return
+
+        try:
+            proc = await asyncio.create_subprocess_exec(*job['args'], cwd=job['location'],
+                stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        except Exception as error:
+            self.response.warning(f"Unable to launch job {job_id} - {error}")
+            if log_file is not None:
+                log_file.write(f"Unable to launch job: {error}\n".encode('utf-8'))
+                log_file.close()
+            self.finish(job_id, job, 127)
+            return
+
+        job['handle'] = proc
+        job['pid'] = proc.pid
+        self.agent.apply_process_limits(job)
+
+        # Drain the output continuously and watch for staleness while we wait for the exit
+        streamer = asyncio.ensure_future(self.stream_output(proc.stdout, log_file))
+        watchdog = asyncio.ensure_future(self.watch_staleness(job_id, job, proc, proc.wait))
+        return_code = await proc.wait()
+        watchdog.cancel()
+        await streamer
+        if log_file is not None:
+            log_file.close()
+
+        self.finish(job_id, job, return_code)
+
+
+    ###############################################################################################
+    async def stream_output(self, stream, log_file):
+        """Public coroutine that copies a job's output to its log file as it arrives
+        """
+        while True:
+            data = await stream.read(self.read_chunk_size)
+            if not data:
+                return
+            if log_file is not None:
+                log_file.write(data)
+                log_file.flush()
+
+
+    ###############################################################################################
+    async def watch_staleness(self, job_id, job, proc, wait_for_exit):
+        """Public coroutine that periodically checks whether the job is still productive and,
+        if not, terminates it, escalating to a kill after the grace period
+
+        :param proc: The process, or anything else with terminate() and kill()
+        :param wait_for_exit: Function returning an awaitable that completes when proc has exited
+        """
+
+        config = self.agent.config
+        while True:
+            await asyncio.sleep(config['staleness_check_interval'])
+            if not self.agent.is_job_stale(job, time.time()):
+                continue
+
+            self.response.warning(f"{job['progress']['stale_reason']}. Kill and restart.")
+            job['status'] = 'kill'
+            self.agent.job_control['generation'] += 1
+            proc.terminate()
+            try:
+                await asyncio.wait_for(asyncio.shield(wait_for_exit()), config['kill_grace_period'])
+            except asyncio.TimeoutError:
+                self.response.warning(f"Job {job_id} did not exit within {config['kill_grace_period']} s of being terminated. Killing it")
+                proc.kill()
+            return
+
+
+    ###############################################################################################
+    def finish(self, job_id, job, return_code):
+        """Public method that hands a finished job back to the agent, refills the freed slot, and wakes the main loop
+        """
+
+        self.tasks.pop(job_id, None)
+        self.agent.response.merge(self.response)
+        self.response = Response()
+        self.agent.complete_job(job_id, job, return_code)
+        self.agent.launch_jobs()
+        if self.wake_callback is not None:
+            self.wake_callback()
+
+
+    ###############################################################################################
+    async def shutdown(self):
+        """Public coroutine that terminates all jobs that are still running and waits for them, escalating
+        to a kill for any that have not exited after the grace period, so that none are left orphaned
+        """
+
+        for job_id,task in list(self.tasks.items()):
+            proc = self.agent.jobs.get(job_id, {}).get('handle')
+            if proc is not None and proc.returncode is None:
+                try:
+                    proc.terminate()
+                except ProcessLookupError:
+                    pass
+        if len(self.tasks) == 0:
+            return
+        grace_period = self.agent.config['kill_grace_period']
+        done, pending = await asyncio.wait(list(self.tasks.values()), timeout=grace_period)
+        if len(pending) == 0:
+            return
+
+        for job_id,task in list(self.tasks.items()):
+            if task not in pending:
+                continue
+            proc = self.agent.jobs.get(job_id, {}).get('handle')
+            if proc is not None and proc.returncode is None:
+                self.response.warning(f"Job {job_id} did not exit within {grace_period} s of being terminated. Killing it")
+                try:
+                    proc.kill()
+                except ProcessLookupError:
+                    pass
+        await asyncio.wait(pending, timeout=grace_period)
@@ -7,15 +7,34 @@ import os
 import json
 import re
 import time
+import math
+import random
+import shutil
+import signal
 import subprocess
+import urllib.parse
+import asyncio
+import unittest
 
 from response import Response
 from dataset_processor import DatasetProcessor
+from event_monitor import EventMonitor
+from job_scheduler import JobScheduler, CircuitBreaker, DiskSpaceAdmission, ConcurrencyTuner
+from async_job_engine import AsyncJobEngine
+from job_journal import JobJournal, ReattachedProcess
+from downloader import DownloadEngine, DownloadTask
+from conversion_executor import ConversionExecutor
+from compressor import ParallelCompressor
 
 
 class AutomationAgent:
 
     # Class variables
+    throughput_time_constant = 30
+    config_reload_delay = 1
+    cpu_bound_job_types = [ 'convert', 'compress' ]
+    restart_only_config_keys = [ 'data_path', 'job_engine', 'journal_enabled', 'px_cache_path', 'px_fetch_threads' ]
+    conversion_config_keys = [ 'converter_path', 'max_running_conversions', 'conversion_memory_per_job', 'conversion_niceness', 'conversion_cpu_affinity' ]
 
 
     ###############################################################################################
@@ -26,9 +45,19 @@ class AutomationAgent:
         self.response = None
         self.config = None
         self.state = { 'status': 'Starting', 'command_pointer': 0 }
-        self.tasks_state = { 'previous_show_buffer': '' }
+        self.tasks_state = { 'previous_show_buffer': '', 'wake_immediately': False, 'reload_config': False, 'reload_config_time': None }
         self.jobs = { }
-        self.job_control = { 'job_index': 1, 'n_running_jobs': 0, 'n_jobs': 0, 'n_running_jobs_by_type': {} }
+        self.job_control = { 'job_index': 1, 'n_running_jobs': 0, 'n_jobs': 0, 'n_running_jobs_by_type': {},
+            'generation': 0, 'shown_generation': -1, 'next_staleness_check': 0 }
+        self.event_monitor = None
+        self.scheduler = JobScheduler()
+        self.circuit_breaker = CircuitBreaker()
+        self.disk_space_admission = DiskSpaceAdmission()
+        self.download_tuner = None
+        self.job_engine = None
+        self.journal = None
+        self.downloader = None
+        self.conversion_executor = None
         self.dataset_processor = DatasetProcessor()
         self.start_directory = os.getcwd()
 
@@ -96,17 +125,60 @@ class AutomationAgent:
         self.config = {
             'sleep_interval': 3,
             'heartbeat_interval': 60,
+            'staleness_check_interval': 10,
+            'kill_grace_period': 5,
+            'minimum_job_throughput': 1024,
+            'retry_backoff_base': 5,
+            'retry_backoff_max': 600,
+            'circuit_breaker_failures': 5,
+            'circuit_breaker_cooldown': 60,
+            'job_engine': 'popen',
+            'download_engine': 'curl',
+            'download_segments': 1,
+            'segmented_download_min_size': 1024 * 1024 * 1024,
+            'journal_enabled': True,
+            'journal_compaction_records': 10000,
+            'job_log_path': 'job_logs',
+            'keep_successful_job_logs': False,
             'data_path': "/proteomics/peptideatlas2/archive/Arabidopsis",
             'max_running_jobs': 2,
             'max_running_jobs_by_type': { 'download': 2 },
+            'max_running_jobs_per_host': 2,
+            'download_autotune': False,
+            'download_autotune_min': 1,
+            'download_autotune_max': 8,
+            'download_autotune_window': 30,
+            'max_running_jobs_by_host': {},
+            'bandwidth_limit': 0,
+            'bandwidth_limit_by_host': {},
+            'px_fetch_threads': 4,
+            'px_fetch_timeout': 60,
+            'px_cache_path': 'px_cache',
+            'px_cache_max_age': 24 * 60 * 60,
+            'ftp_listing_ttl': 600,
+            'converter_path': "C:/Users/ericd/Documents/Software/Thermo/ThermoRawFileParser/ThermoRawFileParser",
+            'max_running_conversions': 0,
+            'conversion_memory_per_job': 2 * 1024 * 1024 * 1024,
+            'conversion_niceness': 10,
+            'conversion_cpu_affinity': [],
+            'compression_method': 'gzip',
+            'compression_level': None,
+            'compression_threads': 0,
+            'remove_uncompressed_mzML': True,
+            'fused_conversion': True,
+            'disk_usage_watermark': 0.95,
+            'disk_space_recheck_interval': 30,
+            'unknown_size_reservation': 1024 * 1024 * 1024,
+            'mzML_size_factor': 3.0,
+            'compressed_mzML_size_factor': 1.0,
         }
 
         # Try to find a config file and read it
-        config_file = "./agent_config.json"
+        config_file = self.get_config_file()
+        self.state['config_file_signature'] = self.get_config_file_signature()
         if os.path.exists(config_file):
             try:
-                with open(config_file) as infile:
-                    input_config = json.load(infile)
+                input_config = self.read_config_file()
             except Exception as error:
                 self.response.error(f"Error reading config file {config_file} - {error}", error_code='ConfigFileReadError')
                 return
@@ -114,6 +186,7 @@ class AutomationAgent:
             self.response.warning(f"Did not find a local config file {config_file}. Creating one with current defaults")
             with open(config_file,'w') as outfile:
                 outfile.write(json.dumps(self.config, indent=4, sort_keys=True)+'\n')
+            self.state['config_file_signature'] = self.get_config_file_signature()
             return
 
         self.response.info(f"Read agent config file {config_file}")
@@ -124,9 +197,158 @@ class AutomationAgent:
                 self.response.error(f"Local config file has unrecognized key {key} that is not supported. Check spelling", error_code='ConfigFileKeyError')
                 return
 
+        self.apply_config()
+
+
+    ###############################################################################################
+    def get_config_file(self):
+        """Public method that returns the path of the agent's config file
+        """
+        return self.start_directory + "/agent_config.json"
+
+
+    ###############################################################################################
+    def get_config_file_signature(self):
+        """Public method that returns what identifies the current content of the config file without reading it,
+        or None if there is no config file
+        """
+        try:
+            stat = os.stat(self.get_config_file())
+        except OSError:
+            return None
+        return [ stat.st_ino, stat.st_size, stat.st_mtime_ns ]
+
+
+    ###############################################################################################
+    def read_config_file(self):
+        """Public method that reads the settings in the config file. Exceptions are left to the caller
+
+        :return: The settings in the file
+        :rtype: dict
+        """
+        with open(self.get_config_file()) as infile:
+            input_config = json.load(infile)
+        if not isinstance(input_config, dict):
+            raise ValueError("The config file must contain a JSON object")
+        return input_config
+
+
+    ###############################################################################################
+    def apply_config(self):
+        """Public method that passes the configuration on to the objects that keep their own copy of it.
+        Everything else reads self.config when it needs a setting, so a new config takes effect on the next pass
+
+        """
+
         # Set the data processors data path, too
         self.dataset_processor.base_dir = self.config['data_path']
 
+        # And how it fetches and caches the ProteomeXchange records
+        self.dataset_processor.px_cache_path = self.config['px_cache_path']
+        self.dataset_processor.px_fetch_threads = self.config['px_fetch_threads']
+        self.dataset_processor.px_fetch_timeout = self.config['px_fetch_timeout']
+        self.dataset_processor.px_cache_max_age = self.config['px_cache_max_age']
+        self.dataset_processor.ftp_listing_ttl = self.config['ftp_listing_ttl']
+        if self.dataset_processor.px_fetcher is not None:
+            self.dataset_processor.px_fetcher.timeout = self.config['px_fetch_timeout']
+            self.dataset_processor.px_fetcher.max_age = self.config['px_cache_max_age']
+
+        # And the extension of compressed files, which follows the compression method
+        if not ParallelCompressor.is_available(self.config['compression_method']):
+            self.response.warning(f"Compression method '{self.config['compression_method']}' is not available. Using gzip instead")
+            self.config['compression_method'] = 'gzip'
+            self.config['compression_level'] = None
+        self.dataset_processor.compressed_extension = ParallelCompressor.extensions[self.config['compression_method']]
+        self.dataset_processor.fused_conversion = self.config['fused_conversion']
+
+        # And the thresholds of the per-host circuit breaker
+        self.circuit_breaker.failure_threshold = self.config['circuit_breaker_failures']
+        self.circuit_breaker.cooldown = self.config['circuit_breaker_cooldown']
+
+        # And the limits on the jobs for each remote host
+        self.scheduler.max_running_jobs_per_host = self.config['max_running_jobs_per_host']
+        self.scheduler.max_running_jobs_by_host = self.config['max_running_jobs_by_host']
+
+        # If the number of concurrent downloads is to follow the throughput, start from the configured number.
+        # A tuner that is already running keeps the limit it found, within the new bounds
+        if not self.config['download_autotune']:
+            self.download_tuner = None
+        elif self.download_tuner is None:
+            self.download_tuner = ConcurrencyTuner(minimum=self.config['download_autotune_min'], maximum=self.config['download_autotune_max'],
+                initial=self.config['max_running_jobs_by_type'].get('download', self.config['max_running_jobs']), window=self.config['download_autotune_window'])
+        else:
+            self.download_tuner.minimum = self.config['download_autotune_min']
+            self.download_tuner.maximum = self.config['download_autotune_max']
+            self.download_tuner.window = self.config['download_autotune_window']
+            self.download_tuner.limit = max(min(self.download_tuner.limit, self.download_tuner.maximum), self.download_tuner.minimum)
+
+        # And the limits of the disk space admission control
+        self.disk_space_admission.watermark = self.config['disk_usage_watermark']
+        self.disk_space_admission.recheck_interval = self.config['disk_space_recheck_interval']
+
+        # And the bandwidth budget of the native downloader, if it is already running
+        if self.downloader is not None:
+            self.downloader.bandwidth_limiter.set_rates(self.config['bandwidth_limit'], self.config['bandwidth_limit_by_host'])
+
+
+    ###############################################################################################
+    def reload_config(self):
+        """Public method that rereads the config file while the agent is running and applies what changed.
+        Running jobs are left alone: new limits apply to the jobs launched from now on. A config file that
+        cannot be read or has unrecognized keys is rejected as a whole, and the agent keeps running on the
+        configuration it has. Settings in restart_only_config_keys cannot change under a running agent
+
+        """
+
+        config_file = self.get_config_file()
+        self.state['config_file_signature'] = self.get_config_file_signature()
+        try:
+            input_config = self.read_config_file()
+        except Exception as error:
+            self.response.warning(f"Unable to reload config file {config_file} - {error}. Keeping the current configuration")
+            return
+        unrecognized_keys = [ key for key in input_config if key not in self.config ]
+        if len(unrecognized_keys) > 0:
+            self.response.warning(f"Config file {config_file} has unrecognized keys {unrecognized_keys}. Keeping the current configuration")
+            return
+
+        changed_keys = sorted(key for key,value in input_config.items() if value != self.config[key])
+        if len(changed_keys) == 0:
+            self.response.debug(f"Config file {config_file} has no changes")
+            return
+        for key in changed_keys:
+            if key in self.restart_only_config_keys:
+                self.response.warning(f"Setting {key} cannot be changed while the agent is running. Restart the agent to use {json.dumps(input_config[key])}")
+                continue
+            self.response.info(f"Changing setting {key} from {json.dumps(self.config[key])} to {json.dumps(input_config[key])}")
+            self.config[key] = input_config[key]
+
+            # The executor is recreated with the new settings on next use, while running conversions keep their own
+            if key in self.conversion_config_keys:
+                self.conversion_executor = None
+
+        self.apply_config()
+        self.job_control['generation'] += 1
+        self.tasks_state['wake_immediately'] = True
+
+
+    ###############################################################################################
+    def schedule_config_reload(self):
+        """Public method that reloads the config file config_reload_delay seconds after it last changed, so that
+        a file that an editor writes in several steps is only read once it is complete
+        """
+        self.tasks_state['reload_config_time'] = time.time() + self.config_reload_delay
+
+
+    ###############################################################################################
+    def request_config_reload(self, signum=None, frame=None):
+        """Public method that asks the main loop to reload the config file on its next pass. Safe to call
+        from a signal handler, and installed as the SIGHUP handler while the agent runs
+        """
+        self.tasks_state['reload_config'] = True
+        if self.event_monitor is not None:
+            self.event_monitor.wake()
+
 
     ###############################################################################################
     def prepare_state(self):
@@ -166,6 +388,73 @@ class AutomationAgent:
 
         # Verify the data path
         self.verify_data_path()
+        if self.response.status != 'OK':
+            return
+
+        # Restore the datasets and jobs from the journal of the previous run
+        if self.config['journal_enabled']:
+            self.restore_from_journal()
+
+
+    ###############################################################################################
+    def restore_from_journal(self):
+        """Public method that restores the tracked datasets and the job queue from the journal and
+        prepares the journal to record this run. Jobs that were running when the previous instance
+        went away are reattached if their process is still alive, otherwise they are requeued
+
+        """
+
+        self.response.debug(f"Restoring state from the journal")
+        self.journal = JobJournal(self.start_directory)
+        state = self.journal.load()
+        self.response.merge(self.journal.response)
+        self.journal.response = Response()
+        if self.response.status != 'OK':
+            return
+
+        if len(state['datasets']) > 0:
+            self.dataset_processor.restore_datasets(state['datasets'])
+        self.dataset_processor.journal = self.journal
+
+        # Requeue the jobs, reattaching any that are still running
+        self.job_control['job_index'] = state['job_index']
+        for job_id,job in sorted(state['jobs'].items()):
+            handle = None
+            if job['status'] in [ 'run', 'kill' ] and self.config['job_engine'] == 'popen':
+                handle = ReattachedProcess.find(job.get('pid'), job['args'])
+            if handle is not None:
+                self.response.info(f"Reattaching to job {job_id} still running as pid {handle.pid}")
+                job['handle'] = handle
+                job['status'] = 'run'
+                job['kill_deadline'] = None
+                self.add_job(job)
+                job_index = self.job_control['job_index'] - 1
+                self.scheduler.mark_running(job_index)
+                self.job_control['n_running_jobs'] += job.get('slots', 1)
+                self.job_control['n_running_jobs_by_type'][job['type']] = self.job_control['n_running_jobs_by_type'].get(job['type'], 0) + job.get('slots', 1)
+            else:
+                if job['status'] in [ 'run', 'kill' ]:
+                    job['status'] = 'redo'
+                job['handle'] = None
+                job['pid'] = None
+                self.add_job(job)
+
+        # Start a fresh journal from a snapshot of what we now have
+        self.journal.compact(self.dataset_processor.datasets['identifiers'], self.jobs, self.job_control['job_index'])
+        self.response.merge(self.journal.response)
+
+
+    ###############################################################################################
+    def update_journal(self):
+        """Public method that writes out the records of this pass and compacts the journal when it has grown large
+
+        """
+
+        if self.journal is None:
+            return
+        self.journal.flush()
+        if self.journal.n_records >= self.config['journal_compaction_records']:
+            self.journal.compact(self.dataset_processor.datasets['identifiers'], self.jobs, self.job_control['job_index'])
 
 
     ###############################################################################################
@@ -229,37 +518,87 @@ class AutomationAgent:
 
 
     ###############################################################################################
-    def read_command(self):
-        """Public method that reads the next command from the agent's command file
+    def read_commands(self):
+        """Public method that reads all new commands from the agent's command file
 
+        The command file is tailed: we seek straight to the stored byte offset in command_pointer
+        and drain every complete line appended since the last call. If the file has been truncated
+        or replaced (rotated), reading starts over from the beginning of the new file. A final line
+        without a trailing newline is assumed to be still in the process of being written and is left
+        for the next call. The pointer file is updated once per batch.
+
+        :return: A list of command strings, possibly empty
+        :rtype: list
         """
 
         #self.response.debug(f"Reading command file")
+        commands = []
 
-        # Try to find a pointer file and read it
+        # Try to find the command file and stat it
         #command_file = os.path.dirname(os.path.abspath(__file__))+"/agent_commands.txt"
         command_file = self.start_directory + "/agent_commands.txt"
-        if os.path.exists(command_file):
-            try:
-                with open(command_file) as infile:
-                    pointer = 0
-                    for line in infile:
-                        pointer += len(line)
-                        line = line.rstrip()
-                        if pointer > self.state['command_pointer']:
-                            self.state['command_pointer'] = pointer
-                            self.update_command_pointer_file()
-                            return line
-            except Exception as error:
-                self.response.error(f"Error reading command file {command_file} - {error}", error_code='CommandFileReadError')
-                return
-        else:
+        try:
+            stat = os.stat(command_file)
+        except FileNotFoundError:
             try:
                 with open(command_file,'w'):
                     pass
             except Exception as error:
                 self.response.error(f"Error writing command file {command_file}", error_code='CommandFileCreateError')
-                return
+            return commands
+        except Exception as error:
+            self.response.error(f"Error reading command file {command_file} - {error}", error_code='CommandFileReadError')
+            return commands
+
+        # If the file was replaced by a new one or shrank below our pointer, start over at the beginning
+        pointer = self.state['command_pointer']
+        inode = self.state.get('command_file_inode')
+        if inode is not None and inode != stat.st_ino:
+            self.response.info(f"Command file {command_file} has been replaced. Reading the new file from the beginning")
+            pointer = 0
+        elif stat.st_size < pointer:
+            self.response.warning(f"Command file {command_file} is shorter than the command pointer {pointer}. Assuming it was truncated")
+            pointer = 0
+        self.state['command_file_inode'] = stat.st_ino
+
+        # If there is nothing new, there is no need to even open the file
+        if stat.st_size == pointer:
+            if pointer != self.state['command_pointer']:
+                self.state['command_pointer'] = pointer
+                self.update_command_pointer_file()
+            return commands
+
+        # Seek to where we left off and read all the complete lines that have been appended
+        try:
+            with open(command_file,'rb') as infile:
+
+                # A file rewritten in place may reuse the same inode, so also compare the first bytes we saw last time
+                head = infile.read(64)
+                previous_head = self.state.get('command_file_head')
+                if pointer > 0 and previous_head is not None and head[:len(previous_head)] != previous_head[:len(head)]:
+                    self.response.info(f"Command file {command_file} has been rewritten. Reading it from the beginning")
+                    pointer = 0
+                self.state['command_file_head'] = head
+
+                infile.seek(pointer)
+                for line in infile:
+                    if not line.endswith(b'\n'):
+                        break
+                    pointer += len(line)
+                    line = line.decode('utf-8', errors='replace').strip()
+                    if line == '':
+                        continue
+                    commands.append(line)
+        except Exception as error:
+            self.response.error(f"Error reading command file {command_file} - {error}", error_code='CommandFileReadError')
+            return commands
+
+        # Persist the new pointer once for the whole batch
+        if pointer != self.state['command_pointer']:
+            self.state['command_pointer'] = pointer
+            self.update_command_pointer_file()
+
+        return commands
 
 
 
@@ -284,37 +623,203 @@ class AutomationAgent:
     def run(self):
         """Public method that runs the agent in an endless loop until a STOP file is seen
 
+        Rather than sleeping a fixed interval, the agent blocks in an EventMonitor and wakes up as soon as
+        the command file or STOP file changes or a child process exits. A timer remains as a fallback
+        for the periodic staleness checks, the heartbeat, and for filesystems where change notification
+        is unavailable.
         """
 
+        # The asyncio job engine needs its own event loop
+        if self.config['job_engine'] == 'asyncio':
+            return asyncio.run(self.run_async())
+        elif self.config['job_engine'] != 'popen':
+            self.response.error(f"Unrecognized job_engine '{self.config['job_engine']}'. Must be 'popen' or 'asyncio'", error_code='UnrecognizedJobEngine')
+            return self.response
+
         self.response.info(f"Agent entering run mode")
         self.state['status'] = 'Running'
 
         #### Define the STOP file to watch for
         stop_file = self.start_directory+"/STOP"
-        heartbeat_time = 0
+        heartbeat_time = time.time()
+
+        #### Start listening for events
+        self.event_monitor = EventMonitor(self.start_directory, { 'agent_commands.txt': 'command', 'STOP': 'stop', 'agent_config.json': 'config' })
+        self.event_monitor.start()
+        self.response.merge(self.event_monitor.response)
+        previous_sighup_handler = self.install_sighup_handler()
+        self.dataset_processor.wake_callback = self.event_monitor.wake
+
+        try:
+            while 1:
+
+                # Run the main task of the agent
+                self.tasks_state['wake_immediately'] = False
+                self.main_task()
+                if self.response.status != 'OK':
+                    #print(self.response.show(level=Response.DEBUG))
+                    return self.response
+
+                # Wait until something happens or the next timer is due
+                events = self.event_monitor.wait(self.get_wait_timeout())
+                if 'config' in events:
+                    self.schedule_config_reload()
+
+                # If the heartbeat time is reached, then send a message
+                if time.time() - heartbeat_time > self.config['heartbeat_interval']:
+                    self.response.info(f"Agent is alive and monitoring agent_commands.txt for things to do")
+                    heartbeat_time = time.time()
+
+                # Check on the STOP file. Only stat it when told it changed, unless we cannot be told
+                if 'stop' in events or 'timer' in events or not self.event_monitor.is_watching_files():
+                    if os.path.exists(stop_file):
+                        self.response.info(f"Detected agent STOP file. Shutting down.")
+                        break
+
+        finally:
+            self.restore_sighup_handler(previous_sighup_handler)
+            self.event_monitor.stop()
+
+
+    ###############################################################################################
+    async def run_async(self):
+        """Public coroutine that runs the agent like run(), but with jobs executed by the AsyncJobEngine.
+        Job exits are delivered as callbacks from the engine, so there is no polling of running jobs,
+        and the command file and STOP file notifications are read by the event loop
+
+        """
+
+        self.response.info(f"Agent entering run mode with the asyncio job engine")
+        self.state['status'] = 'Running'
+
+        #### Define the STOP file to watch for
+        stop_file = self.start_directory+"/STOP"
+        heartbeat_time = time.time()
+
+        #### Set up the engine and have file notifications wake the loop. asyncio watches the children itself
+        loop = asyncio.get_running_loop()
+        wake_event = asyncio.Event()
+        self.job_engine = AsyncJobEngine(self)
+        self.job_engine.wake_callback = wake_event.set
+        self.event_monitor = EventMonitor(self.start_directory, { 'agent_commands.txt': 'command', 'STOP': 'stop', 'agent_config.json': 'config' })
+        self.event_monitor.start(watch_children=False)
+        self.response.merge(self.event_monitor.response)
+        previous_sighup_handler = self.install_sighup_handler()
+        self.dataset_processor.wake_callback = self.event_monitor.wake
+        for fd in self.event_monitor.get_fds():
+            loop.add_reader(fd, wake_event.set)
+
+        try:
+            while 1:
+
+                # Run the main task of the agent
+                wake_event.clear()
+                self.tasks_state['wake_immediately'] = False
+                self.main_task()
+                if self.response.status != 'OK':
+                    return self.response
+
+                # Wait until something happens or the next timer is due
+                events = set()
+                try:
+                    await asyncio.wait_for(wake_event.wait(), self.get_wait_timeout())
+                except asyncio.TimeoutError:
+                    events.add('timer')
+                events |= self.event_monitor.wait(0) - { 'timer' }
+                if 'config' in events:
+                    self.schedule_config_reload()
+
+                # If the heartbeat time is reached, then send a message
+                if time.time() - heartbeat_time > self.config['heartbeat_interval']:
+                    self.response.info(f"Agent is alive and monitoring agent_commands.txt for things to do")
+                    heartbeat_time = time.time()
+
+                # Check on the STOP file
+                if 'stop' in events or 'timer' in events or not self.event_monitor.is_watching_files():
+                    if os.path.exists(stop_file):
+                        self.response.info(f"Detected agent STOP file. Shutting down.")
+                        break
+
+        finally:
+            self.restore_sighup_handler(previous_sighup_handler)
+            for fd in self.event_monitor.get_fds():
+                loop.remove_reader(fd)
+            self.event_monitor.stop()
+            await self.job_engine.shutdown()
+            self.response.merge(self.job_engine.response)
+            self.job_engine = None
 
-        while 1:
 
-            # Run the main task of the agent
-            self.main_task()
-            if self.response.status != 'OK':
-                #print(self.response.show(level=Response.DEBUG))
-                return self.response
+    ###############################################################################################
+    def install_sighup_handler(self):
+        """Public method that makes SIGHUP reload the config file, if the platform has it
 
-            # Sleep for the prescribed interval
-            #self.response.debug(f"Sleeping {self.config['sleep_interval']} seconds")
-            time.sleep(self.config['sleep_interval'])
+        :return: The previous handler, to be passed to restore_sighup_handler()
+        """
+        if not hasattr(signal, 'SIGHUP'):
+            return None
+        try:
+            return signal.signal(signal.SIGHUP, self.request_config_reload)
+        except ValueError as error:
+            self.response.warning(f"Unable to install SIGHUP handler: {error}")
+            return None
 
-            # If the heartbeat time is reached, then send a message
-            heartbeat_time += self.config['sleep_interval']
-            if heartbeat_time > self.config['heartbeat_interval']:
-                self.response.info(f"Agent is alive and monitoring agent_commands.txt for things to do")
-                heartbeat_time = 0
 
-            # Check on the STOP file
-            if os.path.exists(stop_file):
-                self.response.info(f"Detected agent STOP file. Shutting down.")
-                break
+    ###############################################################################################
+    def restore_sighup_handler(self, previous_handler):
+        """Public method that puts back the SIGHUP handler that was there before the agent started running
+        """
+        if previous_handler is None:
+            return
+        try:
+            signal.signal(signal.SIGHUP, previous_handler)
+        except ValueError:
+            pass
+
+
+    ###############################################################################################
+    def get_wait_timeout(self):
+        """Public method that computes how long the main loop may block before it must do something
+
+        :return: Number of seconds to wait
+        :rtype: float
+        """
+
+        # If the last pass left work that can continue right away, do not wait at all
+        if self.tasks_state['wake_immediately']:
+            return 0
+
+        # Without file change notification, we must poll the command file at the configured interval
+        if self.event_monitor is None or not self.event_monitor.is_watching_files():
+            timeout = self.config['sleep_interval']
+        else:
+            timeout = self.config['heartbeat_interval']
+
+        # A changed config file is read once it has settled
+        if self.tasks_state['reload_config_time'] is not None:
+            timeout = min(timeout, self.tasks_state['reload_config_time'] - time.time())
+
+        # Retries that are backing off become ready at a known time
+        next_release_time = self.scheduler.next_release_time()
+        if next_release_time is not None:
+            timeout = min(timeout, next_release_time - time.time())
+
+        # The download autotuner needs to close its windows on time
+        if self.download_tuner is not None and self.job_control['n_running_jobs_by_type'].get('download', 0) > 0:
+            next_update_time = self.download_tuner.next_update_time()
+            if next_update_time is not None:
+                timeout = min(timeout, next_update_time - time.time())
+
+        # Running jobs need periodic staleness checks, and jobs being killed may need a SIGKILL.
+        # The asyncio job engine takes care of both by itself
+        if self.job_control['n_running_jobs'] > 0 and self.job_engine is None:
+            timeout = min(timeout, self.job_control['next_staleness_check'] - time.time())
+            for job_id in self.scheduler.running_job_ids:
+                kill_deadline = self.jobs[job_id].get('kill_deadline')
+                if self.jobs[job_id]['status'] == 'kill' and kill_deadline is not None:
+                    timeout = min(timeout, kill_deadline - time.time())
+
+        return max(timeout, 0)
 
 
     ###############################################################################################
@@ -326,6 +831,18 @@ class AutomationAgent:
         self.response.info(f"Stopping agent")
         self.state['status'] = 'Stopping'
 
+        # Stop any native downloads and close their connections
+        if self.downloader is not None:
+            self.downloader.close()
+            self.downloader = None
+        self.dataset_processor.close()
+
+        # Leave a compact snapshot for the next start
+        if self.journal is not None:
+            self.journal.compact(self.dataset_processor.datasets['identifiers'], self.jobs, self.job_control['job_index'])
+            self.journal.close()
+            self.journal = None
+
         #### Remove our PID file
         pid_file = self.start_directory+"/PID"
         if os.path.exists(pid_file):
@@ -360,8 +877,12 @@ class AutomationAgent:
         job_index = self.job_control['job_index']
         self.response.debug(f"Adding new job {job_index} to the queue")
         self.jobs[job_index] = job
+        self.scheduler.enqueue(job_index, job)
+        if self.journal is not None:
+            self.journal.record_job(job_index, job)
         self.job_control['n_jobs'] += 1
         self.job_control['job_index'] += 1
+        self.job_control['generation'] += 1
 
 
     ###############################################################################################
@@ -370,17 +891,83 @@ class AutomationAgent:
 
         """
 
-        eprint(f"  n_jobs={self.job_control['n_jobs']}, n_running_jobs={self.job_control['n_running_jobs']}")
-        for job_id,job in self.jobs.items():
+        eprint(f"  n_jobs={self.job_control['n_jobs']}, n_running_jobs={self.job_control['n_running_jobs']}, " +
+            f"running by host: {self.scheduler.n_running_slots_by_host}")
+        download_limit = f"  download limit: {self.get_download_limit()}"
+        if self.download_tuner is not None:
+            download_limit += f" (autotuned between {self.download_tuner.minimum} and {self.download_tuner.maximum}, " + \
+                f"configured {self.config['max_running_jobs_by_type'].get('download', self.config['max_running_jobs'])}"
+            if self.download_tuner.throughput is not None:
+                download_limit += f", last window {self.format_bytes(self.download_tuner.throughput)}/s"
+            download_limit += ')'
+        eprint(download_limit)
+        if self.config['bandwidth_limit'] or self.config['bandwidth_limit_by_host']:
+            rates_by_host = { host: f"{self.format_bytes(rate)}/s" for host,rate in self.config['bandwidth_limit_by_host'].items() }
+            eprint(f"  bandwidth limit: {self.format_bytes(self.config['bandwidth_limit']) + '/s' if self.config['bandwidth_limit'] else 'none'}, " +
+                f"by host: {rates_by_host}, assigned to curl downloads: {self.format_bytes(self.get_assigned_bandwidth())}/s")
+        for job_id in sorted(self.scheduler.running_job_ids):
+            job = self.jobs[job_id]
+
+            # Report the progress measured at the last staleness check rather than stat the output again
             output_status = 'none'
-            if 'expected_output_file' in job:
-                if os.path.exists(job['expected_output_file']):
-                    mtime = os.path.getmtime(job['expected_output_file'])
-                    now = time.time()
-                    age = age = int(now-mtime)
-                    output_status = f"file age: {age} s"
-            if job['status'] == 'run':
-                eprint(f"    - {job_id}: status={job['status']}, type={job['status']}, cmd={' '.join(job['args'])}, output: {output_status}")
+            progress = job.get('progress')
+            if progress is not None:
+                output_status = f"{self.format_bytes(progress['bytes'])}"
+                if progress['throughput'] is not None:
+                    output_status += f" at {self.format_bytes(progress['throughput'])}/s"
+                if progress['eta'] is not None:
+                    output_status += f", ETA {int(progress['eta'])} s"
+            eprint(f"    - {job_id}: status={job['status']}, type={job['type']}, cmd={' '.join(job['args'])}, output: {output_status}")
+            log_tail = self.get_job_log_tail(job)
+            if log_tail != '':
+                eprint(f"        log: {log_tail}")
+
+
+    ###############################################################################################
+    def get_job_log_file(self, job_id):
+        """Public method that returns the path of the file to which a job's stdout and stderr are written
+
+        :param job_id: Index of the job in the queue
+        :type job_id: int
+        :return: Full path of the log file
+        :rtype: str
+        """
+
+        log_path = self.config['job_log_path']
+        if not os.path.isabs(log_path):
+            log_path = f"{self.start_directory}/{log_path}"
+        return f"{log_path}/job_{job_id}.log"
+
+
+    ###############################################################################################
+    def get_job_log_tail(self, job, n_bytes=2048, max_length=200):
+        """Public method that returns the last line of output that a job has written to its log.
+        Progress meters that redraw themselves with carriage returns are split on those as well.
+
+        :param job: The job dict
+        :type job: dict
+        :param n_bytes: Number of bytes at the end of the log to consider
+        :type n_bytes: int
+        :param max_length: Maximum number of characters of the line to return
+        :type max_length: int
+        :return: The last non-empty line of the log, or an empty string
+        :rtype: str
+        """
+
+        if job.get('log_file') is None:
+            return ''
+        try:
+            with open(job['log_file'],'rb') as infile:
+                infile.seek(0, os.SEEK_END)
+                size = infile.tell()
+                infile.seek(max(size - n_bytes, 0))
+                content = infile.read().decode('utf-8', errors='replace')
+        except OSError:
+            return ''
+        for line in reversed(re.split(r'[\r\n]+', content)):
+            if line.strip() != '':
+                return line.strip()[-max_length:]
+        return ''
 
 
     ###############################################################################################
@@ -392,44 +979,372 @@ class AutomationAgent:
         # If there is nothing to do, return immediately
         if self.job_control['n_jobs'] == 0:
             return
-        if self.job_control['n_running_jobs'] >= self.config['max_running_jobs']:
-            return
-
-        # Loop through the jobs to determine priority
-        urgent_jobs_list = []
-        other_jobs_list = []
-        for job_id,job in self.jobs.items():
-            if job['status'] == 'run':
-                continue
-            elif job['status'] == 'redo':
-                urgent_jobs_list.append(job_id)
-            else:
-                other_jobs_list.append(job_id)
 
-        jobs_list = urgent_jobs_list
-        for job_id in other_jobs_list:
-            jobs_list.append(job_id)
+        # I/O-bound jobs share max_running_jobs, while CPU-bound conversions and compressions have a pool of their own
+        n_running_jobs_by_type = self.job_control['n_running_jobs_by_type']
+        n_running_cpu_jobs = sum(n_running_jobs_by_type.get(job_type, 0) for job_type in self.cpu_bound_job_types)
+        max_running_jobs = self.config['max_running_jobs']
+        if self.download_tuner is not None:
+            max_running_jobs = max(max_running_jobs, self.download_tuner.limit)
+        n_free_slots = max_running_jobs - ( self.job_control['n_running_jobs'] - n_running_cpu_jobs )
+        n_free_slots_by_type = { job_type: 0 for job_type in self.cpu_bound_job_types }
+        for job_type,max_jobs_of_type in self.config['max_running_jobs_by_type'].items():
+            if job_type not in self.cpu_bound_job_types:
+                n_free_slots_by_type[job_type] = max_jobs_of_type - n_running_jobs_by_type.get(job_type, 0)
+        n_free_slots_by_type['download'] = self.get_download_limit() - n_running_jobs_by_type.get('download', 0)
+        n_free_cpu_slots = 0
+        if any(self.scheduler.peek(job_type) is not None for job_type in self.cpu_bound_job_types):
+            n_free_cpu_slots = self.get_conversion_executor().max_running_jobs - n_running_cpu_jobs
+        if n_free_slots <= 0 and n_free_cpu_slots <= 0:
+            return
 
-        # Loop through the jobs and see if any can be started
-        for job_id in jobs_list:
+        # Jobs are only admitted if what they are expected to write fits on the disk
+        admit = None
+        if self.update_disk_usage():
+            admit = self.admit_job
+        job_ids = []
+        if n_free_slots > 0:
+            job_ids += self.scheduler.select_jobs_to_launch(n_free_slots, n_free_slots_by_type, admit=admit)
+        if n_free_cpu_slots > 0:
+            job_ids += self.scheduler.select_jobs_to_launch(n_free_cpu_slots, {}, job_types=self.cpu_bound_job_types, admit=admit)
+
+        # Launch the jobs that the scheduler picked for those slots
+        for job_id in job_ids:
             job = self.jobs[job_id]
             job_type = job['type']
             if job_type not in self.job_control['n_running_jobs_by_type']:
                 self.job_control['n_running_jobs_by_type'][job_type] = 0
-            if self.job_control['n_running_jobs_by_type'][job_type] >= self.config['max_running_jobs_by_type'][job_type]:
-                continue
 
             self.response.info(f"Launching job '{job_id}'")
-            cwd = os.getcwd()
-            os.chdir(job['location'])
-            proc = subprocess.Popen(job['args'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            job['handle'] = proc
-            os.chdir(cwd)
-            job['pid'] = proc.pid
+
+            # Send the job's output to a log file so that it can never block on a full pipe
+            job['log_file'] = self.get_job_log_file(job_id)
+            self.assign_download_rate(job)
+
+            # What a resumed job finds in place is not its own work, so its first interval is measured from that
+            job['launch_bytes'] = 0
+            if job.get('engine') != 'native' and 'expected_output_file' in job:
+                job['launch_bytes'] = self.measure_job_bytes(job)[0]
+            if self.job_engine is not None:
+                self.job_engine.start(job_id, job)
+            elif job.get('engine') == 'native':
+                self.start_native_download(job)
+            else:
+                try:
+                    os.makedirs(os.path.dirname(job['log_file']), exist_ok=True)
+                    with open(job['log_file'],'ab') as log_file:
+                        proc = subprocess.Popen(job['args'], cwd=job['location'], stdout=log_file, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+                except Exception as error:
+                    # The job never ran, so it gives up its slot and is tried again later like a job that failed
+                    self.scheduler.remove(job_id)
+                    del self.jobs[job_id]
+                    if self.journal is not None:
+                        self.journal.record_job_done(job_id)
+                    self.job_control['n_jobs'] -= 1
+                    self.response.warning(f"Unable to launch job '{job_id}' - {error}")
+                    job['n_retries'] = job.get('n_retries', 0) + 1
+                    if job['n_retries'] <= job.get('max_retries', 10):
+                        self.requeue_job(job)
+                    else:
+                        message = f"Max retries {job.get('max_retries', 10)} reached launching '{' '.join(job['args'])}'. Giving up on it"
+                        self.response.warning(message)
+                        if 'file_handle' in job:
+                            self.dataset_processor.mark_file_failed(job['file_handle'], message)
+                    continue
+                job['handle'] = proc
+                job['pid'] = proc.pid
+                self.apply_process_limits(job)
+
             job['status'] = 'run'
             job['launch_timestamp'] = time.time()
-            self.job_control['n_running_jobs'] += 1
-            self.job_control['n_running_jobs_by_type'][job_type] += 1
+            if self.journal is not None:
+                self.journal.record_job_launch(job_id, job)
+            self.job_control['n_running_jobs'] += job.get('slots', 1)
+            self.job_control['n_running_jobs_by_type'][job_type] += job.get('slots', 1)
+            self.job_control['generation'] += 1
+
+
+    ###############################################################################################
+    def get_download_limit(self):
+        """Public method that returns the number of download slots that may be in use at once, as chosen by the
+        autotuner if it is enabled, otherwise as configured
+        """
+        if self.download_tuner is not None:
+            return self.download_tuner.limit
+        return self.config['max_running_jobs_by_type'].get('download', self.config['max_running_jobs'])
+
+
+    ###############################################################################################
+    def assign_download_rate(self, job):
+        """Public method that gives a curl download job that is about to be launched its share of the bandwidth
+        budget. A curl process cannot change its rate once started, so each job gets what the running ones leave
+        of the budget divided among the download slots not yet assigned, and what it gets is returned to the budget
+        when it exits. Native downloads are not assigned a rate because they draw from the DownloadEngine's shared buckets
+
+        :param job: The job dict, whose 'args' get a --limit-rate and whose 'rate_limit' is set
+        :type job: dict
+        """
+
+        # Drop the rate of a previous run, which no longer fits the jobs now running
+        job.pop('rate_limit', None)
+        args = job['args']
+        if '--limit-rate' in args:
+            index = args.index('--limit-rate')
+            del args[index:index + 2]
+        if job['type'] != 'download' or args[0] != 'curl':
+            return
+
+        download_limit = self.get_download_limit()
+        rate = self.get_bandwidth_share(self.config['bandwidth_limit'], download_limit)
+        host = job.get('host')
+        host_budget = self.config['bandwidth_limit_by_host'].get(host)
+        if host_budget:
+            host_limit = self.scheduler.get_host_limit(host)
+            host_rate = self.get_bandwidth_share(host_budget, download_limit if host_limit is None else min(host_limit, download_limit), host)
+            rate = host_rate if rate is None else min(rate, host_rate)
+        if rate is None:
+            return
+        job['rate_limit'] = rate
+        args[1:1] = [ '--limit-rate', str(rate) ]
+
+
+    ###############################################################################################
+    def get_bandwidth_share(self, budget, n_slots, host=None):
+        """Public method that divides what the running curl downloads leave of a bandwidth budget among the slots
+        that have no rate yet. The share never drops below twice the staleness floor, or the job would be killed as stale
+
+        :param budget: Number of bytes per second for all the downloads, or 0 for no limit
+        :type budget: float
+        :param n_slots: Number of downloads that may run at once under this budget
+        :type n_slots: int
+        :param host: If set, only downloads from this host count against the budget
+        :type host: str
+        :return: Number of bytes per second, or None if there is no limit
+        :rtype: int
+        """
+        if not budget:
+            return None
+        n_assigned = 0
+        for job_id in self.scheduler.running_job_ids:
+            job = self.jobs[job_id]
+            if 'rate_limit' in job and ( host is None or job.get('host') == host ):
+                n_assigned += 1
+        n_unassigned = max(n_slots - n_assigned, 1)
+        return max(int((budget - self.get_assigned_bandwidth(host)) / n_unassigned), 2 * self.config['minimum_job_throughput'])
+
+
+    ###############################################################################################
+    def get_assigned_bandwidth(self, host=None):
+        """Public method that returns the number of bytes per second assigned to the running curl downloads,
+        or only to those from one host
+        """
+        assigned = 0
+        for job_id in self.scheduler.running_job_ids:
+            job = self.jobs[job_id]
+            if host is None or job.get('host') == host:
+                assigned += job.get('rate_limit', 0)
+        return assigned
+
+
+    ###############################################################################################
+    def tune_download_concurrency(self):
+        """Public method that lets the autotuner know whether the download limit is holding jobs back and, at the
+        end of each of its windows, adopts the limit it chooses for the throughput it measured
+        """
+
+        if self.download_tuner is None:
+            return
+        limit = self.download_tuner.limit
+        n_running_downloads = self.job_control['n_running_jobs_by_type'].get('download', 0)
+        self.download_tuner.record(0, n_running_downloads >= limit or self.scheduler.peek('download') is not None)
+        if self.download_tuner.update(time.time()):
+            self.response.info(f"Changing the download limit from {limit} to {self.download_tuner.limit} after a throughput of " +
+                f"{self.format_bytes(self.download_tuner.throughput)}/s with {n_running_downloads} downloads running")
+            self.job_control['generation'] += 1
+
+
+    ###############################################################################################
+    def update_disk_usage(self):
+        """Public method that gives the disk space admission control the current usage of the file system
+        under data_path and the number of bytes that the running jobs have yet to write
+
+        :return: False if the usage could not be determined, in which case jobs are not held back
+        :rtype: bool
+        """
+
+        try:
+            usage = shutil.disk_usage(self.config['data_path'])
+        except OSError as error:
+            self.response.warning(f"Unable to get the disk usage of {self.config['data_path']} - {error}")
+            return False
+        reserved_bytes = 0
+        for job_id in self.scheduler.running_job_ids:
+            reserved_bytes += self.get_job_remaining_bytes(self.jobs[job_id])
+        self.disk_space_admission.update(usage.total, usage.free, reserved_bytes)
+        return True
+
+
+    ###############################################################################################
+    def admit_job(self, job_id):
+        """Public method that decides whether a job that the scheduler is about to launch has room on the disk
+        for what it is expected to write. Called by the scheduler for each job it selects
+
+        :param job_id: Index of the job in the queue
+        :type job_id: int
+        :return: None if the job may be launched, otherwise the time at which to try again
+        :rtype: float
+        """
+
+        job = self.jobs[job_id]
+        n_bytes = self.get_job_remaining_bytes(job)
+        wait_until = self.disk_space_admission.admit(n_bytes, time.time())
+        if wait_until is None:
+            job.pop('waiting_for_space', None)
+        elif not job.get('waiting_for_space'):
+            self.response.warning(f"Holding job {job_id} for {job.get('expected_output_file', ' '.join(job['args']))}: its {self.format_bytes(n_bytes)} would take " +
+                f"{self.config['data_path']} past {int(self.disk_space_admission.watermark * 100)}% full. Retrying every {self.disk_space_admission.recheck_interval} s")
+            job['waiting_for_space'] = True
+        return wait_until
+
+
+    ###############################################################################################
+    def get_job_remaining_bytes(self, job):
+        """Public method that estimates how many more bytes a job will write. Downloads are expected to write the
+        size of the remote file, and conversions and compressions the estimate made when they were queued. What is
+        already allocated to the output file, including a preallocated or partial one, is deducted
+
+        :param job: The job dict
+        :type job: dict
+        :return: Number of bytes
+        :rtype: int
+        """
+
+        expected_size = job.get('expected_size')
+        if job['type'] == 'download' and 'file_handle' in job:
+            expected_size = job['file_handle'].get('expected_size')
+        if expected_size is None:
+            expected_size = self.config['unknown_size_reservation']
+        try:
+            n_bytes_allocated = os.stat(job.get('progress_file', job['expected_output_file'])).st_blocks * 512
+        except (OSError, KeyError):
+            n_bytes_allocated = 0
+        return max(expected_size - n_bytes_allocated, 0)
+
+
+    ###############################################################################################
+    def estimate_output_size(self, input_file, size_factor):
+        """Public method that estimates the size of the output of a conversion or compression from the size of its input
+        """
+        try:
+            return int(os.path.getsize(input_file) * size_factor)
+        except OSError:
+            return None
+
+
+    ###############################################################################################
+    def get_conversion_executor(self):
+        """Public method that returns the ConversionExecutor, creating it on first use
+
+        :return: The executor for conversion jobs
+        :rtype: ConversionExecutor
+        """
+
+        if self.conversion_executor is None:
+            self.conversion_executor = ConversionExecutor(self.config['converter_path'], max_running_jobs=self.config['max_running_conversions'],
+                memory_per_job=self.config['conversion_memory_per_job'], niceness=self.config['conversion_niceness'],
+                cpu_affinity=self.config['conversion_cpu_affinity'])
+            self.response.merge(self.conversion_executor.response)
+            self.conversion_executor.response = Response()
+        return self.conversion_executor
+
+
+    ###############################################################################################
+    def apply_process_limits(self, job):
+        """Public method that applies the priority and affinity of its executor to a just-launched job process
+        """
+        if job['type'] not in self.cpu_bound_job_types or job.get('pid') is None:
+            return
+        executor = self.get_conversion_executor()
+        executor.apply_process_limits(job['pid'])
+        self.response.merge(executor.response)
+        executor.response = Response()
+
+
+    ###############################################################################################
+    def get_downloader(self):
+        """Public method that returns the native DownloadEngine, creating it on first use
+
+        :return: The shared DownloadEngine
+        :rtype: DownloadEngine
+        """
+
+        if self.downloader is None:
+            self.downloader = DownloadEngine()
+            self.downloader.bandwidth_limiter.set_rates(self.config['bandwidth_limit'], self.config['bandwidth_limit_by_host'])
+        return self.downloader
+
+
+    ###############################################################################################
+    def start_native_download(self, job):
+        """Public method that starts a download job on the native DownloadEngine instead of a curl process.
+        The returned task stands in for the Popen handle, and its completion wakes up the main loop
+
+        :param job: The job dict, with 'uri', 'expected_output_file' and 'log_file'
+        :type job: dict
+        :return: The running download
+        :rtype: DownloadTask
+        """
+
+        try:
+            os.makedirs(os.path.dirname(job['log_file']), exist_ok=True)
+        except OSError as error:
+            self.response.warning(f"Unable to create job log directory - {error}")
+        task = self.get_downloader().start(job['uri'], job['expected_output_file'], log_file=job['log_file'],
+            on_complete=self.handle_download_complete, n_segments=job.get('slots', 1))
+        job['handle'] = task
+        job['pid'] = None
+        return task
+
+
+    ###############################################################################################
+    def plan_download_segments(self, job):
+        """Public method that decides into how many concurrent segments a native download job is split.
+        Each segment takes one download slot, so a segmented job is counted against max_running_jobs_by_type
+        and the limit of its host as that many jobs. Only files known to be at least segmented_download_min_size are split, or files
+        whose segmented download is already under way
+
+        :param job: The job dict, which gets 'slots' set
+        :type job: dict
+        """
+
+        n_segments = self.config['download_segments']
+        expected_size = job['file_handle'].get('expected_size')
+        is_large = expected_size is not None and expected_size >= self.config['segmented_download_min_size']
+        if not is_large and not os.path.exists(f"{job['expected_output_file']}.segments"):
+            n_segments = 1
+
+        # A job must fit within the limits or it could never be launched
+        max_slots = self.get_download_limit()
+        if self.download_tuner is None:
+            max_slots = min(max_slots, self.config['max_running_jobs'])
+        host_limit = self.scheduler.get_host_limit(job.get('host'))
+        if host_limit is not None:
+            max_slots = min(max_slots, host_limit)
+        job['slots'] = max(min(n_segments, max_slots), 1)
+
+        # Segments are written to a .part file, which is where progress shows
+        if job['slots'] > 1:
+            job['progress_file'] = f"{job['expected_output_file']}.part"
+        else:
+            job.pop('progress_file', None)
+
+
+    ###############################################################################################
+    def handle_download_complete(self, task):
+        """Public callback, run in the download thread, that wakes up the main loop to reap a finished download
+        """
+        if self.event_monitor is not None:
+            self.event_monitor.wake()
 
 
     ###############################################################################################
@@ -442,110 +1357,458 @@ class AutomationAgent:
         if self.job_control['n_running_jobs'] == 0:
             return
 
-        # Loop through the jobs and poll any running ones
-        job_ids_to_delete = []
-        jobs_to_restart = []
-        for job_id,job in self.jobs.items():
-            if job['status'] != 'run':
-                continue
+        # The staleness checks stat output files, so only do them every staleness_check_interval
+        now = time.time()
+        check_staleness = False
+        if now >= self.job_control['next_staleness_check']:
+            check_staleness = True
+            self.job_control['next_staleness_check'] = now + self.config['staleness_check_interval']
 
+        # Loop through the running jobs and poll them
+        for job_id in list(self.scheduler.running_job_ids):
+            job = self.jobs[job_id]
             proc = job['handle']
             return_code = proc.poll()
 
+            #### If this job is being killed, wait for it to go away without blocking everything else
+            if job['status'] == 'kill':
+                if return_code is None:
+                    if job['kill_deadline'] is not None and now >= job['kill_deadline']:
+                        self.response.warning(f"Job {job_id} did not exit within {self.config['kill_grace_period']} s of being terminated. Killing it")
+                        proc.kill()
+                        job['kill_deadline'] = None
+                    continue
+
             #### If still running, try to determine if still productive
-            if return_code is None:
-                if 'retry_staleness' in job and 'expected_output_file' in job and job['retry_staleness'] > 0:
-                    if os.path.exists(job['expected_output_file']):
-                        mtime = os.path.getmtime(job['expected_output_file'])
-                        now = time.time()
-                        file_age = int(now - mtime)
-                        job_age = int(now - job['launch_timestamp'])
-                        if file_age > job['retry_staleness'] and job_age > job['retry_staleness']:
-                            self.response.warning(f"Maximum staleness {job['retry_staleness']} reached for file {job['expected_output_file']}. Kill and restart.")
-                            if 'n_retries' not in job: job['n_retries'] = 0
-                            if 'max_retries' not in job: job['max_retries'] = 10
-                            job['handle'].terminate()
-                            self.job_control['n_jobs'] -= 1
-                            self.job_control['n_running_jobs'] -= 1
-                            self.job_control['n_running_jobs_by_type'][job['type']] -= 1
-                            time.sleep(5)
-                            job_ids_to_delete.append(job_id)
-                            #os.rename(job['expected_output_file'],f"{job['expected_output_file']}-{job['n_retries']}")
-
-                            #### See if we should restart it
-                            job['n_retries'] += 1
-                            if job['n_retries'] > job['max_retries']:
-                                self.response.error(f"Max retries {job['max_retries']} reached for file {job['expected_output_file']}", error_code='MaxRetriesReached')
-                            else:
-                                jobs_to_restart.append(job)
+            elif return_code is None:
+                if check_staleness and self.is_job_stale(job, now):
+                    self.response.warning(f"{job['progress']['stale_reason']}. Kill and restart.")
+
+                    # Ask it to stop and come back for it later. The slot is held until it is reaped
+                    proc.terminate()
+                    job['status'] = 'kill'
+                    job['kill_deadline'] = now + self.config['kill_grace_period']
+                    self.job_control['generation'] += 1
 
                 # Back to the top if it was still running
                 continue
 
-            # If the job has exited, close it off
-            self.response.info(f"Job {job_id} is complete with return code {return_code}")
-            job_ids_to_delete.append(job_id)
-            self.job_control['n_jobs'] -= 1
-            self.job_control['n_running_jobs'] -= 1
-            self.job_control['n_running_jobs_by_type'][job['type']] -= 1
-
-            # If this was a file download job, check the result and clean up the queue entry
-            if job['type'] == 'download':
-
-                # If there is a file where we expect it
-                if os.path.exists(job['file_handle']['full_path']):
-
-                    # If the job has a set minimum final page, then check that
-                    # (the curl downloader sets the final mtime of the file to that at the origin if completely successful
-                    # but if the curl dies half-way, then the mtime does get reset and indicates the current time, a telltale
-                    # sign of a failed download. If this is so, continue the download)
-                    if 'minimum_final_age' in job:
-                        mtime = os.path.getmtime(job['expected_output_file'])
-                        now = time.time()
-                        file_age = int(now - mtime)
- 
-                        # If the age is greater than the final age, then we're done
-                        if file_age >= job['minimum_final_age']:
-                            job['file_handle']['status'] = 'READY'
-                            job['file_handle']['is_complete'] = True
-                            job['file_handle']['current_size'] = os.path.getsize(job['file_handle']['full_path'])
-
-                        # Otherwise, queue a retry with continue
-                        else:
-                            job['n_retries'] += 1
-                            if job['n_retries'] > job['max_retries']:
-                                self.response.error(f"Max retries {job['max_retries']} reached for file {job['expected_output_file']}", error_code='MaxRetriesReached')
-                            else:
-                                jobs_to_restart.append(job)
+            # The job has exited, so close it off
+            self.complete_job(job_id, job, return_code)
 
-                    # If there's no minium required age, then assume the download was fine
-                    else:
+
+    ###############################################################################################
+    def is_job_stale(self, job, now):
+        """Public method that decides whether a running job has stopped making progress. The job is stale when
+        its throughput over the last retry_staleness seconds is below the minimum_job_throughput floor
+        (or the job's own 'minimum_throughput'), so slow but steady transfers are left alone
+
+        :param job: The job dict
+        :type job: dict
+        :param now: The current time
+        :type now: float
+        :return: True if the job should be killed and restarted
+        :rtype: bool
+        """
+
+        progress = self.sample_job_progress(job, now)
+        if progress is None or 'retry_staleness' not in job or job['retry_staleness'] <= 0:
+            return False
+
+        # Only judge once a full window of samples is available
+        window = job['retry_staleness']
+        first_time, first_bytes = progress['samples'][0]
+        if now - first_time < window or now - job['launch_timestamp'] < window:
+            return False
+        window_throughput = (progress['samples'][-1][1] - first_bytes) / (now - first_time)
+        minimum_throughput = job.get('minimum_throughput', self.config['minimum_job_throughput'])
+        if window_throughput < minimum_throughput:
+            progress['stale_reason'] = f"Throughput of {self.format_bytes(window_throughput)}/s over the last {int(now - first_time)} s " + \
+                f"is below the minimum {self.format_bytes(minimum_throughput)}/s for file {job['expected_output_file']}"
+            return True
+        return False
+
+
+    ###############################################################################################
+    def measure_job_bytes(self, job):
+        """Public method that measures how many bytes a job has produced. Native downloads report their byte
+        count directly. Otherwise the size of the job's output file is taken, which is one stat per call
+
+        :param job: The job dict
+        :type job: dict
+        :return: None if the job has no output to measure, otherwise a tuple of what this run has produced and
+            what is done including what was there before it
+        :rtype: tuple
+        """
+        handle = job.get('handle')
+        if getattr(handle, 'bytes_transferred', None) is not None:
+            return handle.bytes_transferred, handle.start_offset + handle.bytes_transferred
+        if 'expected_output_file' not in job:
+            return None
+        try:
+            n_bytes = os.path.getsize(job.get('progress_file', job['expected_output_file']))
+        except OSError:
+            n_bytes = 0
+        return n_bytes, n_bytes
+
+
+    ###############################################################################################
+    def sample_job_progress(self, job, now):
+        """Public method that records how many bytes a running job has produced so far and updates its
+        throughput estimates, crediting the download tuner with what a download wrote since the previous sample
+
+        :param job: The job dict, whose 'progress' dict is updated
+        :type job: dict
+        :param now: The current time
+        :type now: float
+        :return: The 'progress' dict with 'bytes' (done so far), 'samples' (a sliding window of [time, bytes] covering
+            retry_staleness seconds), 'throughput' (an EWMA in bytes/s), and 'eta' (seconds, or None)
+        :rtype: dict
+        """
+
+        measured_bytes = self.measure_job_bytes(job)
+        if measured_bytes is None:
+            return None
+        n_bytes, n_bytes_done = measured_bytes
+        total_size = getattr(job.get('handle'), 'total_size', None)
+        if total_size is None and 'file_handle' in job and job['type'] == 'download':
+            total_size = job['file_handle'].get('expected_size')
+
+        # The first interval runs from the launch, if what the job started from was measured then
+        progress = job.get('progress')
+        if progress is None:
+            progress = { 'bytes': n_bytes_done, 'samples': [], 'throughput': None, 'eta': None }
+            job['progress'] = progress
+            if 'launch_bytes' in job and 'launch_timestamp' in job:
+                progress['samples'].append( [ job['launch_timestamp'], job['launch_bytes'] ] )
+
+        if len(progress['samples']) > 0:
+            # Exponentially weighted moving average of the rate since the previous sample
+            previous_time, previous_bytes = progress['samples'][-1]
+            elapsed = now - previous_time
+            if self.download_tuner is not None and job['type'] == 'download':
+                self.download_tuner.record(max(n_bytes - previous_bytes, 0), False)
+            if elapsed > 0:
+                rate = max(n_bytes - previous_bytes, 0) / elapsed
+                if progress['throughput'] is None:
+                    progress['throughput'] = rate
+                else:
+                    alpha = 1 - math.exp(-elapsed / self.throughput_time_constant)
+                    progress['throughput'] += alpha * (rate - progress['throughput'])
+        progress['bytes'] = n_bytes_done
+        progress['samples'].append( [ now, n_bytes ] )
+
+        # Keep just enough samples to span the staleness window
+        window = job.get('retry_staleness', 0)
+        while len(progress['samples']) > 2 and now - progress['samples'][1][0] >= window:
+            progress['samples'].pop(0)
+
+        progress['eta'] = None
+        if total_size is not None and progress['throughput']:
+            progress['eta'] = max(total_size - n_bytes_done, 0) / progress['throughput']
+        return progress
+
+
+    ###############################################################################################
+    def format_bytes(self, n_bytes):
+        """Public method that renders a number of bytes in human-readable units
+        """
+        for unit in [ 'B', 'kB', 'MB', 'GB' ]:
+            if abs(n_bytes) < 1000:
+                return f"{n_bytes:.1f} {unit}" if unit != 'B' else f"{int(n_bytes)} B"
+            n_bytes /= 1000
+        return f"{n_bytes:.1f} TB"
+
+
+    ###############################################################################################
+    def complete_job(self, job_id, job, return_code):
+        """Public method that closes off a job whose process has exited, records the result in its
+        file handle, and requeues it if it needs another try. Called by poll_jobs() or by the
+        asyncio job engine when the process has been reaped
+
+        :param job_id: Index of the job in the queue
+        :type job_id: int
+        :param job: The job dict
+        :type job: dict
+        :param return_code: Exit status of the job's process
+        :type return_code: int
+        """
+
+        # Release the job's slot
+        del self.jobs[job_id]
+        self.scheduler.remove(job_id)
+        if self.journal is not None:
+            self.journal.record_job_done(job_id)
+        self.job_control['n_jobs'] -= 1
+        self.job_control['n_running_jobs'] -= job.get('slots', 1)
+        self.job_control['n_running_jobs_by_type'][job['type']] -= job.get('slots', 1)
+
+        # The datasets and the queue deserve another look right away
+        self.job_control['generation'] += 1
+        self.tasks_state['wake_immediately'] = True
+
+        # The job wrote into its dataset's directory, so the listing the datasets are assessed from may be stale
+        if 'file_handle' in job:
+            self.dataset_processor.invalidate_directory_snapshot(job['file_handle']['location'])
+
+        # Credit the tuner with what a download wrote after it was last sampled
+        if self.download_tuner is not None and job['type'] == 'download':
+            measured_bytes = self.measure_job_bytes(job)
+            progress = job.get('progress')
+            if progress is not None and len(progress['samples']) > 0:
+                previous_bytes = progress['samples'][-1][1]
+            else:
+                previous_bytes = job.get('launch_bytes')
+            if measured_bytes is not None and previous_bytes is not None:
+                self.download_tuner.record(max(measured_bytes[0] - previous_bytes, 0), False)
+
+        # Remember the size the native downloader found, so that a retry can be split into segments
+        total_size = getattr(job.get('handle'), 'total_size', None)
+        if total_size is not None and 'file_handle' in job:
+            job['file_handle']['expected_size'] = total_size
+
+        #### If the job was killed for being stale, see if we should restart it
+        if job['status'] == 'kill':
+            self.response.info(f"Stale job {job_id} has exited with return code {return_code}")
+            #os.rename(job['expected_output_file'],f"{job['expected_output_file']}-{job['n_retries']}")
+            if 'n_retries' not in job: job['n_retries'] = 0
+            if 'max_retries' not in job: job['max_retries'] = 10
+            job['n_retries'] += 1
+            self.record_host_result(job, success=False)
+            if job['n_retries'] > job['max_retries']:
+                self.response.error(f"Max retries {job['max_retries']} reached for file {job['expected_output_file']}", error_code='MaxRetriesReached')
+            else:
+                self.requeue_job(job)
+            return
+
+        # If the job has exited, close it off
+        self.response.info(f"Job {job_id} is complete with return code {return_code}")
+
+        # Logs of failed jobs are kept for inspection, but successful ones are just clutter
+        if return_code != 0:
+            self.response.warning(f"Job {job_id} output ends with: {self.get_job_log_tail(job)}")
+        elif not self.config['keep_successful_job_logs'] and job.get('log_file') is not None:
+            try:
+                os.remove(job['log_file'])
+            except OSError:
+                pass
+
+        # If this was a file download job, check the result
+        if job['type'] == 'download' and 'file_handle' in job:
+
+            # The native downloader verifies the size itself, so any failure other than a missing remote file is retried
+            if job.get('engine') == 'native' and return_code not in [ DownloadTask.RETURN_CODE_OK, DownloadTask.RETURN_CODE_NOT_FOUND ]:
+                job['n_retries'] += 1
+                self.record_host_result(job, success=False)
+                if job['n_retries'] > job['max_retries']:
+                    self.response.error(f"Max retries {job['max_retries']} reached for file {job['expected_output_file']}", error_code='MaxRetriesReached')
+                else:
+                    self.requeue_job(job)
+
+            # If there is a file where we expect it
+            elif os.path.exists(job['file_handle']['full_path']):
+
+                # If curl failed and the job has a set minimum final age, then check that
+                # (the curl downloader sets the final mtime of the file to that at the origin if completely successful
+                # but if the curl dies half-way, then the mtime does get reset and indicates the current time, a telltale
+                # sign of a failed download. If this is so, continue the download). curl also fails when resuming a
+                # file that is already complete, which is why a failure alone is not enough to retry
+                if 'minimum_final_age' in job and return_code != 0:
+                    mtime = os.path.getmtime(job['expected_output_file'])
+                    now = time.time()
+                    file_age = int(now - mtime)
+
+                    # If the age is greater than the final age, then we're done
+                    if file_age >= job['minimum_final_age']:
                         job['file_handle']['status'] = 'READY'
                         job['file_handle']['is_complete'] = True
                         job['file_handle']['current_size'] = os.path.getsize(job['file_handle']['full_path'])
+                        self.record_host_result(job, success=True)
 
-                # Else if the file isn't there, then requeue it
-                else:
-                    if return_code == 19:
-                        self.response.warning(f"Requested file is not present on remote server. Give up.")
-                        job['file_handle']['status'] = 'UNAVAILABLE'
-                        job['file_handle']['is_complete'] = True
-                        job['file_handle']['current_size'] = 0
+                    # Otherwise, queue a retry with continue
                     else:
-                        self.response.warning(f"File download was supposedly complete, the but file isn't there! Requeue it.")
-                        jobs_to_restart.append(job)
-
-        # Delete any finished jobs from the jobs queue. Must be done here at the end
-        # since it is not permissable to delete inside the above loop
-        for job_id in job_ids_to_delete:
-            del self.jobs[job_id]
-
-        # If there are any jobs to restart, put them back in the queue
-        for new_job in jobs_to_restart:
-            new_job['pid'] = None
-            new_job['handle'] = None
-            new_job['status'] = 'redo'
-            self.add_job(new_job)
+                        job['n_retries'] += 1
+                        self.record_host_result(job, success=False)
+                        if job['n_retries'] > job['max_retries']:
+                            self.response.error(f"Max retries {job['max_retries']} reached for file {job['expected_output_file']}", error_code='MaxRetriesReached')
+                        else:
+                            self.requeue_job(job)
+
+                # If there's no minium required age, then assume the download was fine
+                else:
+                    job['file_handle']['status'] = 'READY'
+                    job['file_handle']['is_complete'] = True
+                    job['file_handle']['current_size'] = os.path.getsize(job['file_handle']['full_path'])
+                    self.record_host_result(job, success=True)
+
+            # Else if the file isn't there, then requeue it
+            else:
+                if return_code == 19:
+                    self.response.warning(f"Requested file is not present on remote server. Give up.")
+                    job['file_handle']['status'] = 'UNAVAILABLE'
+                    job['file_handle']['is_complete'] = True
+                    job['file_handle']['current_size'] = 0
+                    self.record_host_result(job, success=True)
+                else:
+                    self.response.warning(f"File download was supposedly complete, the but file isn't there! Requeue it.")
+                    self.record_host_result(job, success=False)
+                    self.requeue_job(job)
+
+            # Make the new status of the file durable
+            self.dataset_processor.record_file_handle(job['file_handle'])
+
+        # If this was a conversion or compression, check the result
+        elif job['type'] in self.cpu_bound_job_types and 'file_handle' in job:
+
+            # A reattached process is not our child, so its exit status is unknown and only its output can tell
+            if getattr(job.get('handle'), 'reattached', False):
+                succeeded = self.is_output_complete(job)
+            else:
+                succeeded = return_code == 0 and os.path.exists(job['expected_output_file'])
+            if succeeded:
+                job['file_handle']['status'] = 'READY'
+                job['file_handle']['is_complete'] = True
+                job['file_handle']['current_size'] = os.path.getsize(job['expected_output_file'])
+                if 'stats_file' in job:
+                    self.finish_compression(job)
+            else:
+                self.response.warning(f"Job {job_id} of type {job['type']} exited with return code {return_code} " +
+                    f"without completing {job['expected_output_file']}")
+                job['n_retries'] += 1
+                if job['n_retries'] > job['max_retries']:
+                    self.response.error(f"Max retries {job['max_retries']} reached for file {job['expected_output_file']}", error_code='MaxRetriesReached')
+                else:
+                    self.requeue_job(job)
+            self.dataset_processor.record_file_handle(job['file_handle'])
+
+        # Pipeline the next step for this file right away rather than waiting for the rest of its dataset
+        if 'file_handle' in job and job['file_handle']['status'] == 'READY':
+            self.dataset_processor.handle_file_ready(job['file_handle'])
+            if len(self.dataset_processor.tasks_todo) > 0:
+                self.queue_tasks()
+
+
+    ###############################################################################################
+    def is_output_complete(self, job):
+        """Public method that decides from its output file alone whether a conversion or compression finished,
+        for when its exit status cannot be had. The compressor only puts its output in place once it has been
+        verified, so for a compression, fused or not, the existence of the output is enough. The converter writes
+        its mzML in place, so that must also end with its closing tag
+
+        :param job: The job dict of the conversion or compression
+        :type job: dict
+        :return: True if the output is complete
+        :rtype: bool
+        """
+
+        output_file = job['expected_output_file']
+        if not os.path.exists(output_file):
+            return False
+        if job['type'] == 'compress' or 'stats_file' in job:
+            return True
+        try:
+            with open(output_file, 'rb') as infile:
+                infile.seek(max(os.path.getsize(output_file) - 1024, 0))
+                tail = infile.read()
+        except OSError:
+            return False
+        return b'</mzML>' in tail or b'</indexedmzML>' in tail
+
+
+    ###############################################################################################
+    def finish_compression(self, job):
+        """Public method that records the sizes and ratio of a successful compression, as reported by the
+        compressor, in its file handle and removes the uncompressed file if there is one and it is not to be kept.
+        The compressor only puts its output in place after reading it back and checking it against what it
+        compressed, so the existence of the output is proof enough
+
+        :param job: The job dict of the compression, with 'stats_file' and, unless fused with the conversion, 'source_file'
+        :type job: dict
+        """
+
+        file_handle = job['file_handle']
+        try:
+            with open(job['stats_file']) as infile:
+                stats = json.load(infile)
+            os.remove(job['stats_file'])
+        except (OSError, ValueError) as error:
+            self.response.warning(f"Unable to read compression statistics {job['stats_file']} - {error}")
+            stats = {}
+        if stats.get('uncompressed_size') is not None:
+            file_handle['uncompressed_size'] = stats['uncompressed_size']
+            if stats.get('ratio') is not None:
+                file_handle['compression_ratio'] = round(stats['ratio'], 3)
+            self.response.info(f"Compressed {file_handle['filename']} from {self.format_bytes(file_handle['uncompressed_size'])} to " +
+                f"{self.format_bytes(file_handle['current_size'])} (ratio {file_handle.get('compression_ratio')})")
+
+        source_file = job.get('source_file')
+        if source_file is None or not os.path.exists(source_file):
+            return
+        if not self.config['remove_uncompressed_mzML']:
+            return
+        try:
+            os.remove(source_file)
+        except OSError as error:
+            self.response.warning(f"Unable to remove uncompressed file {source_file} - {error}")
+            return
+
+        # Let the MS run know that its mzML now only exists in compressed form
+        dataset = self.dataset_processor.datasets['identifiers'].get(file_handle.get('dataset_id'))
+        if dataset is None:
+            return
+        source_handle = dataset['metadata'].get('ms_runs', {}).get(file_handle['fileroot'], {}).get('mzML_file')
+        if source_handle is not None and source_handle['full_path'] == source_file:
+            source_handle['status'] = 'REMOVED'
+            source_handle['current_size'] = 0
+            self.dataset_processor.record_file_handle(source_handle)
+
+
+    ###############################################################################################
+    def record_host_result(self, job, success):
+        """Public method that feeds the outcome of a job to the per-host circuit breaker and puts the
+        host's jobs on hold when the circuit opens
+
+        :param job: The job dict, with an optional 'host'
+        :type job: dict
+        :param success: True if the host delivered what was asked (or said it does not have it)
+        :type success: bool
+        """
+
+        host = job.get('host')
+        if host is None:
+            return
+        if success:
+            self.circuit_breaker.record_success(host)
+            return
+        hold_until = self.circuit_breaker.record_failure(host, time.time())
+        if hold_until is not None:
+            self.response.warning(f"Too many consecutive failures for host {host}. Holding its jobs for {int(hold_until - time.time())} s")
+            self.scheduler.hold_host(host, hold_until)
+
+
+    ###############################################################################################
+    def requeue_job(self, job):
+        """Public method that puts a finished job back in the queue to be run again. The job does not
+        become ready again until an exponential backoff with jitter, based on its number of retries, has passed
+
+        :param job: The job dict
+        :type job: dict
+        """
+
+        job['pid'] = None
+        job['handle'] = None
+        job['status'] = 'redo'
+        job['kill_deadline'] = None
+        n_retries = max(job.get('n_retries', 0), 1)
+        delay = min(self.config['retry_backoff_base'] * 2 ** (n_retries - 1), self.config['retry_backoff_max'])
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        job['not_before'] = time.time() + delay
+        self.response.info(f"Retry {n_retries} of '{' '.join(job['args'])}' will wait {delay:.1f} s")
+        job.pop('progress', None)
+        job.pop('launch_bytes', None)
+        if job.get('engine') == 'native':
+            self.plan_download_segments(job)
+        self.add_job(job)
 
 
     ###############################################################################################
@@ -565,19 +1828,62 @@ class AutomationAgent:
                 new_job = { 'pid': None, 'type': 'download', 'args': [ "curl", "-R", "-O", "-C", "-", uri ], 'retry_staleness': 30,
                     'n_retries': 0, 'max_retries': 10, 'file_handle': task['file_metadata'],
                     'location': location, 'status': 'qw', 'handle': None, 'expected_output_file': expected_output_file,
-                    'minimum_final_age': 60 * 60 * 24 }
+                    'minimum_final_age': 60 * 60 * 24, 'host': urllib.parse.urlparse(uri).netloc }
+
+                # The native engine reports success directly, so it does not need the mtime trick
+                if self.config['download_engine'] == 'native':
+                    new_job['engine'] = 'native'
+                    new_job['uri'] = uri
+                    new_job['args'] = [ 'native-download', uri ]
+                    del new_job['minimum_final_age']
+                    self.plan_download_segments(new_job)
                 self.add_job(new_job)
 
             # Process command convert_to_mzML
             elif task['command'] == 'convert_to_mzML':
                 location = task['file_metadata']['location']
-                full_path = task['file_metadata']['full_path']
-                expected_output_file = re.sub(r'\.raw$','.mzML',full_path, flags=re.I)
-                new_job = { 'pid': None, 'type': 'download',
-                    'args': [ "C:/Users/ericd/Documents/Software/Thermo/ThermoRawFileParser/ThermoRawFileParser", "-m", "0", "-f", "2", "-i", full_path ],
+                raw_file = task['source_metadata']['full_path']
+                expected_output_file = task['file_metadata']['full_path']
+                new_job = { 'pid': None, 'type': 'convert',
+                    'args': self.get_conversion_executor().build_args(raw_file, expected_output_file),
                     'retry_staleness': 30,
                     'n_retries': 0, 'max_retries': 10, 'file_handle': task['file_metadata'],
-                    'location': location, 'status': 'qw', 'handle': None, 'expected_output_file': expected_output_file }
+                    'location': location, 'status': 'qw', 'handle': None, 'expected_output_file': expected_output_file,
+                    'expected_size': self.estimate_output_size(raw_file, self.config['mzML_size_factor']) }
+                self.add_job(new_job)
+
+            # Process command convert_and_compress, which streams the converter's output through the compressor
+            elif task['command'] == 'convert_and_compress':
+                location = task['file_metadata']['location']
+                raw_file = task['source_metadata']['full_path']
+                expected_output_file = task['file_metadata']['full_path']
+                stats_file = f"{expected_output_file}.stats.json"
+                new_job = { 'pid': None, 'type': 'convert',
+                    'args': self.get_conversion_executor().build_fused_args(raw_file, expected_output_file,
+                        method=self.config['compression_method'], level=self.config['compression_level'],
+                        n_threads=self.config['compression_threads'], stats_file=stats_file),
+                    'retry_staleness': 120,
+                    'n_retries': 0, 'max_retries': 10, 'file_handle': task['file_metadata'],
+                    'location': location, 'status': 'qw', 'handle': None, 'expected_output_file': expected_output_file,
+                    'stats_file': stats_file, 'progress_file': ParallelCompressor.get_temporary_file(expected_output_file),
+                    'expected_size': self.estimate_output_size(raw_file, self.config['compressed_mzML_size_factor']) }
+                self.add_job(new_job)
+
+            # Process command compress_file
+            elif task['command'] == 'compress_file':
+                location = task['file_metadata']['location']
+                source_file = task['source_metadata']['full_path']
+                expected_output_file = task['file_metadata']['full_path']
+                stats_file = f"{expected_output_file}.stats.json"
+                new_job = { 'pid': None, 'type': 'compress',
+                    'args': self.get_conversion_executor().build_compression_args(source_file, expected_output_file,
+                        method=self.config['compression_method'], level=self.config['compression_level'],
+                        n_threads=self.config['compression_threads'], stats_file=stats_file),
+                    'retry_staleness': 120,
+                    'n_retries': 0, 'max_retries': 10, 'file_handle': task['file_metadata'],
+                    'location': location, 'status': 'qw', 'handle': None, 'expected_output_file': expected_output_file,
+                    'source_file': source_file, 'stats_file': stats_file, 'progress_file': ParallelCompressor.get_temporary_file(expected_output_file),
+                    'expected_size': self.estimate_output_size(source_file, self.config['compressed_mzML_size_factor'] / self.config['mzML_size_factor']) }
                 self.add_job(new_job)
 
             # If not handled yet, then this is unrecognized
@@ -589,30 +1895,73 @@ class AutomationAgent:
 
 
     ###############################################################################################
-    def main_task(self):
-        """Public method that runs the main task of agent. Override with the true work
+    def execute_command(self, command):
+        """Public method that interprets one command read from the command file and acts on it
 
+        :param command: A single line from the command file
+        :type command: str
         """
 
-        # First look for new work to put in the queue
-        command = self.read_command()
-        if command is not None:
-            self.response.info(f"Received command '{command}'")
-            got_match = False
-            match = re.match(r'get\s+(.+)$',command)
-            if match:
-                new_job = { 'pid': None, 'type': 'download', 'args': [ "curl", "-R", "-O", match.group(1) ],
-                    'location': self.config['data_path'], 'status': 'qw', 'handle': None }
-                self.add_job(new_job)
-                got_match = True
+        self.response.info(f"Received command '{command}'")
 
-            match = re.match(r'add_dataset\s+(.+)$',command)
-            if got_match is False and match:
-                self.dataset_processor.add_dataset(match.group(1))
-                got_match = True
+        match = re.match(r'get\s+(.+)$',command)
+        if match:
+            new_job = { 'pid': None, 'type': 'download', 'args': [ "curl", "-R", "-O", match.group(1) ],
+                'location': self.config['data_path'], 'status': 'qw', 'handle': None }
+            self.add_job(new_job)
+            return
 
-            else:
-                self.response.warning(f"Unable to interpret received command '{command}'")
+        match = re.match(r'add_dataset\s+(.+)$',command)
+        if match:
+            self.dataset_processor.add_dataset(match.group(1))
+            return
+
+        # Datasets are only reassessed when something happens to them, so changes made by hand need a nudge
+        match = re.match(r'assess_dataset\s+(.+)$',command)
+        if match:
+            dataset_ids = [ match.group(1) ]
+            if match.group(1) == 'all':
+                dataset_ids = list(self.dataset_processor.datasets['identifiers'])
+            for dataset_id in dataset_ids:
+                if dataset_id not in self.dataset_processor.datasets['identifiers']:
+                    self.response.warning(f"Dataset {dataset_id} is not tracked")
+                    continue
+                self.dataset_processor.mark_dirty(dataset_id)
+            return
+
+        if command == 'reload_config':
+            self.reload_config()
+            return
+
+        if command == 'show_timings':
+            print(self.dataset_processor.show(level='full'))
+            return
+
+        self.response.warning(f"Unable to interpret received command '{command}'")
+
+
+    ###############################################################################################
+    def main_task(self):
+        """Public method that runs the main task of agent. Override with the true work
+
+        """
+
+        # Pick up a changed config file first, so that this pass already runs with the new limits.
+        # Without file change notification, the config file is checked for changes on every pass
+        if not self.tasks_state['reload_config'] and ( self.event_monitor is None or not self.event_monitor.is_watching_files() ):
+            if self.get_config_file_signature() != self.state.get('config_file_signature'):
+                self.tasks_state['reload_config'] = True
+        reload_config_time = self.tasks_state['reload_config_time']
+        if reload_config_time is not None and time.time() >= reload_config_time:
+            self.tasks_state['reload_config'] = True
+        if self.tasks_state['reload_config']:
+            self.tasks_state['reload_config'] = False
+            self.tasks_state['reload_config_time'] = None
+            self.reload_config()
+
+        # Then look for new work to put in the queue. Drain everything that has arrived
+        for command in self.read_commands():
+            self.execute_command(command)
 
         # Run the DatasetProcessor for a cycle
         result = self.dataset_processor.process()
@@ -621,6 +1970,10 @@ class AutomationAgent:
             #print(self.response.show(level=Response.DEBUG))
             return self.response
 
+        # If any dataset moved to a new state, it may be able to take its next step without waiting for an event
+        if self.dataset_processor.n_state_changes > 0:
+            self.tasks_state['wake_immediately'] = True
+
         # Show the DatasetProcessor status
         status_buffer = self.dataset_processor.show(level='high')
         if status_buffer != self.tasks_state['previous_show_buffer']:
@@ -631,18 +1984,116 @@ class AutomationAgent:
         if len(self.dataset_processor.tasks_todo) > 0:
             self.queue_tasks()
 
-        # Show jobs
+        # Show jobs when the queue changed or output file ages are about to be rechecked anyway
         if self.job_control['n_jobs'] > 0:
-            self.show_jobs()
+            if self.job_control['generation'] != self.job_control['shown_generation'] or time.time() >= self.job_control['next_staleness_check']:
+                self.show_jobs()
+                self.job_control['shown_generation'] = self.job_control['generation']
 
-        # Then see if there is something to launch
+        # Then see if there is something to launch, within a download limit that may have been retuned
+        self.tune_download_concurrency()
         self.launch_jobs()
 
-        # Check in on running jobs
-        self.poll_jobs()
+        # Check in on running jobs, unless the asyncio job engine tells us when they finish
+        if self.job_engine is None:
+            self.poll_jobs()
+
+        # Make what happened in this pass durable
+        self.update_journal()
+
 
 
 
+##########################################################################################
+class AutomationAgentTests(unittest.TestCase):
+    """Tests of the agent's job bookkeeping that need neither a config file nor running jobs.
+    Run with: python -m unittest automation_agent
+    """
+
+    def setUp(self):
+        self.agent = AutomationAgent()
+        self.agent.response = Response()
+        self.agent.start_directory = '/nonexistent'
+        self.agent.config = { 'data_path': '/data', 'unknown_size_reservation': 1000, 'keep_successful_job_logs': False }
+        self.agent.disk_space_admission = DiskSpaceAdmission(watermark=0.9, recheck_interval=10)
+
+    def test_admit_get_job_over_watermark(self):
+        self.agent.disk_space_admission.update(1000, 50, 0)
+        self.agent.jobs[1] = { 'pid': None, 'type': 'download', 'args': [ "curl", "-R", "-O", "ftp://example.org/data/run1.raw" ],
+            'location': '/data', 'status': 'qw', 'handle': None }
+        self.assertIsNotNone(self.agent.admit_job(1))
+        self.assertTrue(self.agent.jobs[1]['waiting_for_space'])
+        self.assertIn('ftp://example.org/data/run1.raw', self.agent.response.messages[-1]['message'])
+
+    def test_tuner_credited_from_launch_to_completion(self):
+        import tempfile
+        self.agent.download_tuner = ConcurrencyTuner()
+        with tempfile.TemporaryDirectory() as directory:
+            output_file = f"{directory}/run1.raw"
+            with open(output_file, 'wb') as outfile:
+                outfile.write(b'x' * 100)
+            job = { 'type': 'download', 'args': [ 'curl' ], 'expected_output_file': output_file, 'status': 'run', 'handle': None }
+            job['launch_bytes'] = self.agent.measure_job_bytes(job)[0]
+            job['launch_timestamp'] = 1000
+            with open(output_file, 'ab') as outfile:
+                outfile.write(b'x' * 300)
+            progress = self.agent.sample_job_progress(job, 1010)
+            self.assertEqual(self.agent.download_tuner.n_bytes, 300)
+            self.assertEqual(progress['throughput'], 30)
+            with open(output_file, 'ab') as outfile:
+                outfile.write(b'x' * 50)
+            self.agent.jobs[1] = job
+            self.agent.job_control['n_jobs'] = 1
+            self.agent.job_control['n_running_jobs_by_type']['download'] = 1
+            self.agent.complete_job(1, job, 0)
+            self.assertEqual(self.agent.download_tuner.n_bytes, 350)
+
+    def test_launch_failure_is_not_fatal(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            self.agent.start_directory = directory
+            self.agent.configure()
+            self.agent.config['data_path'] = directory
+            self.agent.dataset_processor.datasets['identifiers']['PXD000001'] = { 'status': 'READY',
+                'state': { 'processing_state': 'Downloading' }, 'metadata': {} }
+            file_handle = { 'dataset_id': 'PXD000001', 'status': 'QUEUED' }
+            self.agent.add_job({ 'pid': None, 'type': 'download', 'args': [ f"{directory}/no-such-command" ], 'location': directory,
+                'status': 'qw', 'handle': None, 'n_retries': 0, 'max_retries': 1, 'file_handle': file_handle })
+            self.agent.add_job({ 'pid': None, 'type': 'download', 'args': [ 'true' ], 'location': directory, 'status': 'qw', 'handle': None })
+            self.agent.launch_jobs()
+            self.assertEqual(self.agent.response.status, 'OK')
+            self.assertEqual(self.agent.jobs[2]['status'], 'run')
+            self.agent.jobs[2]['handle'].wait()
+            self.assertEqual(self.agent.jobs[3]['status'], 'redo')
+            self.assertEqual(self.agent.jobs[3]['n_retries'], 1)
+
+            # Once its retries are used up, only its file and dataset are given up on
+            self.agent.jobs[3]['not_before'] = 0
+            self.agent.scheduler.remove(3)
+            self.agent.scheduler.enqueue(3, self.agent.jobs[3])
+            self.agent.launch_jobs()
+            self.assertEqual(self.agent.response.status, 'OK')
+            self.assertNotIn(3, self.agent.jobs)
+            self.assertEqual(file_handle['status'], 'FAILED')
+            self.assertEqual(self.agent.dataset_processor.datasets['identifiers']['PXD000001']['state']['processing_state'], 'JobFailed')
+
+    def test_output_complete_without_exit_status(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            mzML_file = f"{directory}/run1.mzML"
+            job = { 'type': 'convert', 'expected_output_file': mzML_file }
+            self.assertFalse(self.agent.is_output_complete(job))
+            with open(mzML_file, 'w') as outfile:
+                outfile.write('<?xml version="1.0"?>\n<indexedmzML>\n<mzML>\n<run>\n')
+            self.assertFalse(self.agent.is_output_complete(job))
+            with open(mzML_file, 'a') as outfile:
+                outfile.write('</run>\n</mzML>\n</indexedmzML>\n')
+            self.assertTrue(self.agent.is_output_complete(job))
+            job = { 'type': 'convert', 'expected_output_file': f"{mzML_file}.gz", 'stats_file': f"{mzML_file}.gz.stats.json" }
+            self.assertFalse(self.agent.is_output_complete(job))
+            open(job['expected_output_file'], 'wb').close()
+            self.assertTrue(self.agent.is_output_complete(job))
+
 
 ##########################################################################################
 def main():
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+import sys
+def eprint(*args, **kwargs): print(*args, file=sys.stderr, **kwargs)
+
+import os
+import time
+import zlib
+import json
+import signal
+import struct
+import subprocess
+import collections
+import concurrent.futures
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from response import Response
+
+
+class ParallelCompressor:
+
+    # Class variables
+    extensions = { 'gzip': 'gz', 'zstd': 'zst' }
+    default_levels = { 'gzip': 6, 'zstd': 3 }
+    block_size = 1024 * 1024
+    window_size = 32 * 1024
+
+
+    ###############################################################################################
+    # Constructor
+    def __init__(self, method='gzip', level=None, n_threads=0):
+        """Create a compressor that spreads the work for one large file over several threads. For gzip, the
+        input is cut into blocks that are deflated independently in a thread pool (zlib releases the GIL while
+        it works), each block primed with the last 32 kB of the one before it so that the ratio stays close to
+        that of a single stream, and the pieces are joined into one ordinary gzip member, as pigz does. For zstd,
+        the zstandard module's own worker threads are used. Output is written to a temporary file, read back
+        and checked against the input before it is renamed into place
+
+        :param method: 'gzip' or 'zstd'
+        :type method: str
+        :param level: Compression level, or None for the method's default
+        :type level: int
+        :param n_threads: Number of threads to compress with. If 0, one per available core
+        :type n_threads: int
+        """
+        self.status = 'OK'
+        self.response = Response()
+        self.method = method
+        self.level = level
+        if self.level is None:
+            self.level = self.default_levels.get(method)
+        self.n_threads = n_threads
+        if self.n_threads is None or self.n_threads <= 0:
+            self.n_threads = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+        self.stats = {}
+        self.process = None
+
+
+    ###############################################################################################
+    @staticmethod
+    def is_available(method):
+        """Return True if the given compression method can be used in this environment
+        """
+        if method == 'gzip':
+            return True
+        if method == 'zstd':
+            return zstandard is not None
+        return False
+
+
+    ###############################################################################################
+    def compress_file(self, source_file, destination_file):
+        """Public method that compresses a file. The destination only appears once the compressed data has been
+        written, synced and verified to decompress to exactly the source, so its existence can be trusted
+
+        :param source_file: Full path of the file to compress
+        :type source_file: str
+        :param destination_file: Full path of the compressed file to create
+        :type destination_file: str
+        :return: The response, with the sizes, ratio and timing in self.stats
+        :rtype: Response
+        """
+
+        try:
+            infile = open(source_file,'rb')
+        except OSError as error:
+            self.response.error(f"Unable to open {source_file} - {error}", error_code='CompressionFailed')
+            return self.response
+        with infile:
+            stat = os.fstat(infile.fileno())
+            return self.compress_stream(infile, destination_file, int(stat.st_mtime), stat.st_size, source_file)
+
+
+    ###############################################################################################
+    def compress_command(self, args, destination_file):
+        """Public method that runs a command and compresses what it writes to its standard output as it comes,
+        so that its uncompressed output never touches the disk. The destination only appears if the command
+        succeeded and the compressed data was verified against what it wrote
+
+        :param args: The command line to run, e.g. a converter writing mzML to its standard output
+        :type args: list
+        :param destination_file: Full path of the compressed file to create
+        :type destination_file: str
+        :return: The response, with the sizes, ratio and timing in self.stats
+        :rtype: Response
+        """
+
+        try:
+            self.process = subprocess.Popen(args, stdout=subprocess.PIPE)
+        except OSError as error:
+            self.response.error(f"Unable to start {args[0]} - {error}", error_code='CannotStartCommand')
+            return self.response
+        try:
+            with self.process.stdout:
+                self.compress_stream(self.process.stdout, destination_file, int(time.time()), -1, f"output of {args[0]}", self.process.wait)
+        finally:
+            # If the compression gave up early, the command would block forever on a full pipe
+            if self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+        return self.response
+
+
+    ###############################################################################################
+    def compress_stream(self, infile, destination_file, mtime, size, source_name, wait_for_source=None):
+        """Internal method that compresses everything read from infile into a temporary file, checks it and
+        renames it to destination_file
+
+        :param infile: Binary stream to read the uncompressed data from
+        :type infile: file
+        :param destination_file: Full path of the compressed file to create
+        :type destination_file: str
+        :param mtime: Modification time to put in the gzip header
+        :type mtime: int
+        :param size: Number of bytes that will be read, or -1 if not known
+        :type size: int
+        :param source_name: Description of where the data comes from, for messages
+        :type source_name: str
+        :param wait_for_source: A function returning the exit status of the producer of the stream, which must be 0
+        :type wait_for_source: function
+        """
+
+        response = self.response
+        if not self.is_available(self.method):
+            response.error(f"Compression method '{self.method}' is not available", error_code='CompressionMethodNotAvailable')
+            return response
+
+        t0 = time.time()
+        temporary_file = self.get_temporary_file(destination_file)
+        try:
+            with open(temporary_file,'wb') as outfile:
+                if self.method == 'gzip':
+                    checksum, uncompressed_size = self.compress_gzip(infile, outfile, mtime)
+                else:
+                    checksum, uncompressed_size = self.compress_zstd(infile, outfile, size)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+        except OSError as error:
+            response.error(f"Unable to compress {source_name} into {temporary_file} - {error}", error_code='CompressionFailed')
+            self.remove_file(temporary_file)
+            return response
+        t1 = time.time()
+
+        # A stream that ended because its producer failed is well-formed but incomplete
+        if wait_for_source is not None:
+            return_code = wait_for_source()
+            if return_code != 0:
+                response.error(f"Unable to use the {source_name}, which ended with return code {return_code}", error_code='SourceCommandFailed')
+                self.remove_file(temporary_file)
+                return response
+
+        # Read the result back before letting it take the place of anything
+        if not self.verify_file(temporary_file, checksum, uncompressed_size):
+            response.error(f"Compressed file {temporary_file} does not decompress to the content of {source_name}", error_code='CompressionVerificationFailed')
+            self.remove_file(temporary_file)
+            return response
+        os.replace(temporary_file, destination_file)
+
+        compressed_size = os.path.getsize(destination_file)
+        self.stats = { 'uncompressed_size': uncompressed_size, 'compressed_size': compressed_size,
+            'ratio': uncompressed_size / compressed_size if compressed_size > 0 else None,
+            'compression_time': t1 - t0, 'verification_time': time.time() - t1 }
+        response.info(f"Compressed {source_name} from {uncompressed_size} to {compressed_size} bytes " +
+            f"(ratio {self.stats['ratio'] or 0:.2f}) with {self.method} level {self.level} on {self.n_threads} threads " +
+            f"in {self.stats['compression_time']:.1f} s, verified in {self.stats['verification_time']:.1f} s")
+        return response
+
+
+    ###############################################################################################
+    def compress_gzip(self, infile, outfile, mtime):
+        """Internal method that writes the gzip member for the content of infile to outfile, deflating the
+        blocks in parallel and writing them in order as they finish
+
+        :return: A tuple of the CRC-32 and the size of the uncompressed data
+        :rtype: tuple
+        """
+
+        # Header: magic, deflate, no flags, mtime, no extra flags, Unix
+        outfile.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', mtime & 0xffffffff) + b'\x00\x03')
+
+        checksum = 0
+        uncompressed_size = 0
+        dictionary = None
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+            while True:
+                block = infile.read(self.block_size)
+                if not block:
+                    break
+                checksum = zlib.crc32(block, checksum)
+                uncompressed_size += len(block)
+                pending.append(pool.submit(self.deflate_block, block, dictionary))
+                dictionary = block[-self.window_size:]
+
+                # Keep a bounded number of blocks in memory
+                while len(pending) >= 2 * self.n_threads:
+                    outfile.write(pending.popleft().result())
+            while len(pending) > 0:
+                outfile.write(pending.popleft().result())
+
+        # Every block ends on a sync flush, so the stream is closed with an empty final block, then the trailer
+        outfile.write(zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS).flush(zlib.Z_FINISH))
+        outfile.write(struct.pack('<II', checksum & 0xffffffff, uncompressed_size & 0xffffffff))
+        return checksum, uncompressed_size
+
+
+    ###############################################################################################
+    def deflate_block(self, block, dictionary):
+        """Internal method that deflates one block as a raw deflate fragment ending on a byte boundary, so that
+        fragments can be concatenated into one stream
+
+        :param block: The uncompressed block
+        :type block: bytes
+        :param dictionary: The end of the previous block, or None for the first block
+        :type dictionary: bytes
+        """
+        if dictionary:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+    ###############################################################################################
+    def compress_zstd(self, infile, outfile, size):
+        """Internal method that writes a zstd frame for the content of infile to outfile using the
+        zstandard module's worker threads
+
+        :return: A tuple of the CRC-32 and the size of the uncompressed data
+        :rtype: tuple
+        """
+        checksum = 0
+        uncompressed_size = 0
+        compressor = zstandard.ZstdCompressor(level=self.level, threads=self.n_threads, write_checksum=True).compressobj(size=size)
+        while True:
+            block = infile.read(self.block_size)
+            if not block:
+                break
+            checksum = zlib.crc32(block, checksum)
+            uncompressed_size += len(block)
+            outfile.write(compressor.compress(block))
+        outfile.write(compressor.flush())
+        return checksum, uncompressed_size
+
+
+    ###############################################################################################
+    def verify_file(self, compressed_file, checksum, uncompressed_size):
+        """Public method that decompresses a file and checks that it yields data with the given CRC-32 and size
+
+        :return: True if the content matches
+        :rtype: bool
+        """
+        if self.method == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            decompressor = zstandard.ZstdDecompressor().decompressobj()
+        found_checksum = 0
+        found_size = 0
+        try:
+            with open(compressed_file,'rb') as infile:
+                while True:
+                    block = infile.read(self.block_size)
+                    if not block:
+                        break
+                    data = decompressor.decompress(block)
+                    found_checksum = zlib.crc32(data, found_checksum)
+                    found_size += len(data)
+        except (OSError, zlib.error) as error:
+            self.response.warning(f"Unable to decompress {compressed_file} - {error}")
+            return False
+        except Exception as error:
+            if zstandard is not None and isinstance(error, zstandard.ZstdError):
+                self.response.warning(f"Unable to decompress {compressed_file} - {error}")
+                return False
+            raise
+        if self.method == 'gzip' and ( not decompressor.eof or len(decompressor.unused_data) > 0 ):
+            self.response.warning(f"Compressed file {compressed_file} is truncated or has trailing data")
+            return False
+        return found_checksum == checksum and found_size == uncompressed_size
+
+
+    ###############################################################################################
+    @staticmethod
+    def get_temporary_file(destination_file):
+        """Public method that returns the name under which a compressed file is written until it has been verified
+        """
+        return f"{destination_file}.tmp"
+
+
+    ###############################################################################################
+    def remove_file(self, filename):
+        """Internal method that removes a file if it is there
+        """
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+
+##########################################################################################
+def main():
+
+    # Parse command line options
+    import argparse
+    argparser = argparse.ArgumentParser(description='Compress a file, or the standard output of a command, with several threads and verify the result before putting it in place')
+    argparser.add_argument('--method', type=str, default='gzip', choices=list(ParallelCompressor.extensions), help='Compression method (default gzip)' )
+    argparser.add_argument('--level', type=int, default=None, help='Compression level (default 6 for gzip, 3 for zstd)' )
+    argparser.add_argument('--threads', type=int, default=0, help='Number of threads to use (default one per available core)' )
+    argparser.add_argument('--priority', type=int, default=None, help='Scheduling priority (niceness) to run at, inherited by the command' )
+    argparser.add_argument('--cpu_affinity', type=str, default=None, help='Comma-separated list of CPUs to run on, inherited by the command' )
+    argparser.add_argument('--stats_file', type=str, default=None, help='If set, write the sizes, ratio and timing as JSON to this file on success' )
+    argparser.add_argument('source_file', type=str, help="File to compress, or - for the standard output of the --command")
+    argparser.add_argument('destination_file', type=str, nargs='?', help='Compressed file to write (default source_file plus the extension of the method)')
+    argparser.add_argument('--command', nargs=argparse.REMAINDER, help='Command whose standard output is compressed. Must come last' )
+    params = argparser.parse_args()
+
+    # Set the limits before the command is started so that it inherits them
+    if params.priority is not None:
+        os.setpriority(os.PRIO_PROCESS, 0, params.priority)
+    if params.cpu_affinity is not None:
+        os.sched_setaffinity(0, { int(cpu) for cpu in params.cpu_affinity.split(',') })
+
+    compressor = ParallelCompressor(method=params.method, level=params.level, n_threads=params.threads)
+    destination_file = params.destination_file
+    if params.source_file == '-':
+        if not params.command or destination_file is None:
+            argparser.error('Compressing standard output requires a destination_file and a --command')
+
+        # When the job is stopped, stop the command too rather than leave it writing into a closed pipe
+        def stop(signal_number, frame):
+            if compressor.process is not None and compressor.process.poll() is None:
+                compressor.process.terminate()
+            compressor.remove_file(compressor.get_temporary_file(destination_file))
+            sys.exit(128 + signal_number)
+        signal.signal(signal.SIGTERM, stop)
+
+        response = compressor.compress_command(params.command, destination_file)
+    else:
+        if destination_file is None:
+            destination_file = f"{params.source_file}.{ParallelCompressor.extensions[params.method]}"
+        response = compressor.compress_file(params.source_file, destination_file)
+
+    for message in response.messages_list(level=Response.INFO):
+        print(message)
+    if response.status != 'OK':
+        sys.exit(1)
+    if params.stats_file is not None:
+        with open(params.stats_file,'w') as outfile:
+            json.dump(compressor.stats, outfile)
+
+
+if __name__ == "__main__": main()
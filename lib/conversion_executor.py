@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+import sys
+def eprint(*args, **kwargs): print(*args, file=sys.stderr, **kwargs)
+
+import os
+
+from response import Response
+
+
+class ConversionExecutor:
+
+    ###############################################################################################
+    # Constructor
+    def __init__(self, converter_path, max_running_jobs=0, memory_per_job=2*1024*1024*1024, niceness=10, cpu_affinity=None):
+        """Create the executor for CPU-bound conversion jobs. It has its own limit on the number of jobs that
+        run at once, separate from the limits on I/O-bound jobs such as downloads, and runs its processes
+        at a lower priority and optionally on a subset of the cores so that they do not starve the agent
+        and its transfers
+
+        :param converter_path: Path of the ThermoRawFileParser executable
+        :type converter_path: str
+        :param max_running_jobs: Maximum number of conversions at once. If 0, derived from the available cores and memory
+        :type max_running_jobs: int
+        :param memory_per_job: Number of bytes of memory a conversion is expected to need
+        :type memory_per_job: int
+        :param niceness: Increment of the niceness of conversion processes (0 to leave it alone)
+        :type niceness: int
+        :param cpu_affinity: List of CPU numbers to which conversion processes are restricted, or None for all
+        :type cpu_affinity: list
+        """
+        self.status = 'OK'
+        self.response = Response()
+        self.converter_path = converter_path
+        self.memory_per_job = memory_per_job
+        self.niceness = niceness
+        self.cpu_affinity = None
+        if cpu_affinity is not None and len(cpu_affinity) > 0:
+            self.cpu_affinity = set(cpu_affinity)
+        self.max_running_jobs = max_running_jobs
+        if self.max_running_jobs is None or self.max_running_jobs <= 0:
+            self.max_running_jobs = self.get_default_max_running_jobs()
+
+
+    ###############################################################################################
+    def get_n_cores(self):
+        """Public method that returns the number of cores that conversion processes may use
+        """
+        if self.cpu_affinity is not None:
+            return len(self.cpu_affinity)
+        if hasattr(os, 'sched_getaffinity'):
+            return len(os.sched_getaffinity(0))
+        return os.cpu_count() or 1
+
+
+    ###############################################################################################
+    def get_available_memory(self):
+        """Public method that returns the number of bytes of memory available for new processes, or None if unknown
+        """
+        try:
+            with open('/proc/meminfo') as infile:
+                for line in infile:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError, IndexError):
+            pass
+        try:
+            return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+        except (AttributeError, ValueError, OSError):
+            return None
+
+
+    ###############################################################################################
+    def get_default_max_running_jobs(self):
+        """Public method that derives the number of concurrent conversions from the cores and memory available
+        """
+        n_jobs = self.get_n_cores()
+        available_memory = self.get_available_memory()
+        if available_memory is not None and self.memory_per_job > 0:
+            n_jobs = min(n_jobs, available_memory // self.memory_per_job)
+        n_jobs = max(int(n_jobs), 1)
+        self.response.info(f"Allowing {n_jobs} concurrent conversions for {self.get_n_cores()} cores and " +
+            f"{'unknown' if available_memory is None else int(available_memory / 1024**3)} GB of available memory")
+        return n_jobs
+
+
+    ###############################################################################################
+    def build_args(self, raw_file, output_file=None):
+        """Public method that returns the command line that converts a raw file to mzML
+
+        :param raw_file: Full path of the .raw file
+        :type raw_file: str
+        :param output_file: Full path of the .mzML file to write, or None to write the mzML to standard output
+        :type output_file: str
+        :return: The argument list for the conversion process
+        :rtype: list
+        """
+        if output_file is None:
+            return [ self.converter_path, "-m", "0", "-f", "2", "-i", raw_file, "--stdout" ]
+        return [ self.converter_path, "-m", "0", "-f", "2", "-i", raw_file, "-b", output_file ]
+
+
+    ###############################################################################################
+    def build_compression_args(self, source_file, output_file, method='gzip', level=None, n_threads=0, stats_file=None):
+        """Public method that returns the command line that compresses a file with the ParallelCompressor
+
+        :param source_file: Full path of the file to compress, or a raw file to convert and compress in one stream
+        :type source_file: str
+        :param output_file: Full path of the compressed file to write
+        :type output_file: str
+        :param method: 'gzip' or 'zstd'
+        :type method: str
+        :param level: Compression level, or None for the method's default
+        :type level: int
+        :param n_threads: Number of compression threads, or 0 for one per core the process may use
+        :type n_threads: int
+        :param stats_file: File to which the compressor writes its sizes and ratio, if any
+        :type stats_file: str
+        :return: The argument list for the compression process
+        :rtype: list
+        """
+        args = [ sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'compressor.py'), '--method', method ]
+        if level is not None:
+            args += [ '--level', str(level) ]
+        # The affinity is only applied once the process is running, so it cannot count the cores itself
+        if ( n_threads is None or n_threads <= 0 ) and self.cpu_affinity is not None:
+            n_threads = len(self.cpu_affinity)
+        if n_threads is not None and n_threads > 0:
+            args += [ '--threads', str(n_threads) ]
+        if stats_file is not None:
+            args += [ '--stats_file', stats_file ]
+        return args + [ source_file, output_file ]
+
+
+    ###############################################################################################
+    def build_fused_args(self, raw_file, output_file, method='gzip', level=None, n_threads=0, stats_file=None):
+        """Public method that returns the command line that converts a raw file and compresses the mzML as the
+        converter writes it, so that the uncompressed mzML is never written to disk. The converter is started
+        by the compressor, so the limits are passed along to be set before it starts rather than applied afterwards
+
+        :return: The argument list for the combined process
+        :rtype: list
+        """
+        args = self.build_compression_args('-', output_file, method=method, level=level, n_threads=n_threads, stats_file=stats_file)
+        limits = []
+        if self.niceness and hasattr(os, 'getpriority'):
+            limits += [ '--priority', str(self.get_process_priority()) ]
+        if self.cpu_affinity is not None:
+            limits += [ '--cpu_affinity', ','.join(str(cpu) for cpu in sorted(self.cpu_affinity)) ]
+        return args[:2] + limits + args[2:] + [ '--command' ] + self.build_args(raw_file)
+
+
+    ###############################################################################################
+    def get_process_priority(self):
+        """Public method that returns the niceness at which conversion processes are run
+        """
+        return min(os.getpriority(os.PRIO_PROCESS, 0) + self.niceness, 19)
+
+
+    ###############################################################################################
+    def apply_process_limits(self, pid):
+        """Public method that lowers the priority of a just-launched conversion process and pins it to the
+        configured cores. This is done from the agent's side rather than in a preexec_fn, which is not
+        safe while the downloader's threads are running
+
+        :param pid: Process id of the conversion
+        :type pid: int
+        """
+        try:
+            if self.niceness and hasattr(os, 'setpriority'):
+                os.setpriority(os.PRIO_PROCESS, pid, self.get_process_priority())
+            if self.cpu_affinity is not None and hasattr(os, 'sched_setaffinity'):
+                os.sched_setaffinity(pid, self.cpu_affinity)
+        except (ProcessLookupError, PermissionError, OSError) as error:
+            self.response.warning(f"Unable to set the priority or affinity of conversion process {pid} - {error}")
+
+
+##########################################################################################
+def main():
+
+    # Parse command line options
+    import argparse
+    argparser = argparse.ArgumentParser(description='Show the limits that the ConversionExecutor derives for this machine')
+    argparser.add_argument('--memory_per_job', type=float, default=2, help='Number of GB of memory a conversion needs (default 2)' )
+    params = argparser.parse_args()
+
+    executor = ConversionExecutor('ThermoRawFileParser', memory_per_job=int(params.memory_per_job * 1024**3))
+    print(f"cores: {executor.get_n_cores()}, available memory: {executor.get_available_memory()}, max_running_jobs: {executor.max_running_jobs}")
+
+
+if __name__ == "__main__": main()
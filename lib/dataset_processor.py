@@ -8,15 +8,92 @@ import json
 import re
 import time
 import json
-import requests
-from ftplib import FTP
+import calendar
+import urllib.parse
+from ftplib import error_perm
 
 from response import Response
+from px_record_fetcher import PxRecordFetcher
+from downloader import FtpConnectionPool
+
+
+class TimingHistogram:
+
+    # Class variables. Upper bounds of the buckets in seconds. Longer times go in a last, open-ended bucket
+    bucket_bounds = [ 0.01, 0.1, 1, 10, 60, 600, 3600, 6 * 3600, 24 * 3600 ]
+
+
+    ###############################################################################################
+    # Constructor
+    def __init__(self):
+        """Create a histogram of durations in logarithmically growing buckets, with their count, total and maximum
+        """
+        self.bucket_counts = [ 0 ] * ( len(self.bucket_bounds) + 1 )
+        self.n_values = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+
+    ###############################################################################################
+    def record(self, seconds):
+        """Public method that adds a duration to the histogram
+        """
+        index = 0
+        while index < len(self.bucket_bounds) and seconds > self.bucket_bounds[index]:
+            index += 1
+        self.bucket_counts[index] += 1
+        self.n_values += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+
+    ###############################################################################################
+    def show(self):
+        """Public method that returns a one-line rendering of the histogram, listing only the buckets in use
+        """
+        if self.n_values == 0:
+            return "n=0"
+        buffer = f"n={self.n_values}, mean={self.format_seconds(self.total / self.n_values)}, max={self.format_seconds(self.maximum)}:"
+        for index,count in enumerate(self.bucket_counts):
+            if count == 0:
+                continue
+            if index < len(self.bucket_bounds):
+                buffer += f" <={self.format_seconds(self.bucket_bounds[index])}:{count}"
+            else:
+                buffer += f" >{self.format_seconds(self.bucket_bounds[-1])}:{count}"
+        return buffer
+
+
+    ###############################################################################################
+    @staticmethod
+    def format_seconds(seconds):
+        """Render a duration in the largest unit it reaches
+        """
+        if seconds < 1:
+            return f"{seconds * 1000:.0f}ms"
+        for unit,size in [ ( 'd', 86400 ), ( 'h', 3600 ), ( 'm', 60 ) ]:
+            if seconds >= size:
+                return f"{seconds / size:.1f}{unit}"
+        return f"{seconds:.1f}s"
 
 
 class DatasetProcessor:
 
     # Class variables
+    racy_mtime_window = 2
+
+    # Handler that takes a dataset on from each processing state. Conversion and compression are queued file by file
+    # as each input becomes ready, so the later states just summarize how far its files have come. 'Wait' is final
+    state_handlers = {
+        'Queued': 'assess_setup',
+        'Set up': 'assess_setup',
+        'Ready to download': 'assess_download',
+        'Downloading': 'assess_download',
+        'Ready to convert': 'assess_conversion',
+        'Converting': 'update_conversion_state',
+        'Ready to compress': 'assess_conversion',
+        'Compressing': 'update_conversion_state',
+    }
 
 
     ###############################################################################################
@@ -28,8 +105,24 @@ class DatasetProcessor:
         self.tasks_todo = []
         self.base_dir = "/proteomics/peptideatlas2/archive/Arabidopsis"
         self.state = { 'processing_state': 'Unknown', 'todo': 'assess' }
+        self.n_state_changes = 0
         self.datasets = { 'identifiers': {} }
-        self.compressed_extension = 'zip'
+        self.dirty_dataset_ids = set()
+        self.directory_snapshots = {}
+        self.transition_timings = {}
+        self.px_fetcher = None
+        self.px_cache_path = 'px_cache'
+        self.px_fetch_threads = 4
+        self.px_fetch_timeout = 60
+        self.px_cache_max_age = 24 * 60 * 60
+        self.wake_callback = None
+        self.ftp_pool = None
+        self.ftp_listing_cache = {}
+        self.ftp_listing_ttl = 600
+        self.n_passes = 0
+        self.compressed_extension = 'gz'
+        self.fused_conversion = True
+        self.journal = None
 
         response = Response()
         self.response = response
@@ -45,16 +138,135 @@ class DatasetProcessor:
         response = self.response
         response.info(f"Add dataset_id {dataset_id} to the list of tracked datasets")
 
-        dataset = { 'status': 'QUEUED', 'state': { 'processing_state': 'Queued', 'message': 'Ready to begin setup' },
+        dataset = { 'status': 'QUEUED', 'state': { 'processing_state': 'Queued', 'message': 'Ready to begin setup', 'entered_timestamp': time.time() },
             'dataset_id': dataset_id, 'metadata': { 'location': f"{self.base_dir}/{dataset_id}" } }
         self.datasets['identifiers'][dataset_id] = dataset
+        self.mark_dirty(dataset_id)
+        if self.journal is not None:
+            self.journal.record_dataset(dataset)
 
         return response
 
 
+    ###############################################################################################
+    def restore_datasets(self, datasets):
+        """Replace the tracked datasets with ones restored from the journal. The PX records are not
+        part of the journal and are read back from disk when next needed
+        """
+
+        self.datasets['identifiers'] = datasets
+        self.dirty_dataset_ids = set(datasets)
+        self.response.info(f"Restored {len(datasets)} tracked datasets")
+        return self.response
+
+
+    ###############################################################################################
+    def create_file_handle(self, dataset_id, role, fileroot, filename, status='TODO', uri=None, filetype=None, expected_size=None, remote_mtime=None):
+        """Create a file handle for one of the files of a dataset, attach it to the dataset metadata,
+        and record it in the journal
+
+        :param dataset_id: Identifier of the dataset the file belongs to
+        :type dataset_id: str
+        :param role: 'manifest', or the key under ms_runs[fileroot], e.g. 'raw_file', 'mzML_file', 'mzML_gz_file'
+        :type role: str
+        :param fileroot: Root name of the file that identifies the MS run
+        :type fileroot: str
+        :param filename: Name of the file in the dataset's data directory
+        :type filename: str
+        :param status: Initial status, e.g. 'TODO' or 'READY'
+        :type status: str
+        :param uri: Remote location of the file if it is to be downloaded
+        :type uri: str
+        :param filetype: Type of the file, e.g. 'raw' or 'mzML'
+        :type filetype: str
+        :param expected_size: Number of bytes the file is expected to have when complete, if known
+        :type expected_size: int
+        :param remote_mtime: Modification time of the remote file in seconds since the epoch, if known
+        :type remote_mtime: float
+        :return: The new file handle
+        :rtype: dict
+        """
+
+        dataset = self.datasets['identifiers'][dataset_id]
+        location = f"{dataset['metadata']['location']}/data"
+        file_handle = { 'status': status, 'fileroot': fileroot,
+            'filename': filename, 'full_path': f"{location}/{filename}",
+            'location': location,
+            'expected_size': expected_size, 'current_size': None,
+            'local_age': None, 'is_complete': status == 'READY', 'filetype': filetype,
+            'dataset_id': dataset_id, 'role': role }
+        if uri is not None:
+            file_handle['uri'] = uri
+        if remote_mtime is not None:
+            file_handle['remote_mtime'] = remote_mtime
+
+        if role == 'manifest':
+            dataset['metadata']['manifest']['file'] = file_handle
+        else:
+            if fileroot not in dataset['metadata']['ms_runs']:
+                dataset['metadata']['ms_runs'][fileroot] = {}
+            dataset['metadata']['ms_runs'][fileroot][role] = file_handle
+
+        self.record_file_handle(file_handle)
+        return file_handle
+
+
+    ###############################################################################################
+    def record_file_handle(self, file_handle):
+        """Record the current content of a file handle in the journal, if there is one. A file that changed
+        may let its dataset take its next step, so the dataset is marked for processing
+        """
+        self.mark_dirty(file_handle.get('dataset_id'))
+        if self.journal is not None:
+            self.journal.record_file_handle(file_handle)
+
+
+    ###############################################################################################
+    def mark_file_failed(self, file_handle, message):
+        """Give up on a file whose job could not be run, and stop its dataset in the JobFailed state, which has
+        no handler, so that the rest of the datasets carry on without it
+        """
+        file_handle['status'] = 'FAILED'
+        self.record_file_handle(file_handle)
+        dataset = self.datasets['identifiers'].get(file_handle.get('dataset_id'))
+        if dataset is None:
+            return
+        self.record_transition(dataset, dataset['state']['processing_state'], 'JobFailed')
+        dataset['status'] = 'ERROR'
+        dataset['state']['processing_state'] = 'JobFailed'
+        dataset['state']['message'] = message
+        if self.journal is not None:
+            self.journal.record_dataset(dataset)
+
+
+    ###############################################################################################
+    def mark_dirty(self, dataset_id):
+        """Mark a dataset as having changed, so that it is processed in the next call to process()
+        """
+        if dataset_id in self.datasets['identifiers']:
+            self.dirty_dataset_ids.add(dataset_id)
+
+
+    ###############################################################################################
+    def get_px_data(self, dataset_id):
+        """Return the ProteomeXchange record of a dataset, reading it from the dataset's data directory
+        if it is not in memory (e.g. after the datasets were restored from the journal)
+        """
+
+        dataset = self.datasets['identifiers'][dataset_id]
+        if 'px_data' not in dataset['metadata']:
+            target_path = f"{dataset['metadata']['location']}/data/ProteomeXchange.json"
+            with open(target_path,'r') as infile:
+                dataset['metadata']['px_data'] = json.load(infile)
+        return dataset['metadata']['px_data']
+
+
     ###############################################################################################
     def process(self):
-        """Top level method to loop over all datasets in the system to process
+        """Top level method to loop over the datasets that need processing. Only datasets marked dirty are
+        processed: those just added or restored and those with a file that changed (e.g. when a job completes).
+        Each is taken through as many states as it can go, so all others are waiting on something and would
+        only be rescanned for nothing
 
         """
 
@@ -62,15 +274,108 @@ class DatasetProcessor:
         response = self.response
         #response.info(f"Begin processing all datasets")
 
-        for dataset_id in self.datasets['identifiers']:
+        # Keep count of how many datasets changed state so the caller knows whether to come right back
+        self.n_state_changes = 0
+        self.n_passes += 1
+        if self.px_fetcher is not None:
+            for dataset_id in self.px_fetcher.collect_completed():
+                self.mark_dirty(dataset_id)
+        dirty_dataset_ids = [ dataset_id for dataset_id in self.datasets['identifiers'] if dataset_id in self.dirty_dataset_ids ]
+        for dataset_id in dirty_dataset_ids:
+            dataset = self.datasets['identifiers'][dataset_id]
+            previous_state = dataset['state']['processing_state']
+            previous_summary = self.get_dataset_summary(dataset)
             self.process_dataset(dataset_id)
 
+            # The dataset has gone as far as it can, so it needs no other look until something happens to it
+            self.dirty_dataset_ids.discard(dataset_id)
+            if dataset['state']['processing_state'] != previous_state:
+                self.n_state_changes += 1
+            if self.journal is not None and self.get_dataset_summary(dataset) != previous_summary:
+                self.journal.record_dataset(dataset)
+
         return response
 
 
+    ###############################################################################################
+    def get_directory_snapshot(self, directory):
+        """Return what is in a directory as a dict of file name to (size, mtime), read with a single os.scandir.
+        The listing is kept and reused as long as the modification time of the directory is unchanged, which is
+        checked at most once per pass of process(). A pass then costs one stat per directory rather than one
+        per file. The directory's mtime only changes when files are added, removed or renamed, so callers that
+        change files in place, such as jobs writing their output, must call invalidate_directory_snapshot()
+
+        :param directory: Path of the directory
+        :type directory: str
+        :return: Dict of file name to (size in bytes, mtime), empty if the directory cannot be read
+        :rtype: dict
+        """
+
+        snapshot = self.directory_snapshots.get(directory)
+        if snapshot is not None and snapshot['n_pass'] == self.n_passes:
+            return snapshot['files']
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            self.directory_snapshots.pop(directory, None)
+            return {}
+        if snapshot is not None and snapshot['mtime_ns'] == mtime_ns and snapshot['is_stable']:
+            snapshot['n_pass'] = self.n_passes
+            return snapshot['files']
+
+        files = {}
+        scan_time = time.time()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    files[entry.name] = ( stat.st_size, stat.st_mtime )
+        except OSError as error:
+            self.response.warning(f"Unable to list directory {directory} - {error}")
+            self.directory_snapshots.pop(directory, None)
+            return {}
+
+        # A change within the granularity of the mtime right after the scan would go unnoticed,
+        # so a directory that changed very recently is scanned again on the next pass
+        is_stable = scan_time - mtime_ns / 1e9 > self.racy_mtime_window
+        self.directory_snapshots[directory] = { 'mtime_ns': mtime_ns, 'is_stable': is_stable, 'n_pass': self.n_passes, 'files': files }
+        return files
+
+
+    ###############################################################################################
+    def invalidate_directory_snapshot(self, directory):
+        """Forget the listing of a directory, so that it is read again the next time it is needed
+        """
+        self.directory_snapshots.pop(directory, None)
+
+
+    ###############################################################################################
+    def file_exists(self, path):
+        """Return True if a file exists according to the snapshot of its directory
+        """
+        return os.path.basename(path) in self.get_directory_snapshot(os.path.dirname(path))
+
+
+    ###############################################################################################
+    def get_dataset_summary(self, dataset):
+        """Return a small tuple of the top-level state of a dataset, used to detect changes worth journaling
+        """
+        manifest_status = None
+        if 'manifest' in dataset['metadata']:
+            manifest_status = dataset['metadata']['manifest']['status']
+        return ( dataset['status'], dataset['state']['processing_state'], dataset['metadata'].get('ftp_location'), manifest_status )
+
+
     ###############################################################################################
     def process_dataset(self, dataset_id):
-        """Finish the current step or take the next step in processing one dataset
+        """Advance one dataset through its processing states. The handler of the current state is looked up in
+        state_handlers and run, and as long as it moves the dataset to a new state, the handler of that state is
+        run right away. The dataset stops at the first state whose handler leaves it where it was, because it is
+        waiting on work outside the processor, such as its jobs. The time spent in each state is recorded
+        in transition_timings
         """
 
         #### Set the self state and begin examining what we have
@@ -90,53 +395,25 @@ class DatasetProcessor:
             if dataset['status'] == 'ERROR':
                 return response
 
-            # Consult the processing_state to figure out where to go
-            if dataset['state']['processing_state'] == 'Queued':
-                self.assess_setup(dataset_id)
-
-            elif dataset['state']['processing_state'] == 'Set up':
-                self.assess_setup(dataset_id)
-
-            elif dataset['state']['processing_state'] == 'Ready to download':
-                self.assess_download(dataset_id)
-                #if dataset['state']['processing_state'] == 'Ready to download':
-                #    self.download_dataset(dataset_id)
-
-            elif dataset['state']['processing_state'] == 'Downloading':
-                self.assess_download(dataset_id)
-
-            elif dataset['state']['processing_state'] == 'Ready to convert':
-                dataset['state']['processing_state'] = 'Wait'
-                #self.assess_conversion(dataset_id)
-                #if dataset['state']['processing_state'] == 'Ready to convert':
-                #       self.convert_dataset(dataset_id)
-
-            elif dataset['state']['processing_state'] == 'Converting':
-                self.assess_conversion(dataset_id)
-
-            elif dataset['state']['processing_state'] == 'Ready to compress':
-                self.assess_conversion(dataset_id)
-                if dataset['state']['processing_state'] == 'Ready to compress':
-                    self.compress_dataset(dataset_id)
-
-            elif dataset['state']['processing_state'] == 'Compressing':
-                self.assess_conversion(dataset_id)
-
-            elif dataset['state']['processing_state'] == 'Wait':
-                #response.info(f"Done with what we are able to do so far")
+            # Done with what we are able to do so far
+            state = dataset['state']['processing_state']
+            if state == 'Wait':
                 dataset['status'] = 'READY'
                 return response
 
-            else:
-                strange_state = dataset['state']['processing_state']
+            # Consult the processing_state to figure out where to go
+            handler_name = self.state_handlers.get(state)
+            if handler_name is None:
                 dataset['status'] = 'ERROR'
-                #dataset['state']['processing_state'] = 'UnrecognizedState'
-                #response.error(f"Unrecognized processing state {strange_state}", error_code=dataset['state']['processing_state'])
-                #response.warning(f"Unrecognized processing state {strange_state}")
+                #response.error(f"Unrecognized processing state {state}", error_code=state)
                 return response
+            getattr(self, handler_name)(dataset_id)
 
-            # Don't need a loop here after all??
-            break
+            # If the dataset did not move on, it is waiting for something
+            new_state = dataset['state']['processing_state']
+            if new_state == state:
+                return response
+            self.record_transition(dataset, state, new_state)
 
             #### Provide a mechanism to escape an infinite loop
             loop_counter += 1
@@ -145,6 +422,22 @@ class DatasetProcessor:
                 return response
 
 
+    ###############################################################################################
+    def record_transition(self, dataset, state, new_state):
+        """Record in the histogram of the transition how long the dataset spent in the state it is leaving. The time
+        it entered a state is kept in its state dict, so that it survives in the journal
+        """
+        now = time.time()
+        entered_timestamp = dataset['state'].get('entered_timestamp')
+        dataset['state']['entered_timestamp'] = now
+        if entered_timestamp is None:
+            return
+        transition = f"{state} -> {new_state}"
+        if transition not in self.transition_timings:
+            self.transition_timings[transition] = TimingHistogram()
+        self.transition_timings[transition].record(now - entered_timestamp)
+
+
     ###############################################################################################
     def assess_setup(self, dataset_id):
         """Assess the current state of the setup of the dataset
@@ -215,11 +508,10 @@ class DatasetProcessor:
         # See if the ProteomeXchange record exists
         response.info(f"Check for ProteomeXchange metadata file")
         target_path = f"{dataset['metadata']['location']}/data/ProteomeXchange.json"
-        if not os.path.exists(target_path):
+        if not self.file_exists(target_path):
             if mode == 'assess':
-                self.fetch_px_record(dataset_id)
-                if dataset['status'] == 'ERROR':
-                    return
+                if not self.fetch_px_record(dataset_id):
+                    return response
             if mode == 'verify':
                 dataset['status'] = 'ERROR'
                 dataset['state']['processing_state'] = 'PXRecordMissing'
@@ -318,30 +610,66 @@ class DatasetProcessor:
 
     ###############################################################################################
     def fetch_px_record(self, dataset_id):
-        """Fetch the PX record and store it in the specified location
+        """Fetch the PX record and store it in the specified location. The record is fetched in the background,
+        so the first call usually only starts the fetch, and the dataset is processed again when it has finished
+
+        :return: True if the record is now in place, False if it is still being fetched or could not be fetched
+        :rtype: bool
         """
 
         #### Create the URL for ProteomeCentral
         response = self.response
-        response.info(f"Fetching dataset record from ProteomeXchange")
 
         # Get the dataset handle and set status
         dataset = self.datasets['identifiers'][dataset_id]
 
-        url = f"http://proteomecentral.proteomexchange.org/cgi/GetDataset?ID={dataset_id}&outputMode=json"
-        response_content = requests.get(url, headers={'accept': 'application/json'})
+        result = self.get_px_fetcher().get_record(dataset_id)
+        if result['status'] == 'PENDING':
+            response.info(f"Fetching dataset record from ProteomeXchange")
+            return False
 
         #### Examine response
-        status_code = response_content.status_code
-        if status_code != 200:
+        if result['status'] != 'OK':
             dataset['status'] = 'ERROR'
             dataset['state']['processing_state'] = 'CannotFetchPXRecord'
-            print(response_content)
-            response.error(f"Unable to fetch ProteomeCentral record for dataset '{dataset_id}', status_code={status_code}. Not a publicly released dataset?", error_code=dataset['state']['processing_state'])
-            return response
+            response.error(result['message'], error_code=dataset['state']['processing_state'])
+            return False
 
         with open(f"{dataset['metadata']['location']}/data/ProteomeXchange.json", "w", encoding="utf-8") as outfile:
-            outfile.write(str(response_content.text))
+            outfile.write(result['text'])
+        self.invalidate_directory_snapshot(f"{dataset['metadata']['location']}/data")
+        return True
+
+
+    ###############################################################################################
+    def get_px_fetcher(self):
+        """Return the PxRecordFetcher, creating it on first use
+        """
+        if self.px_fetcher is None:
+            self.px_fetcher = PxRecordFetcher(self.px_cache_path, max_workers=self.px_fetch_threads, timeout=self.px_fetch_timeout,
+                max_age=self.px_cache_max_age)
+            self.px_fetcher.on_complete = self.handle_px_record_fetched
+        return self.px_fetcher
+
+
+    ###############################################################################################
+    def handle_px_record_fetched(self, dataset_id):
+        """Callback, run in a fetcher thread, that wakes up the main loop so that the dataset is processed again
+        """
+        if self.wake_callback is not None:
+            self.wake_callback()
+
+
+    ###############################################################################################
+    def close(self):
+        """Stop the fetches of PX records that have not started and close the pooled FTP sessions
+        """
+        if self.px_fetcher is not None:
+            self.px_fetcher.close()
+            self.px_fetcher = None
+        if self.ftp_pool is not None:
+            self.ftp_pool.close()
+            self.ftp_pool = None
 
 
     ###############################################################################################
@@ -357,7 +685,7 @@ class DatasetProcessor:
 
         # Get the dataset handle and set status
         dataset = self.datasets['identifiers'][dataset_id]
-        px_data = dataset['metadata']['px_data']
+        px_data = self.get_px_data(dataset_id)
 
         # Set the mode to either assess (as a check on work that may have been done previously)
         # or verify (to verify that work that was just done has completed)
@@ -395,25 +723,17 @@ class DatasetProcessor:
 
             # If the file is already there, then record it
             destination_filepath = f"{dataset['metadata']['location']}/data/README.txt"
-            if os.path.exists(destination_filepath):
+            if self.file_exists(destination_filepath):
                 response.info(f"PRIDE manifest (README.txt) file is READY")
                 dataset['metadata']['manifest']['status'] = 'READY'
-                dataset['metadata']['manifest']['file'] = { 'status': 'READY', 'fileroot': 'README',
-                    'filename': 'README.txt', 'full_path': f"{dataset['metadata']['location']}/data/README.txt",
-                    'location': f"{dataset['metadata']['location']}/data",
-                    'expected_size': None, 'current_size': None, 'uri': f"{ftp_dir}/README.txt",
-                    'local_age': None, 'is_complete': True, 'filetype': 'txt' }
+                self.create_file_handle(dataset_id, 'manifest', 'README', 'README.txt', status='READY', uri=f"{ftp_dir}/README.txt", filetype='txt')
 
             # If the file is not there
             else:
 
                 # If the status is UNKNOWN, then this is the first we'vbe considered it and need to download it
                 if dataset['metadata']['manifest']['status'] == 'UNKNOWN':
-                    dataset['metadata']['manifest']['file'] = { 'status': 'TODO', 'fileroot': 'README',
-                        'filename': 'README.txt', 'full_path': f"{dataset['metadata']['location']}/data/README.txt",
-                        'location': f"{dataset['metadata']['location']}/data",
-                        'expected_size': None, 'current_size': None, 'uri': f"{ftp_dir}/README.txt",
-                        'local_age': None, 'is_complete': False, 'filetype': 'txt' }
+                    self.create_file_handle(dataset_id, 'manifest', 'README', 'README.txt', status='TODO', uri=f"{ftp_dir}/README.txt", filetype='txt')
                     self.tasks_todo.append( { 'command': 'download_file', 'file_metadata': dataset['metadata']['manifest']['file'] } )
                     dataset['metadata']['manifest']['status'] = 'DOWNLOADING'
 
@@ -440,8 +760,13 @@ class DatasetProcessor:
             dataset['metadata']['ms_runs'] = {}
 
 
+        #### Runs that are already tracked are accounted for once their raw file has been fetched or found to be unavailable
+        for fileroot,ms_run in dataset['metadata']['ms_runs'].items():
+            if 'raw_file' not in ms_run or ms_run['raw_file']['status'] in [ 'READY', 'UNAVAILABLE' ]:
+                previous_msruns.pop(fileroot, None)
+
         #### If there's no information on the runs yet, then create it
-        if len(previous_msruns) == 0 and len(missing_msruns) == 0:
+        if len(dataset['metadata']['ms_runs']) == 0:
 
             #### If there is available information in the PX record datasetFiles
             if 'datasetFiles' in px_data:
@@ -460,6 +785,17 @@ class DatasetProcessor:
                             response.error(f"Unable to get the file file name in uri {uri}", error_code=dataset['state']['processing_state'])
                             return response
 
+                #### The PX record does not give the sizes of the files, so take those in the FTP location from its listing
+                if len(ms_runs) > 0 and ftp_dir != '????':
+                    remote_files = self.list_remote_directory(ftp_dir)
+                    if remote_files is None:
+                        response.warning(f"Unable to get the sizes of the MS run files from {ftp_dir}")
+                        remote_files = {}
+                    for ms_run in ms_runs:
+                        if ms_run['uri'] == f"{ftp_dir}/{ms_run['filename']}" and ms_run['filename'] in remote_files:
+                            ms_run['size'] = remote_files[ms_run['filename']]['size']
+                            ms_run['mtime'] = remote_files[ms_run['filename']]['mtime']
+
             #### If the files are not listed in the PX record, try getting a listing at the source via FTP
             else:
                 response.warning(f"Unable to find the datasetFiles in the PX record. Trying to get an FTP listing at the source.")
@@ -481,36 +817,24 @@ class DatasetProcessor:
                     if fileroot in dataset['metadata']['ms_runs']:
                         if dataset['metadata']['ms_runs'][fileroot]['raw_file']['status'] == 'READY':
                             response.info(f"MS Run {fileroot} is READY")
-                            del previous_msruns[fileroot]
+                            previous_msruns.pop(fileroot, None)
                         else:
                             #response.info(f"MS Run {fileroot} is still downloading")
                             pass
                     else:
                         destination_filepath = f"{dataset['metadata']['location']}/data/{filename}"
-                        file_info = { 'status': 'TODO',
-                            'fileroot': fileroot,
-                            'filename': filename,
-                            'full_path': f"{dataset['metadata']['location']}/data/{filename}",
-                            'location': f"{dataset['metadata']['location']}/data",
-                            'expected_size': None,
-                            'current_size': None,
-                            'uri': uri,
-                            'local_age': None,
-                            'is_complete': False,
-                            'filetype': match.group(2) }
-
-                        if os.path.exists(destination_filepath):
+                        status = 'TODO'
+
+                        if self.file_exists(destination_filepath):
                             response.info(f"Found MS Run raw file {filename} untracked but already present")
-                            file_info['status'] = 'READY'
-                            file_info['is_complete'] = True
+                            status = 'READY'
 
                         if verify_by_curl_continue:
                             response.info(f"But verify_by_curl_continue is set, so perform a curl continue anyway")
-                            file_info['status'] = 'TODO'
-                            file_info['is_complete'] = False
+                            status = 'TODO'
 
-                        dataset['metadata']['ms_runs'][fileroot] = {}
-                        dataset['metadata']['ms_runs'][fileroot]['raw_file'] = file_info
+                        file_info = self.create_file_handle(dataset_id, 'raw_file', fileroot, filename, status=status, uri=uri, filetype=match.group(2),
+                            expected_size=ms_run.get('size'), remote_mtime=ms_run.get('mtime'))
 
                         if file_info['status'] == 'TODO':
                             self.tasks_todo.append( { 'command': 'download_file', 'file_metadata': dataset['metadata']['ms_runs'][fileroot]['raw_file'] } )
@@ -556,7 +880,7 @@ class DatasetProcessor:
         # Get the dataset handle and set status
         dataset = self.datasets['identifiers'][dataset_id]
         dataset['status'] = 'PROCESSING'
-        px_data = dataset['metadata']['px_data']
+        px_data = self.get_px_data(dataset_id)
 
         # If we don't already have the manifest, queue a fetch for that
         #if 'manifest' not in dataset['metadata']:
@@ -607,12 +931,7 @@ class DatasetProcessor:
                                 del previous_msruns[fileroot]
                             else:
                                 response.info(f"Queueing MS Run raw file {filename} for download")
-                                dataset['metadata']['ms_runs'][fileroot] = {}
-                                dataset['metadata']['ms_runs'][fileroot]['raw_file'] = { 'status': 'TODO', 'fileroot': fileroot,
-                                    'filename': filename, 'full_path': f"{dataset['metadata']['location']}/data/{filename}",
-                                    'location': f"{dataset['metadata']['location']}/data",
-                                    'expected_size': None, 'current_size': None, 'uri': uri,
-                                    'local_age': None, 'is_complete': False, 'filetype': match.group(2) }
+                                self.create_file_handle(dataset_id, 'raw_file', fileroot, filename, status='TODO', uri=uri, filetype=match.group(2))
                                 self.tasks_todo.append( { 'command': 'download_file', 'file_metadata': dataset['metadata']['ms_runs'][fileroot]['raw_file'] } )
                                 if have_previous_msruns:
                                     response.warning(f"Previous catalog of MS run did not have {fileroot}")
@@ -636,7 +955,7 @@ class DatasetProcessor:
         # Get the dataset handle and set status
         dataset = self.datasets['identifiers'][dataset_id]
         dataset['status'] = 'PROCESSING'
-        px_data = dataset['metadata']['px_data']
+        px_data = self.get_px_data(dataset_id)
         ms_runs = []
 
         # Get the FTP location
@@ -654,187 +973,300 @@ class DatasetProcessor:
         # Try to decompose the FTP location
         response.info(f"Remote FTP location is {ftp_url}")
         match = re.match(r'ftp://(.+?)/(.+)$',ftp_url)
-        if match:
-            ftp_host = match.group(1)
-            ftp_dir = match.group(2)
-
-        else:
+        if not match:
             dataset['status'] = 'ERROR'
             dataset['state']['processing_state'] = 'CannotReadRemoteFTPDir'
             response.error(f"Unable to read the remote FTP directory {ftp_url}", error_code=dataset['state']['processing_state'])
             return
 
-        try:
-            response.info(f"Connecting to {ftp_host}")
-            ftp_session = FTP(ftp_host)
-            response.info(f"Login as anonymous")
-            ftp_session.login()
-            response.info(f"Set CWD to {ftp_dir}")
-            ftp_session.cwd(ftp_dir)
-            response.info(f"Executing nlst")
-            files = ftp_session.nlst()
-        except:
+        files = self.list_remote_directory(ftp_url)
+        if files is None:
             dataset['status'] = 'ERROR'
             dataset['state']['processing_state'] = 'FailedFTPDirListing'
             response.error(f"Unable to get the dir listing at {ftp_url}", error_code=dataset['state']['processing_state'])
             return
 
         #### Loop over all the files to guess the MS Runs
-        for filename in files:
+        for filename,file_info in files.items():
             if filename.endswith('.raw') or filename.endswith('.RAW'):
-                ms_runs.append( { 'filename': filename, 'uri': f"{ftp_url}/{filename}" } )
+                ms_runs.append( { 'filename': filename, 'uri': f"{ftp_url}/{filename}", 'size': file_info['size'], 'mtime': file_info['mtime'] } )
 
         return ms_runs
 
 
     ###############################################################################################
-    def assess_conversion(self, dataset_id):
-        """Assess if the RAW files have been converted to mzML
-
+    def list_remote_directory(self, ftp_url):
+        """Public method that lists the files in a remote FTP directory with their sizes and modification times.
+        Sessions come from a pool of logged-in connections per host, so consecutive listings from the same server
+        do not each connect and log in, and a session that fails is closed rather than leaked. Listings are kept
+        for ftp_listing_ttl seconds, so the datasets that share a directory or are set up again soon list it once
+
+        :param ftp_url: ftp:// URL of the directory
+        :type ftp_url: str
+        :return: A dict of file name to a dict with 'size' in bytes and 'mtime' in seconds since the epoch (either
+            None if the server would not say), or None if the directory could not be listed
+        :rtype: dict
         """
 
         response = self.response
-        dataset = self.datasets['identifiers'][dataset_id]
-        response.info(f"Check if mzML files for {dataset_id} have already been created")
+        cached_listing = self.ftp_listing_cache.get(ftp_url)
+        if cached_listing is not None:
+            if time.time() - cached_listing['timestamp'] < self.ftp_listing_ttl:
+                response.debug(f"Using the listing of {ftp_url} from {int(time.time() - cached_listing['timestamp'])} s ago")
+                return cached_listing['files']
+            del self.ftp_listing_cache[ftp_url]
+
+        location = urllib.parse.urlparse(ftp_url)
+        if location.scheme != 'ftp' or location.hostname is None:
+            response.warning(f"Unable to decompose FTP location {ftp_url}")
+            return None
+        ftp_dir = location.path or '/'
+        if self.ftp_pool is None:
+            self.ftp_pool = FtpConnectionPool()
+
+        ftp_session = None
+        try:
+            response.info(f"Listing {ftp_dir} at {location.netloc}")
+            ftp_session = self.ftp_pool.acquire(location.netloc)
+            ftp_session.cwd(ftp_dir)
+            files = self.list_ftp_session_directory(ftp_session)
+        except Exception as error:
+            if ftp_session is not None:
+                self.ftp_pool.discard(ftp_session)
+            response.warning(f"Unable to get the dir listing at {ftp_url} - {error}")
+            return None
+        self.ftp_pool.release(location.netloc, ftp_session)
+
+        # Listings of datasets that are not listed again would otherwise be kept for as long as the agent runs
+        now = time.time()
+        for expired_url in [ url for url,listing in self.ftp_listing_cache.items() if now - listing['timestamp'] >= self.ftp_listing_ttl ]:
+            del self.ftp_listing_cache[expired_url]
+        self.ftp_listing_cache[ftp_url] = { 'timestamp': now, 'files': files }
+        return files
 
-        # Set the mode to either assess (as a check on work that may have been done previously)
-        # or verify (to verify that work that was just done has completed)
-        mode = 'assess'
-        if dataset['state']['processing_state'] == 'Ready to compress':
-            mode = 'verify'
-        if dataset['state']['processing_state'] == 'Ready to assess':
-            mode = 'verify'
 
-        # Loop over the MS runs and make a dict of things we might need to do
-        ms_runs_to_convert = {}
-        ms_runs_to_compress = {}
-        for fileroot in dataset['metadata']['ms_runs']:
-            ms_runs_to_convert['fileroot'] = 1
-            ms_runs_to_compress['fileroot'] = 1
-
-        # Loop over the MS runs and queue a conversion job
-        for fileroot in dataset['metadata']['ms_runs']:
-            have_mzML_record = False
-            have_mzML_gz_record = False
-            if 'mzML_file' in dataset['metadata']['ms_runs'][fileroot]:
-                have_mzML_record = True
-            if 'mzML_gz_file' in dataset['metadata']['ms_runs'][fileroot]:
-                have_mzML_gz_record = True
-
-            have_mzML_file = False
-            have_mzML_gz_file = False
-            if os.path.exists(f"{dataset['metadata']['location']}/data/{filename}.mzML"):
-                have_mzML_file = True
-            if os.path.exists(f"{dataset['metadata']['location']}/data/{filename}.mzML.{self.compressed_extension}"):
-                have_mzML_gz_file = True
-
-            if not have_mzML_record and have_mzML_file:
-                filename = f"{fileroot}.mzML"
-                destination_filepath = f"{dataset['metadata']['location']}/data/{filename}"
-                response.info(f"Found MS Run raw file {filename}.mzML untracked but already present")
-                dataset['metadata']['ms_runs'][fileroot]['mzML_file'] = { 'status': 'READY', 'fileroot': fileroot,
-                    'filename': filename, 'full_path': f"{dataset['metadata']['location']}/data/{filename}",
-                    'location': f"{dataset['metadata']['location']}/data",
-                    'expected_size': None, 'current_size': None,
-                    'local_age': None, 'is_complete': True, 'filetype': 'mzML' }
-                have_mzML_record = True
-
-            if not have_mzML_gz_record and have_mzML_gz_file:
-                filename = f"{fileroot}.mzML.{self.compressed_extension}"
-                destination_filepath = f"{dataset['metadata']['location']}/data/{filename}"
-                response.info(f"Found MS Run raw file {filename}.mzML.{self.compressed_extension} untracked but already present")
-                dataset['metadata']['ms_runs'][fileroot]['mzML_gz_file'] = { 'status': 'READY', 'fileroot': fileroot,
-                    'filename': filename, 'full_path': f"{dataset['metadata']['location']}/data/{filename}",
-                    'location': f"{dataset['metadata']['location']}/data",
-                    'expected_size': None, 'current_size': None,
-                    'local_age': None, 'is_complete': True, 'filetype': 'mzML' }
-                have_mzML_gz_record = True
-
-            if have_mzML_gz_record:
-                if dataset['metadata']['ms_runs'][fileroot]['mzML_gz_file']['status'] == 'READY':
-                    del ms_runs_to_convert['fileroot']
-                    del ms_runs_to_compress['fileroot']
-                else:
-                    pass
-            elif have_mzML_record:
-                if dataset['metadata']['ms_runs'][fileroot]['mzML_file']['status'] == 'READY':
-                    del ms_runs_to_compress['fileroot']
-                else:
-                    pass
-            else:
-                pass
+    ###############################################################################################
+    def list_ftp_session_directory(self, ftp_session):
+        """Public method that lists the current directory of an FTP session. MLSD gives exact sizes and times in one
+        request. Servers without it are asked for a LIST, which is parsed if it is in the common Unix format.
+        Failing that, the names come from NLST and the size of each file from SIZE, which costs one request per file
 
+        :return: A dict of file name to a dict with 'size' and 'mtime'
+        :rtype: dict
+        """
 
-        if dataset['state']['processing_state'] == 'Ready to convert':
-            if mode == 'assess':
-                if len(ms_runs_to_convert) == 0:
-                    dataset['state']['processing_state'] == 'Ready to compress'
-                    return
-                else:
-                    # stay ready to convert and the conversion will start
-                    return
-            else:
-                response.warning(f"I should not be here in Ready to convert and not assess")
+        files = {}
+        try:
+            for filename,facts in ftp_session.mlsd(facts=[ 'type', 'size', 'modify' ]):
+                if facts.get('type', 'file') == 'file':
+                    files[filename] = { 'size': int(facts['size']) if 'size' in facts else None, 'mtime': self.parse_mlsd_time(facts.get('modify')) }
+            return files
+        except error_perm:
+            pass
+
+        lines = []
+        try:
+            ftp_session.retrlines('LIST', lines.append)
+        except error_perm:
+            lines = []
+        for line in lines:
+            match = re.match(r'([\-dlcbps])\S*\s+\d+\s+\S+\s+\S+\s+(\d+)\s+(\w{3}\s+\d{1,2}\s+(?:\d{1,2}:\d{2}|\d{4}))\s+(.+)$', line)
+            if match and match.group(1) == '-':
+                files[match.group(4)] = { 'size': int(match.group(2)), 'mtime': self.parse_list_time(match.group(3)) }
+        if len(files) > 0:
+            return files
+
+        ftp_session.voidcmd('TYPE I')
+        for filename in ftp_session.nlst():
+            try:
+                files[filename] = { 'size': ftp_session.size(filename), 'mtime': None }
+            except error_perm:
+                files[filename] = { 'size': None, 'mtime': None }
+        return files
+
+
+    ###############################################################################################
+    @staticmethod
+    def parse_mlsd_time(value):
+        """Convert an MLSD modify fact (YYYYMMDDHHMMSS[.sss], UTC) to seconds since the epoch, or None
+        """
+        if value is None:
+            return None
+        try:
+            return calendar.timegm(time.strptime(value[:14], '%Y%m%d%H%M%S'))
+        except ValueError:
+            return None
+
+
+    ###############################################################################################
+    @staticmethod
+    def parse_list_time(value):
+        """Convert the date of a Unix-style LIST line ("Mon DD HH:MM" for the past half year, else "Mon DD YYYY")
+        to seconds since the epoch, or None. Servers give it in their own time zone, which is taken to be UTC
+        """
+        fields = value.split()
+        try:
+            if ':' in fields[2]:
+                now = time.gmtime()
+                mtime = calendar.timegm(time.strptime(f"{fields[0]} {fields[1]} {now.tm_year} {fields[2]}", '%b %d %Y %H:%M'))
+                # Without a year, the date is within the last half year, so a date ahead of now was last year
+                if mtime > time.time() + 24 * 60 * 60:
+                    mtime = calendar.timegm(time.strptime(f"{fields[0]} {fields[1]} {now.tm_year - 1} {fields[2]}", '%b %d %Y %H:%M'))
+                return mtime
+            return calendar.timegm(time.strptime(value, '%b %d %Y'))
+        except (ValueError, IndexError):
+            return None
+
+
+    ###############################################################################################
+    @staticmethod
+    def is_convertible(file_handle):
+        """Return True if a raw file handle is of a type the converter takes
+        """
+        return file_handle.get('filetype') is not None and file_handle['filetype'].lower() == 'raw'
+
+
+    ###############################################################################################
+    def handle_file_ready(self, file_handle):
+        """Queue the next step for a single MS run as soon as one of its files is READY, without waiting
+        for the rest of the dataset: a raw file is converted to mzML, and an mzML file is compressed.
+        Nothing is queued if the result is already tracked, so this may be called more than once
+
+        :param file_handle: The file handle that just became READY
+        :type file_handle: dict
+        """
+
+        if file_handle.get('status') != 'READY' or file_handle.get('role') not in [ 'raw_file', 'mzML_file' ]:
+            return
+        dataset = self.datasets['identifiers'].get(file_handle['dataset_id'])
+        if dataset is None:
+            return
+        ms_run = dataset['metadata']['ms_runs'].get(file_handle['fileroot'])
+        if ms_run is None:
+            return
+
+        if file_handle['role'] == 'raw_file':
+            if 'mzML_file' in ms_run or 'mzML_gz_file' in ms_run:
                 return
-        elif dataset['state']['processing_state'] == 'Converting':
-            if mode == 'assess':
-                if len(ms_runs_to_convert) == 0:
-                    dataset['state']['processing_state'] == 'Ready to compress'
-                    return
-                else:
-                    response.warning(f"Still waiting for conversion to complete")
-                    return
-            else:
-                response.warning(f"I should not be here in Ready to convert and not assess")
+            if not self.is_convertible(file_handle):
                 return
-        elif dataset['state']['processing_state'] == 'Ready to compress':
-            if mode == 'assess':
-                if len(ms_runs_to_convert) == 0:
-                    dataset['state']['processing_state'] == 'Ready to compress'
-                    return
-                else:
-                    response.warning(f"Still waiting for conversion to complete")
-                    return
-            else:
-                response.warning(f"I should not be here in Ready to convert and not assess")
+            self.queue_conversion(file_handle['dataset_id'], file_handle['fileroot'])
+
+        elif file_handle['role'] == 'mzML_file':
+            if 'mzML_gz_file' in ms_run:
                 return
+            self.queue_compression(file_handle['dataset_id'], file_handle['fileroot'])
 
 
-                # Continue here with assess conversion! FIXME
+    ###############################################################################################
+    def queue_conversion(self, dataset_id, fileroot):
+        """Queue the conversion of the raw file of one MS run to mzML. With fused_conversion, the converter's
+        output is compressed as it is produced, so the MS run only ever gets a compressed mzML file
+        """
+
+        dataset = self.datasets['identifiers'][dataset_id]
+        ms_run = dataset['metadata']['ms_runs'][fileroot]
+        if self.fused_conversion:
+            self.response.info(f"Queuing conversion to compressed mzML for MS run {fileroot}")
+            file_handle = self.create_file_handle(dataset_id, 'mzML_gz_file', fileroot, f"{fileroot}.mzML.{self.compressed_extension}", status='TODO', filetype='mzML')
+            self.tasks_todo.append( { 'command': 'convert_and_compress', 'file_metadata': file_handle, 'source_metadata': ms_run['raw_file'] } )
+            return
+
+        self.response.info(f"Queuing conversion to mzML for MS run {fileroot}")
+        file_handle = self.create_file_handle(dataset_id, 'mzML_file', fileroot, f"{fileroot}.mzML", status='TODO', filetype='mzML')
+        self.tasks_todo.append( { 'command': 'convert_to_mzML', 'file_metadata': file_handle, 'source_metadata': ms_run['raw_file'] } )
 
 
     ###############################################################################################
-    def assess_mzML(self, dataset_id):
-        """Check if there is an mzML file and if not queue a conversion
+    def queue_compression(self, dataset_id, fileroot):
+        """Queue the compression of the mzML file of one MS run
+        """
+
+        self.response.info(f"Queuing compression of mzML for MS run {fileroot}")
+        dataset = self.datasets['identifiers'][dataset_id]
+        ms_run = dataset['metadata']['ms_runs'][fileroot]
+        file_handle = self.create_file_handle(dataset_id, 'mzML_gz_file', fileroot, f"{fileroot}.mzML.{self.compressed_extension}", status='TODO', filetype='mzML')
+        self.tasks_todo.append( { 'command': 'compress_file', 'file_metadata': file_handle, 'source_metadata': ms_run['mzML_file'] } )
+
+
+    ###############################################################################################
+    def assess_conversion(self, dataset_id):
+        """Assess which MS runs have been converted to mzML and compressed. Results already on disk but not
+        tracked are adopted, any step that an MS run is ready for but that has not been queued is queued
+        (e.g. for raw files that were present before the agent started), and the dataset state is updated
 
         """
 
         response = self.response
-        response.info(f"Convert to mzML")
-
-        # Get the dataset handle and set status
         dataset = self.datasets['identifiers'][dataset_id]
-        dataset['status'] = 'PROCESSING'
+        response.info(f"Check if mzML files for {dataset_id} have already been created")
+        location = f"{dataset['metadata']['location']}/data"
 
-        # Loop over the MS runs and queue a conversion job
-        for fileroot in dataset['metadata']['ms_runs']:
-            have_mzML = False
-            have_mzML_gz = False
-            if 'mzML_file' in dataset['metadata']['ms_runs'][fileroot]: have_mzML = True
-            if 'mzML_gz_file' in dataset['metadata']['ms_runs'][fileroot]: have_mzML_gz = True
+        for fileroot,ms_run in dataset['metadata']['ms_runs'].items():
 
-            # If we don't have either uncompressed or compressed, queue up the conversion
-            if not have_mzML and not have_mzML_gz:
-                response.info(f"Queuing conversion to mzML for MS run {fileroot}")
+            # Adopt results that are already there
+            if 'mzML_gz_file' not in ms_run:
+                filename = f"{fileroot}.mzML.{self.compressed_extension}"
+                if self.file_exists(f"{location}/{filename}"):
+                    response.info(f"Found compressed mzML file {filename} untracked but already present")
+                    self.create_file_handle(dataset_id, 'mzML_gz_file', fileroot, filename, status='READY', filetype='mzML')
+            if 'mzML_file' not in ms_run and 'mzML_gz_file' not in ms_run:
                 filename = f"{fileroot}.mzML"
-                dataset['metadata']['ms_runs'][fileroot]['mzML_file'] = { 'status': 'TODO', 'fileroot': fileroot,
-                    'filename': filename, 'full_path': f"{dataset['metadata']['location']}/data/{filename}",
-                    'location': f"{dataset['metadata']['location']}/data",
-                    'expected_size': None, 'current_size': None,
-                    'local_age': None, 'is_complete': False, 'filetype': 'mzML' }
-                self.tasks_todo.append( { 'command': 'convert_to_mzML', 'file_metadata': dataset['metadata']['ms_runs'][fileroot]['mzML_file'] } )
+                if self.file_exists(f"{location}/{filename}"):
+                    response.info(f"Found mzML file {filename} untracked but already present")
+                    self.create_file_handle(dataset_id, 'mzML_file', fileroot, filename, status='READY', filetype='mzML')
+
+            # Queue whatever this run is ready for
+            for role in [ 'raw_file', 'mzML_file' ]:
+                if role in ms_run:
+                    self.handle_file_ready(ms_run[role])
+
+        self.update_conversion_state(dataset_id)
 
-            # Or if we have the mzMLs but not mzML.gz, then queue the READY ones
+
+    ###############################################################################################
+    def get_ms_run_counts(self, dataset):
+        """Return a dict counting how many of the MS runs of a dataset have reached each stage
+        """
+
+        counts = { 'n_ms_runs': 0, 'n_downloaded': 0, 'n_unavailable': 0, 'n_convertible': 0, 'n_converted': 0, 'n_compressed': 0 }
+        for ms_run in dataset['metadata'].get('ms_runs', {}).values():
+            counts['n_ms_runs'] += 1
+            if 'raw_file' in ms_run:
+                if ms_run['raw_file']['status'] == 'READY':
+                    counts['n_downloaded'] += 1
+                elif ms_run['raw_file']['status'] == 'UNAVAILABLE':
+                    counts['n_unavailable'] += 1
+
+            # A run is expected to end up as mzML if it already has one or has a raw file that handle_file_ready would convert
+            if 'mzML_file' in ms_run or 'mzML_gz_file' in ms_run:
+                counts['n_convertible'] += 1
+            elif 'raw_file' in ms_run and ms_run['raw_file']['status'] != 'UNAVAILABLE' and self.is_convertible(ms_run['raw_file']):
+                counts['n_convertible'] += 1
+            if 'mzML_gz_file' in ms_run and ms_run['mzML_gz_file']['status'] == 'READY':
+                counts['n_converted'] += 1
+                counts['n_compressed'] += 1
+            elif 'mzML_file' in ms_run and ms_run['mzML_file']['status'] == 'READY':
+                counts['n_converted'] += 1
+        return counts
+
+
+    ###############################################################################################
+    def update_conversion_state(self, dataset_id):
+        """Set the processing state of a dataset whose files are all downloaded from how far its
+        conversions and compressions have come
+
+        """
+
+        dataset = self.datasets['identifiers'][dataset_id]
+        counts = self.get_ms_run_counts(dataset)
+        n_convertible = counts['n_convertible']
+        if counts['n_converted'] < n_convertible:
+            dataset['state']['processing_state'] = 'Converting'
+        elif counts['n_compressed'] < n_convertible:
+            dataset['state']['processing_state'] = 'Compressing'
+        else:
+            dataset['state']['processing_state'] = 'Wait'
 
 
     ###############################################################################################
@@ -853,17 +1285,22 @@ class DatasetProcessor:
         if len(dataset_ids) > 0:
             buffer += '  - Datasets:\n'
             for dataset_id in dataset_ids:
-                status = self.datasets['identifiers'][dataset_id]['status']
-                n_files = 0
-                if 'ms_runs' in self.datasets['identifiers'][dataset_id]['metadata']:
-                    n_files = len(self.datasets['identifiers'][dataset_id]['metadata']['ms_runs'])
-                buffer += f"      {dataset_id} - {status} - {n_files} files\n"
+                dataset = self.datasets['identifiers'][dataset_id]
+                counts = self.get_ms_run_counts(dataset)
+                buffer += f"      {dataset_id} - {dataset['status']} - {dataset['state']['processing_state']} - {counts['n_ms_runs']} files: " + \
+                    f"{counts['n_downloaded']} downloaded, {counts['n_converted']} converted, {counts['n_compressed']} compressed\n"
         else:
             buffer += '  - No datasets'
 
         # Show some other key things
         buffer += f"  - Tasks to do: {len(self.tasks_todo)}"
 
+        # Where the datasets have spent their time
+        if level == 'full':
+            buffer += '\n  - Time spent in each state before a transition:'
+            for transition,histogram in sorted(self.transition_timings.items()):
+                buffer += f"\n      {transition}: {histogram.show()}"
+
 
         return buffer
 
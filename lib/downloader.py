@@ -0,0 +1,932 @@
+#!/usr/bin/env python3
+import sys
+def eprint(*args, **kwargs): print(*args, file=sys.stderr, **kwargs)
+
+import os
+import json
+import time
+import datetime
+import threading
+import concurrent.futures
+import email.utils
+import urllib.parse
+import ftplib
+
+import requests
+
+from response import Response
+
+
+class FtpConnectionPool:
+
+    ###############################################################################################
+    # Constructor
+    def __init__(self, max_idle_per_host=4, idle_timeout=60, timeout=60):
+        """Create a pool of logged-in anonymous FTP sessions, kept per host, so that consecutive
+        transfers from the same server do not each pay for DNS, TCP connection and login
+
+        :param max_idle_per_host: Maximum number of idle sessions kept open for each host
+        :type max_idle_per_host: int
+        :param idle_timeout: Number of seconds after which an idle session is closed rather than reused
+        :type idle_timeout: float
+        :param timeout: Socket timeout in seconds for the sessions
+        :type timeout: float
+        """
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.idle_sessions = {}
+        self.lock = threading.Lock()
+
+
+    ###############################################################################################
+    def acquire(self, host):
+        """Public method that returns a logged-in FTP session to the host, reusing an idle one if possible
+
+        :param host: Host name, optionally with :port
+        :type host: str
+        :return: A logged-in FTP session
+        :rtype: ftplib.FTP
+        """
+
+        while True:
+            with self.lock:
+                sessions = self.idle_sessions.get(host, [])
+                if len(sessions) == 0:
+                    break
+                ftp_session, idle_since = sessions.pop()
+
+            # Only reuse sessions that are recent and still answer
+            if time.time() - idle_since < self.idle_timeout:
+                try:
+                    ftp_session.voidcmd('NOOP')
+                    return ftp_session
+                except Exception:
+                    pass
+            self.discard(ftp_session)
+
+        hostname, _, port = host.partition(':')
+        ftp_session = ftplib.FTP(timeout=self.timeout)
+        ftp_session.connect(hostname, int(port) if port else 21)
+        ftp_session.login()
+        return ftp_session
+
+
+    ###############################################################################################
+    def release(self, host, ftp_session):
+        """Public method that returns a session to the pool after a successful operation
+        """
+        with self.lock:
+            sessions = self.idle_sessions.setdefault(host, [])
+            if len(sessions) < self.max_idle_per_host:
+                sessions.append( ( ftp_session, time.time() ) )
+                return
+        self.discard(ftp_session)
+
+
+    ###############################################################################################
+    def discard(self, ftp_session):
+        """Public method that closes a session that is broken or not wanted anymore
+        """
+        try:
+            ftp_session.quit()
+        except Exception:
+            try:
+                ftp_session.close()
+            except Exception:
+                pass
+
+
+    ###############################################################################################
+    def close(self):
+        """Public method that closes all idle sessions
+        """
+        with self.lock:
+            all_sessions = [ session for sessions in self.idle_sessions.values() for session,idle_since in sessions ]
+            self.idle_sessions = {}
+        for ftp_session in all_sessions:
+            self.discard(ftp_session)
+
+
+class TokenBucket:
+
+    ###############################################################################################
+    # Constructor
+    def __init__(self, rate=0, burst=None):
+        """Create a token bucket that admits rate bytes per second on average, allowing bursts of up to
+        burst bytes. Consumers take the bytes they have just transferred and are told how long to wait,
+        so the bucket can go into debt by one block and the wait pays the debt back
+
+        :param rate: Number of bytes per second to admit, or 0 for no limit
+        :type rate: float
+        :param burst: Number of bytes that may be taken at once after an idle period. Defaults to one second's worth
+        :type burst: float
+        """
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.set_rate(rate, burst)
+
+
+    ###############################################################################################
+    def set_rate(self, rate, burst=None):
+        """Public method that changes the rate of the bucket, keeping the tokens (or the debt) it holds
+        """
+        with self.lock:
+            self.refill()
+            self.rate = max(float(rate or 0), 0.0)
+            self.burst = float(burst) if burst is not None else self.rate
+            self.tokens = min(self.tokens, self.burst)
+
+
+    ###############################################################################################
+    def refill(self):
+        """Internal method that adds the tokens accrued since the last update. The lock must be held
+        """
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+
+
+    ###############################################################################################
+    def take(self, n_bytes):
+        """Public method that takes n_bytes from the bucket
+
+        :return: Number of seconds the caller should wait before transferring more
+        :rtype: float
+        """
+        with self.lock:
+            if self.rate <= 0:
+                return 0.0
+            self.refill()
+            self.tokens -= n_bytes
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class BandwidthLimiter:
+
+    # Class variables
+    sleep_interval = 0.1
+
+
+    ###############################################################################################
+    # Constructor
+    def __init__(self, rate=0, rates_by_host=None):
+        """Create a limiter that shares a global bandwidth budget, and optionally one per host, among all
+        transfers of the engine. Since every transfer draws from the same buckets, the budget is rebalanced
+        as transfers start and finish without any bookkeeping of who is running
+
+        :param rate: Number of bytes per second for all transfers together, or 0 for no limit
+        :type rate: float
+        :param rates_by_host: Dict of host name to number of bytes per second for transfers from that host
+        :type rates_by_host: dict
+        """
+        self.bucket = TokenBucket()
+        self.buckets_by_host = {}
+        self.lock = threading.Lock()
+        self.set_rates(rate, rates_by_host)
+
+
+    ###############################################################################################
+    def set_rates(self, rate=0, rates_by_host=None):
+        """Public method that sets the global and per-host rates. Hosts that are not listed are only
+        subject to the global rate
+        """
+        self.bucket.set_rate(rate)
+        rates_by_host = rates_by_host or {}
+        with self.lock:
+            for host in list(self.buckets_by_host):
+                if host not in rates_by_host:
+                    del self.buckets_by_host[host]
+            for host, host_rate in rates_by_host.items():
+                if host in self.buckets_by_host:
+                    self.buckets_by_host[host].set_rate(host_rate)
+                else:
+                    self.buckets_by_host[host] = TokenBucket(host_rate)
+
+
+    ###############################################################################################
+    def is_limited(self):
+        """Public method that returns True if any rate is set
+        """
+        with self.lock:
+            return self.bucket.rate > 0 or any(bucket.rate > 0 for bucket in self.buckets_by_host.values())
+
+
+    ###############################################################################################
+    def throttle(self, task, n_bytes):
+        """Public method that charges n_bytes just transferred by the task to the buckets and sleeps as long
+        as the slowest one requires. The sleep is cut into short intervals so that an abort is not delayed
+
+        :return: None, or the abort return code if the task was aborted while waiting
+        :rtype: int
+        """
+        with self.lock:
+            host_bucket = self.buckets_by_host.get(task.host)
+        wait = self.bucket.take(n_bytes)
+        if host_bucket is not None:
+            wait = max(wait, host_bucket.take(n_bytes))
+        deadline = time.monotonic() + wait
+        while True:
+            if task.abort_signal is not None:
+                return task.abort_signal
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            time.sleep(min(remaining, self.sleep_interval))
+
+
+class DownloadTask:
+
+    # Class variables. Return codes follow curl's so that the agent treats both engines alike
+    RETURN_CODE_OK = 0
+    RETURN_CODE_UNSUPPORTED_PROTOCOL = 1
+    RETURN_CODE_COULD_NOT_CONNECT = 7
+    RETURN_CODE_PARTIAL_FILE = 18
+    RETURN_CODE_NOT_FOUND = 19
+    RETURN_CODE_WRITE_ERROR = 23
+    RETURN_CODE_RANGE_ERROR = 33
+    RETURN_CODE_ABORTED = 42
+    RETURN_CODE_RECEIVE_ERROR = 56
+    RETURN_CODE_TERMINATED = -15
+    RETURN_CODE_KILLED = -9
+
+
+    ###############################################################################################
+    # Constructor
+    def __init__(self, uri, destination, log_file=None, n_segments=1):
+        """One file transfer run by the DownloadEngine. It offers the parts of the subprocess.Popen interface
+        that the agent uses (pid, poll(), terminate(), kill()) so that it can stand in for a curl process
+
+        :param uri: ftp://, http:// or https:// location of the file
+        :type uri: str
+        :param destination: Full path of the local file, which is resumed if it already exists
+        :type destination: str
+        :param log_file: Optional path of a file to which progress messages are appended
+        :type log_file: str
+        :param n_segments: Number of byte ranges of the file to download concurrently
+        :type n_segments: int
+        """
+        self.uri = uri
+        self.host = urllib.parse.urlparse(uri).netloc
+        self.destination = destination
+        self.log_file = log_file
+        self.n_segments = n_segments
+        self.pid = None
+        self.returncode = None
+        self.bytes_transferred = 0
+        self.start_offset = 0
+        self.total_size = None
+        self.remote_mtime = None
+        self.abort_signal = None
+        self.future = concurrent.futures.Future()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+
+    ###############################################################################################
+    def record_progress(self, n_bytes):
+        """Add to the count of bytes transferred. Segments of one task report from several threads
+        """
+        with self.lock:
+            self.bytes_transferred += n_bytes
+
+
+    ###############################################################################################
+    def poll(self):
+        """Return None while the transfer is in progress and the return code once it has finished
+        """
+        return self.returncode
+
+
+    ###############################################################################################
+    def terminate(self):
+        """Ask the transfer to stop at the next block
+        """
+        if self.abort_signal is None:
+            self.abort_signal = self.RETURN_CODE_TERMINATED
+
+
+    ###############################################################################################
+    def kill(self):
+        """Same as terminate(). A transfer thread cannot be killed, but it checks for aborts after every block
+        """
+        self.abort_signal = self.RETURN_CODE_KILLED
+
+
+    ###############################################################################################
+    def add_done_callback(self, callback):
+        """Register a function to be called (from the transfer thread) with this task when it finishes
+        """
+        self.callbacks.append(callback)
+
+
+    ###############################################################################################
+    def log(self, message):
+        """Append a timestamped line to the task's log file
+        """
+        if self.log_file is None:
+            return
+        try:
+            with open(self.log_file,'a', encoding='utf-8') as outfile:
+                outfile.write(f"{datetime.datetime.now()} {message}\n")
+        except OSError:
+            pass
+
+
+    ###############################################################################################
+    def finish(self, return_code):
+        """Record the outcome and notify whoever is waiting
+        """
+        self.returncode = return_code
+        self.log(f"Finished with return code {return_code} after {self.bytes_transferred} bytes")
+        self.future.set_result(return_code)
+        for callback in self.callbacks:
+            try:
+                callback(self)
+            except Exception as error:
+                eprint(f"ERROR: DownloadTask callback failed: {error}")
+
+
+class DownloadEngine:
+
+    # Class variables
+    block_size = 1024 * 1024
+
+
+    ###############################################################################################
+    # Constructor
+    def __init__(self, max_idle_connections_per_host=4, idle_timeout=60, timeout=60):
+        """Create a download engine that transfers files in threads over pooled connections: persistent,
+        logged-in FTP sessions per host and a requests.Session whose HTTP(S) connections are kept alive per host
+
+        :param max_idle_connections_per_host: Maximum number of idle connections kept open per host
+        :type max_idle_connections_per_host: int
+        :param idle_timeout: Number of seconds after which an idle connection is closed rather than reused
+        :type idle_timeout: float
+        :param timeout: Socket timeout in seconds
+        :type timeout: float
+        """
+        self.status = 'OK'
+        self.response = Response()
+        self.timeout = timeout
+        self.ftp_pool = FtpConnectionPool(max_idle_per_host=max_idle_connections_per_host, idle_timeout=idle_timeout, timeout=timeout)
+        self.http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=max(max_idle_connections_per_host, 1))
+        self.http_session.mount('http://', adapter)
+        self.http_session.mount('https://', adapter)
+        self.bandwidth_limiter = BandwidthLimiter()
+        self.tasks = set()
+        self.lock = threading.Lock()
+
+
+    ###############################################################################################
+    def start(self, uri, destination, log_file=None, on_complete=None, n_segments=1):
+        """Public method that starts downloading a file in the background
+
+        :param uri: ftp://, http:// or https:// location of the file
+        :type uri: str
+        :param destination: Full path of the local file. An existing partial file is resumed
+        :type destination: str
+        :param log_file: Optional path of a file to which progress messages are appended
+        :type log_file: str
+        :param on_complete: Optional function called with the task when it finishes
+        :type on_complete: function
+        :param n_segments: If more than 1, large files are split into this many byte ranges that are downloaded
+            concurrently into a preallocated .part file, with their progress kept in a .segments file for resuming
+        :type n_segments: int
+        :return: The running task
+        :rtype: DownloadTask
+        """
+
+        task = DownloadTask(uri, destination, log_file=log_file, n_segments=n_segments)
+        if on_complete is not None:
+            task.add_done_callback(on_complete)
+        with self.lock:
+            self.tasks.add(task)
+        thread = threading.Thread(target=self.run_task, args=(task,), name=f"download {os.path.basename(destination)}", daemon=True)
+        thread.start()
+        return task
+
+
+    ###############################################################################################
+    def run_task(self, task):
+        """Internal method that runs in the task's thread
+        """
+        try:
+            scheme = urllib.parse.urlparse(task.uri).scheme.lower()
+            task.log(f"Downloading {task.uri} to {task.destination}")
+            if scheme not in [ 'ftp', 'http', 'https' ]:
+                task.log(f"Unsupported protocol '{scheme}'")
+                return_code = DownloadTask.RETURN_CODE_UNSUPPORTED_PROTOCOL
+            elif task.n_segments > 1 or os.path.exists(self.get_segments_file(task)):
+                return_code = self.download_segmented(task)
+            elif scheme == 'ftp':
+                return_code = self.download_ftp(task)
+            else:
+                return_code = self.download_http(task)
+        except Exception as error:
+            task.log(f"Unexpected error: {error}")
+            return_code = DownloadTask.RETURN_CODE_RECEIVE_ERROR
+
+        with self.lock:
+            self.tasks.discard(task)
+        task.finish(return_code)
+
+
+    ###############################################################################################
+    def get_resume_offset(self, task):
+        """Internal method that returns how much of the destination file is already there
+        """
+        try:
+            return os.path.getsize(task.destination)
+        except OSError:
+            return 0
+
+
+    ###############################################################################################
+    def copy_stream(self, task, read_block, write_block, limit=None):
+        """Internal method that copies blocks from read_block(n) to write_block(data) until EOF,
+        until limit bytes have been copied, or until an abort. Each block is charged to the bandwidth limiter,
+        which paces the copy to the configured rates
+
+        :return: None on EOF or reaching the limit, or the abort return code
+        :rtype: int
+        """
+        while True:
+            if task.abort_signal is not None:
+                return task.abort_signal
+            block_size = self.block_size
+            if limit is not None:
+                if limit <= 0:
+                    return None
+                block_size = min(block_size, limit)
+                limit -= block_size
+            block = read_block(block_size)
+            if not block:
+                return None
+            if limit is not None:
+                limit += block_size - len(block)
+            write_block(block)
+            task.record_progress(len(block))
+            abort_code = self.bandwidth_limiter.throttle(task, len(block))
+            if abort_code is not None:
+                return abort_code
+
+
+    ###############################################################################################
+    def download_ftp(self, task):
+        """Internal method that downloads a file over a pooled FTP session, resuming with REST
+        """
+
+        parsed_uri = urllib.parse.urlparse(task.uri)
+        host = parsed_uri.netloc
+        remote_path = urllib.parse.unquote(parsed_uri.path)
+
+        try:
+            ftp_session = self.ftp_pool.acquire(host)
+        except Exception as error:
+            task.log(f"Unable to connect to {host}: {error}")
+            return DownloadTask.RETURN_CODE_COULD_NOT_CONNECT
+
+        reusable = False
+        try:
+            ftp_session.voidcmd('TYPE I')
+
+            # Learn the size and modification time so we can resume, verify and stamp the file
+            try:
+                task.total_size = ftp_session.size(remote_path)
+            except ftplib.error_perm as error:
+                if str(error).startswith('550'):
+                    task.log(f"Remote file not found: {error}")
+                    reusable = True
+                    return DownloadTask.RETURN_CODE_NOT_FOUND
+            try:
+                mdtm = ftp_session.voidcmd(f"MDTM {remote_path}").split()[-1]
+                task.remote_mtime = datetime.datetime.strptime(mdtm[:14], '%Y%m%d%H%M%S').replace(tzinfo=datetime.timezone.utc).timestamp()
+            except (ftplib.Error, ValueError, IndexError):
+                pass
+
+            offset = self.get_resume_offset(task)
+            if task.total_size is not None and offset > task.total_size:
+                task.log(f"Local file is larger than the remote one. Starting over")
+                offset = 0
+            task.start_offset = offset
+
+            # Nothing left to transfer
+            if task.total_size is not None and offset == task.total_size:
+                task.log(f"Local file is already complete")
+                reusable = True
+                self.set_mtime(task)
+                return DownloadTask.RETURN_CODE_OK
+
+            if offset > 0:
+                task.log(f"Resuming at byte {offset}")
+            with open(task.destination, 'ab' if offset > 0 else 'wb') as outfile:
+                try:
+                    data_connection = ftp_session.transfercmd(f"RETR {remote_path}", rest=offset if offset > 0 else None)
+                except ftplib.error_perm as error:
+                    task.log(f"Unable to retrieve file: {error}")
+                    reusable = str(error).startswith('550')
+                    return DownloadTask.RETURN_CODE_NOT_FOUND if reusable else DownloadTask.RETURN_CODE_RECEIVE_ERROR
+                with data_connection:
+                    abort_code = self.copy_stream(task, data_connection.recv, outfile.write)
+                if abort_code is not None:
+                    # The control connection is in an unknown state after an aborted transfer
+                    return abort_code
+            ftp_session.voidresp()
+            reusable = True
+
+        except (OSError, EOFError, ftplib.Error) as error:
+            task.log(f"Transfer failed: {error}")
+            return DownloadTask.RETURN_CODE_RECEIVE_ERROR
+
+        finally:
+            if reusable:
+                self.ftp_pool.release(host, ftp_session)
+            else:
+                self.ftp_pool.discard(ftp_session)
+
+        return self.verify(task)
+
+
+    ###############################################################################################
+    def download_http(self, task):
+        """Internal method that downloads a file over a pooled HTTP(S) connection, resuming with a Range request
+        """
+
+        offset = self.get_resume_offset(task)
+        headers = {}
+        if offset > 0:
+            headers['Range'] = f"bytes={offset}-"
+
+        try:
+            with self.http_session.get(task.uri, headers=headers, stream=True, timeout=self.timeout) as http_response:
+
+                if http_response.status_code in [ 404, 410 ]:
+                    task.log(f"Remote file not found: HTTP {http_response.status_code}")
+                    return DownloadTask.RETURN_CODE_NOT_FOUND
+
+                # A 416 on a resume means there is nothing left to fetch
+                if http_response.status_code == 416 and offset > 0:
+                    task.log(f"Local file is already complete")
+                    task.total_size = offset
+                    task.start_offset = offset
+                    return DownloadTask.RETURN_CODE_OK
+
+                if http_response.status_code not in [ 200, 206 ]:
+                    task.log(f"Unexpected HTTP status {http_response.status_code}")
+                    return DownloadTask.RETURN_CODE_RECEIVE_ERROR
+
+                # If the server ignored the Range, start over
+                if http_response.status_code == 200 and offset > 0:
+                    task.log(f"Server does not support resume. Starting over")
+                    offset = 0
+                task.start_offset = offset
+
+                if 'Content-Length' in http_response.headers:
+                    task.total_size = offset + int(http_response.headers['Content-Length'])
+                if 'Last-Modified' in http_response.headers:
+                    try:
+                        task.remote_mtime = email.utils.parsedate_to_datetime(http_response.headers['Last-Modified']).timestamp()
+                    except (TypeError, ValueError):
+                        pass
+
+                if offset > 0:
+                    task.log(f"Resuming at byte {offset}")
+                with open(task.destination, 'ab' if offset > 0 else 'wb') as outfile:
+                    abort_code = self.copy_stream(task, lambda n_bytes: http_response.raw.read(n_bytes, decode_content=True), outfile.write)
+                if abort_code is not None:
+                    return abort_code
+
+        except OSError as error:
+            task.log(f"Unable to write {task.destination}: {error}")
+            return DownloadTask.RETURN_CODE_WRITE_ERROR
+        except requests.exceptions.ConnectionError as error:
+            task.log(f"Unable to connect: {error}")
+            return DownloadTask.RETURN_CODE_COULD_NOT_CONNECT
+        except requests.exceptions.RequestException as error:
+            task.log(f"Transfer failed: {error}")
+            return DownloadTask.RETURN_CODE_RECEIVE_ERROR
+
+        return self.verify(task)
+
+
+    ###############################################################################################
+    def get_segments_file(self, task):
+        """Internal method that returns the path of the file that tracks the segments of a segmented download
+        """
+        return f"{task.destination}.segments"
+
+
+    ###############################################################################################
+    def probe(self, task):
+        """Internal method that learns the size and modification time of the remote file, and whether
+        byte ranges can be requested, without transferring it
+
+        :return: None if the file can be fetched in ranges, otherwise a return code, which is
+            RETURN_CODE_RANGE_ERROR if the file can only be fetched whole
+        :rtype: int
+        """
+
+        parsed_uri = urllib.parse.urlparse(task.uri)
+        if parsed_uri.scheme.lower() == 'ftp':
+            host = parsed_uri.netloc
+            remote_path = urllib.parse.unquote(parsed_uri.path)
+            try:
+                ftp_session = self.ftp_pool.acquire(host)
+            except Exception as error:
+                task.log(f"Unable to connect to {host}: {error}")
+                return DownloadTask.RETURN_CODE_COULD_NOT_CONNECT
+            try:
+                ftp_session.voidcmd('TYPE I')
+                try:
+                    task.total_size = ftp_session.size(remote_path)
+                except ftplib.error_perm as error:
+                    self.ftp_pool.release(host, ftp_session)
+                    if str(error).startswith('550'):
+                        task.log(f"Remote file not found: {error}")
+                        return DownloadTask.RETURN_CODE_NOT_FOUND
+                    return DownloadTask.RETURN_CODE_RANGE_ERROR
+                try:
+                    mdtm = ftp_session.voidcmd(f"MDTM {remote_path}").split()[-1]
+                    task.remote_mtime = datetime.datetime.strptime(mdtm[:14], '%Y%m%d%H%M%S').replace(tzinfo=datetime.timezone.utc).timestamp()
+                except (ftplib.Error, ValueError, IndexError):
+                    pass
+            except (OSError, EOFError, ftplib.Error) as error:
+                self.ftp_pool.discard(ftp_session)
+                task.log(f"Unable to query remote file: {error}")
+                return DownloadTask.RETURN_CODE_RECEIVE_ERROR
+            self.ftp_pool.release(host, ftp_session)
+            return None
+
+        try:
+            http_response = self.http_session.head(task.uri, allow_redirects=True, timeout=self.timeout)
+        except requests.exceptions.ConnectionError as error:
+            task.log(f"Unable to connect: {error}")
+            return DownloadTask.RETURN_CODE_COULD_NOT_CONNECT
+        except requests.exceptions.RequestException as error:
+            task.log(f"Unable to query remote file: {error}")
+            return DownloadTask.RETURN_CODE_RECEIVE_ERROR
+        if http_response.status_code in [ 404, 410 ]:
+            task.log(f"Remote file not found: HTTP {http_response.status_code}")
+            return DownloadTask.RETURN_CODE_NOT_FOUND
+        if 'Last-Modified' in http_response.headers:
+            try:
+                task.remote_mtime = email.utils.parsedate_to_datetime(http_response.headers['Last-Modified']).timestamp()
+            except (TypeError, ValueError):
+                pass
+        if http_response.status_code != 200 or 'Content-Length' not in http_response.headers:
+            return DownloadTask.RETURN_CODE_RANGE_ERROR
+        task.total_size = int(http_response.headers['Content-Length'])
+        if http_response.headers.get('Accept-Ranges', '').lower() != 'bytes':
+            return DownloadTask.RETURN_CODE_RANGE_ERROR
+        return None
+
+
+    ###############################################################################################
+    def download_segmented(self, task):
+        """Internal method that downloads a large file as several byte ranges at once. The ranges are written
+        in place into a preallocated .part file, and the bytes completed in each range are kept in a .segments
+        file so that an interrupted download resumes every range where it stopped. The .part file is renamed
+        to the destination once all ranges are complete
+        """
+
+        segments_file = self.get_segments_file(task)
+        part_file = f"{task.destination}.part"
+        scheme = urllib.parse.urlparse(task.uri).scheme.lower()
+
+        # Without a size or range support, or if a plain download is already under way, fetch it as one stream
+        return_code = self.probe(task)
+        if return_code == DownloadTask.RETURN_CODE_NOT_FOUND or return_code == DownloadTask.RETURN_CODE_COULD_NOT_CONNECT:
+            return return_code
+        if return_code is not None or task.total_size < task.n_segments * self.block_size or \
+                ( os.path.exists(task.destination) and not os.path.exists(segments_file) ):
+            task.log(f"Downloading as a single stream")
+            if scheme == 'ftp':
+                return self.download_ftp(task)
+            return self.download_http(task)
+
+        # Resume the previous plan if it is for the same remote file
+        plan = None
+        if os.path.exists(segments_file) and os.path.exists(part_file):
+            try:
+                with open(segments_file, encoding='utf-8') as infile:
+                    plan = json.load(infile)
+                if plan['size'] != task.total_size or plan['mtime'] != task.remote_mtime:
+                    task.log(f"Remote file has changed since the segmented download began. Starting over")
+                    plan = None
+            except (OSError, ValueError, KeyError):
+                plan = None
+
+        if plan is None:
+            segment_size = -(-task.total_size // task.n_segments)
+            plan = { 'uri': task.uri, 'size': task.total_size, 'mtime': task.remote_mtime,
+                'segments': [ { 'start': start, 'end': min(start + segment_size, task.total_size), 'done': 0 }
+                    for start in range(0, task.total_size, segment_size) ] }
+            try:
+                with open(part_file,'wb') as outfile:
+                    try:
+                        os.posix_fallocate(outfile.fileno(), 0, task.total_size)
+                    except (AttributeError, OSError):
+                        outfile.truncate(task.total_size)
+            except OSError as error:
+                task.log(f"Unable to create {part_file}: {error}")
+                return DownloadTask.RETURN_CODE_WRITE_ERROR
+            self.save_segments(task, plan)
+            task.log(f"Downloading {task.total_size} bytes in {len(plan['segments'])} segments")
+        else:
+            task.start_offset = sum(segment['done'] for segment in plan['segments'])
+            task.log(f"Resuming segmented download with {task.start_offset} of {task.total_size} bytes done")
+
+        # Fetch the unfinished segments in parallel, all writing into the same file
+        try:
+            fd = os.open(part_file, os.O_WRONLY)
+        except OSError as error:
+            task.log(f"Unable to open {part_file}: {error}")
+            return DownloadTask.RETURN_CODE_WRITE_ERROR
+        results = {}
+        threads = []
+        for index,segment in enumerate(plan['segments']):
+            if segment['done'] >= segment['end'] - segment['start']:
+                continue
+            thread = threading.Thread(target=lambda index=index,segment=segment: results.__setitem__(index, self.fetch_segment(task, plan, segment, fd)),
+                name=f"segment {index} of {os.path.basename(task.destination)}", daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        os.close(fd)
+        self.save_segments(task, plan)
+
+        failures = [ return_code for return_code in results.values() if return_code != DownloadTask.RETURN_CODE_OK ]
+        if len(failures) > 0:
+            if task.abort_signal is not None:
+                return task.abort_signal
+            return failures[0]
+
+        # Stitch: the ranges are already in place, so the part file just becomes the destination
+        try:
+            os.replace(part_file, task.destination)
+            os.remove(segments_file)
+        except OSError as error:
+            task.log(f"Unable to finish {task.destination}: {error}")
+            return DownloadTask.RETURN_CODE_WRITE_ERROR
+        return self.verify(task)
+
+
+    ###############################################################################################
+    def fetch_segment(self, task, plan, segment, fd):
+        """Internal method, run in its own thread, that downloads the rest of one byte range into the part file
+        """
+
+        def write_block(block):
+            os.pwrite(fd, block, segment['start'] + segment['done'])
+            with task.lock:
+                segment['done'] += len(block)
+                segment['n_unsaved_bytes'] = segment.get('n_unsaved_bytes', 0) + len(block)
+                save = segment['n_unsaved_bytes'] >= 64 * self.block_size
+                if save:
+                    segment['n_unsaved_bytes'] = 0
+            if save:
+                self.save_segments(task, plan)
+
+        offset = segment['start'] + segment['done']
+        n_bytes = segment['end'] - offset
+        parsed_uri = urllib.parse.urlparse(task.uri)
+
+        if parsed_uri.scheme.lower() == 'ftp':
+            host = parsed_uri.netloc
+            try:
+                ftp_session = self.ftp_pool.acquire(host)
+            except Exception as error:
+                task.log(f"Unable to connect to {host}: {error}")
+                return DownloadTask.RETURN_CODE_COULD_NOT_CONNECT
+            reusable = False
+            try:
+                ftp_session.voidcmd('TYPE I')
+                data_connection = ftp_session.transfercmd(f"RETR {urllib.parse.unquote(parsed_uri.path)}", rest=offset if offset > 0 else None)
+                with data_connection:
+                    abort_code = self.copy_stream(task, data_connection.recv, write_block, limit=n_bytes)
+                if abort_code is not None:
+                    return abort_code
+                # The last segment reads to the end, so the transfer completes normally. For the others,
+                # the server sees the data connection close early and the session is not worth saving
+                if segment['end'] == plan['size']:
+                    ftp_session.voidresp()
+                    reusable = True
+            except (OSError, EOFError, ftplib.Error) as error:
+                task.log(f"Transfer of segment at {offset} failed: {error}")
+                return DownloadTask.RETURN_CODE_RECEIVE_ERROR
+            finally:
+                if reusable:
+                    self.ftp_pool.release(host, ftp_session)
+                else:
+                    self.ftp_pool.discard(ftp_session)
+
+        else:
+            try:
+                headers = { 'Range': f"bytes={offset}-{segment['end']-1}" }
+                with self.http_session.get(task.uri, headers=headers, stream=True, timeout=self.timeout) as http_response:
+                    if http_response.status_code != 206:
+                        task.log(f"Expected partial content for segment at {offset} but got HTTP {http_response.status_code}")
+                        return DownloadTask.RETURN_CODE_RANGE_ERROR
+                    abort_code = self.copy_stream(task, lambda n_bytes: http_response.raw.read(n_bytes, decode_content=True), write_block, limit=n_bytes)
+                if abort_code is not None:
+                    return abort_code
+            except OSError as error:
+                task.log(f"Transfer of segment at {offset} failed: {error}")
+                return DownloadTask.RETURN_CODE_WRITE_ERROR
+            except requests.exceptions.RequestException as error:
+                task.log(f"Transfer of segment at {offset} failed: {error}")
+                return DownloadTask.RETURN_CODE_RECEIVE_ERROR
+
+        if segment['done'] < segment['end'] - segment['start']:
+            task.log(f"Segment at {segment['start']} ended after {segment['done']} of {segment['end'] - segment['start']} bytes")
+            return DownloadTask.RETURN_CODE_PARTIAL_FILE
+        return DownloadTask.RETURN_CODE_OK
+
+
+    ###############################################################################################
+    def save_segments(self, task, plan):
+        """Internal method that writes the progress of each segment to the .segments file
+        """
+        segments_file = self.get_segments_file(task)
+        with task.lock:
+            content = json.dumps( { 'uri': plan['uri'], 'size': plan['size'], 'mtime': plan['mtime'],
+                'segments': [ { key: segment[key] for key in [ 'start', 'end', 'done' ] } for segment in plan['segments'] ] } )
+            try:
+                with open(f"{segments_file}.tmp",'w', encoding='utf-8') as outfile:
+                    outfile.write(content)
+                os.replace(f"{segments_file}.tmp", segments_file)
+            except OSError as error:
+                task.log(f"Unable to save segment progress: {error}")
+
+
+    ###############################################################################################
+    def verify(self, task):
+        """Internal method that checks the size of a finished transfer and stamps it with the remote mtime
+        """
+        if task.total_size is not None:
+            size = self.get_resume_offset(task)
+            if size != task.total_size:
+                task.log(f"File is {size} bytes but should be {task.total_size}")
+                return DownloadTask.RETURN_CODE_PARTIAL_FILE
+        self.set_mtime(task)
+        return DownloadTask.RETURN_CODE_OK
+
+
+    ###############################################################################################
+    def set_mtime(self, task):
+        """Internal method that gives the local file the modification time of the remote one, like curl -R
+        """
+        if task.remote_mtime is None:
+            return
+        try:
+            os.utime(task.destination, (time.time(), task.remote_mtime))
+        except OSError as error:
+            task.log(f"Unable to set modification time: {error}")
+
+
+    ###############################################################################################
+    def close(self):
+        """Public method that asks all running transfers to stop and closes pooled connections
+        """
+        with self.lock:
+            tasks = list(self.tasks)
+        for task in tasks:
+            task.terminate()
+        self.ftp_pool.close()
+        self.http_session.close()
+
+
+##########################################################################################
+def main():
+
+    # Parse command line options
+    import argparse
+    argparser = argparse.ArgumentParser(description='Download one or more files with the DownloadEngine into the current directory')
+    argparser.add_argument('--verbose', action='count', help='If set, print out messages to STDERR as they are generated' )
+    argparser.add_argument('--segments', type=int, default=1, help='Number of byte ranges to download concurrently for each file (default 1)' )
+    argparser.add_argument('--limit_rate', type=float, default=0, help='Number of bytes per second for all downloads together (default 0 for no limit)' )
+    argparser.add_argument('uris', type=str, nargs='+', help='ftp:// or http(s):// URIs to download')
+    params = argparser.parse_args()
+
+    engine = DownloadEngine()
+    engine.bandwidth_limiter.set_rates(params.limit_rate)
+    tasks = []
+    for uri in params.uris:
+        destination = os.path.basename(urllib.parse.unquote(urllib.parse.urlparse(uri).path))
+        tasks.append(engine.start(uri, destination, log_file='/dev/stderr' if params.verbose else None, n_segments=params.segments))
+    for task in tasks:
+        return_code = task.future.result()
+        print(f"{task.uri}: return code {return_code}, {task.bytes_transferred} bytes transferred")
+    engine.close()
+
+
+if __name__ == "__main__": main()
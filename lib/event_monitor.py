@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+import sys
+def eprint(*args, **kwargs): print(*args, file=sys.stderr, **kwargs)
+
+import os
+import time
+import select
+import signal
+import struct
+import ctypes
+import ctypes.util
+
+from response import Response
+
+
+class EventMonitor:
+
+    # Class variables
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = 0x00000800
+    IN_CLOEXEC = 0x00080000
+    event_header_format = 'iIII'
+    event_header_size = struct.calcsize(event_header_format)
+
+
+    ###############################################################################################
+    # Constructor
+    def __init__(self, directory, watched_files=None):
+        """Create a monitor that can block until something of interest happens
+
+        :param directory: Directory in which the watched files live
+        :type directory: str
+        :param watched_files: Dict of filename to the event name that is reported when that file changes
+        :type watched_files: dict
+        """
+        self.status = 'OK'
+        self.response = Response()
+        self.directory = directory
+        self.watched_files = {}
+        if watched_files is not None:
+            self.watched_files = dict(watched_files)
+        self.mode = 'polling'
+        self.inotify_fd = None
+        self.watch_descriptor = None
+        self.wake_read_fd = None
+        self.wake_write_fd = None
+        self.previous_sigchld_handler = None
+
+
+    ###############################################################################################
+    def start(self, watch_children=True):
+        """Public method that sets up the inotify watch, the wakeup pipe and the SIGCHLD handler as available.
+        On platforms without these facilities, the monitor falls back to plain sleeping.
+
+        :param watch_children: If True, install a SIGCHLD handler so that child exits wake up wait()
+        :type watch_children: bool
+        """
+
+        response = self.response
+
+        # A self-pipe allows signal handlers and other threads to wake us up
+        if hasattr(os, 'pipe') and sys.platform != 'win32':
+            self.wake_read_fd, self.wake_write_fd = os.pipe()
+            os.set_blocking(self.wake_read_fd, False)
+            os.set_blocking(self.wake_write_fd, False)
+            self.mode = 'select'
+
+        # On Linux, ask the kernel to tell us about changes to the watched files
+        if self.mode == 'select' and sys.platform.startswith('linux'):
+            self._start_inotify()
+
+        # Wake up whenever a child process exits
+        if watch_children and self.mode != 'polling' and hasattr(signal, 'SIGCHLD'):
+            try:
+                self.previous_sigchld_handler = signal.signal(signal.SIGCHLD, self._handle_sigchld)
+            except ValueError as error:
+                response.warning(f"Unable to install SIGCHLD handler: {error}")
+
+        response.info(f"Event monitor started in mode '{self.mode}'")
+        return response
+
+
+    ###############################################################################################
+    def _start_inotify(self):
+        """Internal method that opens an inotify descriptor on the watched directory
+        """
+
+        response = self.response
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            inotify_fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+            if inotify_fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_CREATE | self.IN_DELETE | self.IN_MOVED_FROM | self.IN_MOVED_TO
+            watch_descriptor = libc.inotify_add_watch(inotify_fd, os.fsencode(self.directory), mask)
+            if watch_descriptor < 0:
+                os.close(inotify_fd)
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed on {self.directory}")
+        except Exception as error:
+            response.warning(f"inotify is not available, so falling back to timed polling: {error}")
+            return
+
+        self.inotify_fd = inotify_fd
+        self.watch_descriptor = watch_descriptor
+        self.mode = 'inotify'
+
+
+    ###############################################################################################
+    def _handle_sigchld(self, signum, frame):
+        """Internal signal handler that turns a child exit into a wakeup
+        """
+        self.wake(b'c')
+
+
+    ###############################################################################################
+    def wake(self, reason=b'w'):
+        """Public method that wakes up a pending wait(). Safe to call from signal handlers and other threads
+
+        :param reason: A single byte: b'c' for a child exit, anything else for a generic wakeup
+        :type reason: bytes
+        """
+        if self.wake_write_fd is None:
+            return
+        try:
+            os.write(self.wake_write_fd, reason)
+        except (BlockingIOError, OSError):
+            # The pipe is full, so a wakeup is pending anyway
+            pass
+
+
+    ###############################################################################################
+    def wait(self, timeout):
+        """Public method that blocks until an event arrives or the timeout expires
+
+        :param timeout: Maximum number of seconds to wait
+        :type timeout: float
+        :return: A set of event names such as 'child', 'wake', 'timer', or the names given in watched_files
+        :rtype: set
+        """
+
+        events = set()
+        if timeout is None or timeout < 0:
+            timeout = 0
+
+        # Without any event sources, just sleep
+        if self.mode == 'polling':
+            time.sleep(timeout)
+            events.add('timer')
+            return events
+
+        read_fds = [ self.wake_read_fd ]
+        if self.inotify_fd is not None:
+            read_fds.append(self.inotify_fd)
+
+        try:
+            ready_fds, _, _ = select.select(read_fds, [], [], timeout)
+        except InterruptedError:
+            ready_fds = []
+
+        if len(ready_fds) == 0:
+            events.add('timer')
+            return events
+
+        if self.wake_read_fd in ready_fds:
+            events |= self._drain_wake_pipe()
+        if self.inotify_fd is not None and self.inotify_fd in ready_fds:
+            events |= self._drain_inotify()
+
+        return events
+
+
+    ###############################################################################################
+    def _drain_wake_pipe(self):
+        """Internal method that reads all pending bytes from the wakeup pipe
+        """
+        events = set()
+        while True:
+            try:
+                data = os.read(self.wake_read_fd, 4096)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            if b'c' in data:
+                events.add('child')
+            if data.replace(b'c', b'') != b'':
+                events.add('wake')
+        return events
+
+
+    ###############################################################################################
+    def _drain_inotify(self):
+        """Internal method that reads and decodes all pending inotify events
+        """
+        events = set()
+        while True:
+            try:
+                data = os.read(self.inotify_fd, 65536)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            offset = 0
+            while offset + self.event_header_size <= len(data):
+                watch_descriptor, mask, cookie, name_length = struct.unpack_from(self.event_header_format, data, offset)
+                offset += self.event_header_size
+                name = data[offset:offset+name_length].rstrip(b'\0').decode('utf-8', errors='replace')
+                offset += name_length
+                if mask & self.IN_Q_OVERFLOW:
+                    # We lost track of what happened, so report everything
+                    events |= set(self.watched_files.values())
+                elif name in self.watched_files:
+                    events.add(self.watched_files[name])
+        return events
+
+
+    ###############################################################################################
+    def get_fds(self):
+        """Public method that returns the file descriptors that become readable when there is an event,
+        for use with an external event loop. Call wait(0) afterwards to collect the events
+
+        :return: List of file descriptors
+        :rtype: list
+        """
+        return [ fd for fd in [ self.wake_read_fd, self.inotify_fd ] if fd is not None ]
+
+
+    ###############################################################################################
+    def is_watching_files(self):
+        """Public method that returns True if file changes are reported as events rather than needing polling
+        """
+        return self.mode == 'inotify'
+
+
+    ###############################################################################################
+    def stop(self):
+        """Public method that releases all descriptors and restores the previous SIGCHLD handler
+        """
+        if self.previous_sigchld_handler is not None:
+            try:
+                signal.signal(signal.SIGCHLD, self.previous_sigchld_handler)
+            except ValueError:
+                pass
+            self.previous_sigchld_handler = None
+        for fd in [ self.inotify_fd, self.wake_read_fd, self.wake_write_fd ]:
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.inotify_fd = None
+        self.wake_read_fd = None
+        self.wake_write_fd = None
+        self.mode = 'polling'
+
+
+##########################################################################################
+def main():
+
+    # Parse command line options
+    import argparse
+    argparser = argparse.ArgumentParser(description='Watch a directory and print the events that the EventMonitor reports')
+    argparser.add_argument('--verbose', action='count', help='If set, print out messages to STDERR as they are generated' )
+    argparser.add_argument('--timeout', type=float, default=10, help='Number of seconds to wait for each event (default 10)' )
+    argparser.add_argument('directory', type=str, help='Directory to watch')
+    argparser.add_argument('filenames', type=str, nargs='*', help='Names of files in the directory to watch')
+    params = argparser.parse_args()
+
+    # Set verbosity
+    if params.verbose is not None:
+        Response.output = 'STDERR'
+
+    monitor = EventMonitor(params.directory, { filename: filename for filename in params.filenames })
+    monitor.start()
+    while True:
+        events = monitor.wait(params.timeout)
+        print(sorted(events))
+
+
+if __name__ == "__main__": main()
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+import sys
+def eprint(*args, **kwargs): print(*args, file=sys.stderr, **kwargs)
+
+import os
+import json
+import time
+
+from response import Response
+
+
+class JobJournal:
+
+    # Class variables
+    version = 1
+
+
+    ###############################################################################################
+    # Constructor
+    def __init__(self, directory, basename='agent_journal'):
+        """Create a durable record of dataset, file and job state. Every transition is appended to a
+        journal file as one JSON line, and the journal is periodically compacted into a snapshot file.
+        On startup, the snapshot is loaded and the journal replayed on top of it to restore the state
+
+        :param directory: Directory in which the journal and snapshot files are kept
+        :type directory: str
+        :param basename: Base name of the journal and snapshot files
+        :type basename: str
+        """
+        self.status = 'OK'
+        self.response = Response()
+        self.journal_file = f"{directory}/{basename}.jsonl"
+        self.snapshot_file = f"{directory}/{basename}.snapshot.json"
+        self.outfile = None
+        self.buffer = []
+        self.n_records = 0
+
+
+    ###############################################################################################
+    def open(self):
+        """Public method that opens the journal for appending
+        """
+        try:
+            self.outfile = open(self.journal_file,'a', encoding='utf-8')
+        except Exception as error:
+            self.response.error(f"Unable to open journal file {self.journal_file} - {error}", error_code='CannotOpenJournal')
+        return self.response
+
+
+    ###############################################################################################
+    def append(self, record):
+        """Public method that adds a record to the journal. Records are buffered until flush()
+
+        :param record: A JSON-serializable dict with at least an 'op' key
+        :type record: dict
+        """
+        self.buffer.append(json.dumps(record, separators=(',',':')))
+        self.n_records += 1
+
+
+    ###############################################################################################
+    def flush(self):
+        """Public method that writes all buffered records to the journal file in one write
+        """
+        if len(self.buffer) == 0 or self.outfile is None:
+            return
+        self.outfile.write('\n'.join(self.buffer) + '\n')
+        self.outfile.flush()
+        self.buffer = []
+
+
+    ###############################################################################################
+    def record_dataset(self, dataset):
+        """Public method that records the top-level state of a dataset, without its file handles or PX record
+
+        :param dataset: The dataset dict from DatasetProcessor.datasets['identifiers']
+        :type dataset: dict
+        """
+        metadata = {}
+        for key,value in dataset['metadata'].items():
+            if key in [ 'px_data', 'ms_runs' ]:
+                continue
+            if key == 'manifest':
+                value = { manifest_key: manifest_value for manifest_key,manifest_value in value.items() if manifest_key != 'file' }
+            metadata[key] = value
+        self.append( { 'op': 'dataset', 'dataset_id': dataset['dataset_id'], 'status': dataset['status'],
+            'state': dataset['state'], 'metadata': metadata } )
+
+
+    ###############################################################################################
+    def record_file_handle(self, file_handle):
+        """Public method that records the current content of a file handle
+
+        :param file_handle: A file handle dict as created by DatasetProcessor.create_file_handle()
+        :type file_handle: dict
+        """
+        if 'dataset_id' not in file_handle:
+            return
+        self.append( { 'op': 'file', 'handle': file_handle } )
+
+
+    ###############################################################################################
+    def record_job(self, job_id, job):
+        """Public method that records a job entering the queue
+
+        :param job_id: Index of the job in the queue
+        :type job_id: int
+        :param job: The job dict
+        :type job: dict
+        """
+        self.append( { 'op': 'job', 'job_id': job_id, 'job': self.serialize_job(job) } )
+
+
+    ###############################################################################################
+    def record_job_launch(self, job_id, job):
+        """Public method that records that a job has been started. The arguments are recorded again because
+        a rate limit may have been added at launch, and they must match for the process to be reattached
+        """
+        record = { 'op': 'job_launch', 'job_id': job_id, 'pid': job['pid'], 'launch_timestamp': job['launch_timestamp'], 'args': job['args'] }
+        if 'rate_limit' in job:
+            record['rate_limit'] = job['rate_limit']
+        self.append(record)
+
+
+    ###############################################################################################
+    def record_job_done(self, job_id):
+        """Public method that records that a job has left the queue
+        """
+        self.append( { 'op': 'job_done', 'job_id': job_id } )
+
+
+    ###############################################################################################
+    def serialize_job(self, job):
+        """Public method that returns a JSON-serializable copy of a job. The process handle is dropped
+        and the file handle is replaced by its full path so it can be relinked on replay
+        """
+        serialized_job = {}
+        for key,value in job.items():
+            if key == 'handle':
+                continue
+            if key == 'file_handle':
+                serialized_job['file_handle_path'] = value['full_path']
+                continue
+            serialized_job[key] = value
+        return serialized_job
+
+
+    ###############################################################################################
+    def load(self):
+        """Public method that reads the snapshot and replays the journal on top of it
+
+        :return: A dict with 'datasets' (as in DatasetProcessor.datasets['identifiers']), 'jobs' (with the
+            file handles relinked into the datasets) and 'job_index'
+        :rtype: dict
+        """
+
+        response = self.response
+        t0 = time.time()
+        state = { 'datasets': {}, 'jobs': {}, 'job_index': 1 }
+
+        # Start from the snapshot, if there is one
+        if os.path.exists(self.snapshot_file):
+            try:
+                with open(self.snapshot_file, encoding='utf-8') as infile:
+                    snapshot = json.load(infile)
+                state['datasets'] = snapshot['datasets']
+                state['jobs'] = { int(job_id): job for job_id,job in snapshot['jobs'].items() }
+                state['job_index'] = snapshot['job_index']
+            except Exception as error:
+                response.error(f"Unable to read journal snapshot {self.snapshot_file} - {error}", error_code='CannotReadJournalSnapshot')
+                return state
+
+        # Replay the journal
+        n_records = 0
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, encoding='utf-8') as infile:
+                for line in infile:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn final write from a crash. Everything before it is good
+                        response.warning(f"Ignoring unreadable record at the end of journal {self.journal_file}")
+                        break
+                    self.apply_record(state, record)
+                    n_records += 1
+        self.n_records = n_records
+
+        # Relink the jobs to the file handles in the datasets so that updates are seen by both
+        file_handles = {}
+        for dataset in state['datasets'].values():
+            manifest = dataset['metadata'].get('manifest', {})
+            if 'file' in manifest:
+                file_handles[manifest['file']['full_path']] = manifest['file']
+            for ms_run in dataset['metadata'].get('ms_runs', {}).values():
+                for file_handle in ms_run.values():
+                    file_handles[file_handle['full_path']] = file_handle
+        for job in state['jobs'].values():
+            file_handle_path = job.pop('file_handle_path', None)
+            if file_handle_path is not None:
+                job['file_handle'] = file_handles.get(file_handle_path, { 'full_path': file_handle_path })
+
+        response.info(f"Restored {len(state['datasets'])} datasets, {len(file_handles)} files and {len(state['jobs'])} jobs " +
+            f"from journal ({n_records} records replayed) in {time.time()-t0:.3f} s")
+        return state
+
+
+    ###############################################################################################
+    def apply_record(self, state, record):
+        """Public method that applies one journal record to the state being restored
+        """
+
+        op = record['op']
+        if op == 'dataset':
+            dataset = state['datasets'].get(record['dataset_id'])
+            if dataset is None:
+                dataset = { 'dataset_id': record['dataset_id'], 'metadata': {} }
+                state['datasets'][record['dataset_id']] = dataset
+            dataset['status'] = record['status']
+            dataset['state'] = record['state']
+            for key,value in record['metadata'].items():
+                if key == 'manifest' and 'manifest' in dataset['metadata']:
+                    dataset['metadata']['manifest'].update(value)
+                else:
+                    dataset['metadata'][key] = value
+
+        elif op == 'file':
+            file_handle = record['handle']
+            dataset = state['datasets'].get(file_handle['dataset_id'])
+            if dataset is None:
+                return
+            metadata = dataset['metadata']
+            if file_handle['role'] == 'manifest':
+                if 'manifest' not in metadata:
+                    metadata['manifest'] = { 'status': 'UNKNOWN' }
+                metadata['manifest']['file'] = file_handle
+            else:
+                if 'ms_runs' not in metadata:
+                    metadata['ms_runs'] = {}
+                if file_handle['fileroot'] not in metadata['ms_runs']:
+                    metadata['ms_runs'][file_handle['fileroot']] = {}
+                metadata['ms_runs'][file_handle['fileroot']][file_handle['role']] = file_handle
+
+        elif op == 'job':
+            state['jobs'][record['job_id']] = record['job']
+            state['job_index'] = max(state['job_index'], record['job_id'] + 1)
+
+        elif op == 'job_launch':
+            if record['job_id'] in state['jobs']:
+                job = state['jobs'][record['job_id']]
+                job['status'] = 'run'
+                job['pid'] = record['pid']
+                job['launch_timestamp'] = record['launch_timestamp']
+                if 'args' in record:
+                    job['args'] = record['args']
+                if 'rate_limit' in record:
+                    job['rate_limit'] = record['rate_limit']
+
+        elif op == 'job_done':
+            state['jobs'].pop(record['job_id'], None)
+
+        else:
+            self.response.warning(f"Unrecognized journal record op '{op}'")
+
+
+    ###############################################################################################
+    def compact(self, datasets, jobs, job_index):
+        """Public method that writes a snapshot of the complete current state and empties the journal.
+        The snapshot is written to a temporary file and renamed into place, so that a crash leaves
+        either the old snapshot and journal or the new snapshot
+
+        :param datasets: DatasetProcessor.datasets['identifiers']
+        :type datasets: dict
+        :param jobs: The agent's jobs dict
+        :type jobs: dict
+        :param job_index: The next job index to be handed out
+        :type job_index: int
+        """
+
+        response = self.response
+        self.flush()
+        snapshot = { 'version': self.version, 'timestamp': time.time(), 'job_index': job_index, 'datasets': {}, 'jobs': {} }
+        for dataset_id,dataset in datasets.items():
+            snapshot['datasets'][dataset_id] = dict(dataset)
+            snapshot['datasets'][dataset_id]['metadata'] = { key: value for key,value in dataset['metadata'].items() if key != 'px_data' }
+        for job_id,job in jobs.items():
+            snapshot['jobs'][str(job_id)] = self.serialize_job(job)
+
+        temporary_file = f"{self.snapshot_file}.tmp"
+        try:
+            with open(temporary_file,'w', encoding='utf-8') as outfile:
+                json.dump(snapshot, outfile, separators=(',',':'))
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(temporary_file, self.snapshot_file)
+        except Exception as error:
+            response.warning(f"Unable to write journal snapshot {self.snapshot_file} - {error}")
+            return response
+
+        # Now that the snapshot holds everything, start a fresh journal
+        if self.outfile is not None:
+            self.outfile.close()
+        self.outfile = open(self.journal_file,'w', encoding='utf-8')
+        self.n_records = 0
+        response.debug(f"Compacted journal into snapshot {self.snapshot_file}")
+        return response
+
+
+    ###############################################################################################
+    def close(self):
+        """Public method that flushes and closes the journal
+        """
+        self.flush()
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
+
+
+class ReattachedProcess:
+
+    ###############################################################################################
+    # Constructor
+    def __init__(self, pid):
+        """A minimal stand-in for a subprocess.Popen handle for a job process that was started by a previous
+        instance of the agent and is still running. Since it is not our child, its exit status cannot be
+        collected, so a return code of -1 is reported once it is gone, and the reattached attribute tells the
+        agent to decide from the job's output alone whether it succeeded
+
+        :param pid: Process id of the still-running job
+        :type pid: int
+        """
+        self.pid = pid
+        self.returncode = None
+        self.reattached = True
+
+
+    ###############################################################################################
+    @staticmethod
+    def find(pid, args):
+        """Return a ReattachedProcess if the given pid is alive and is running the given command, otherwise None
+        """
+        if pid is None:
+            return None
+        try:
+            with open(f"/proc/{pid}/cmdline",'rb') as infile:
+                cmdline = infile.read()
+        except OSError:
+            return None
+        if cmdline.rstrip(b'\0').split(b'\0') != [ os.fsencode(arg) for arg in args ]:
+            return None
+        return ReattachedProcess(pid)
+
+
+    ###############################################################################################
+    def poll(self):
+        """Return None while the process is alive and -1 once it has gone away
+        """
+        if self.returncode is not None:
+            return self.returncode
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            self.returncode = -1
+        except PermissionError:
+            pass
+        return self.returncode
+
+
+    ###############################################################################################
+    def terminate(self):
+        import signal
+        self.send_signal(signal.SIGTERM)
+
+
+    ###############################################################################################
+    def kill(self):
+        import signal
+        self.send_signal(signal.SIGKILL)
+
+
+    ###############################################################################################
+    def send_signal(self, signum):
+        try:
+            os.kill(self.pid, signum)
+        except ProcessLookupError:
+            pass
@@ -0,0 +1,609 @@
+#!/usr/bin/env python3
+import sys
+def eprint(*args, **kwargs): print(*args, file=sys.stderr, **kwargs)
+
+import heapq
+import time
+
+
+class JobScheduler:
+
+    # Class variables
+    RETRY_CLASS_REDO = 0
+    RETRY_CLASS_NEW = 1
+
+
+    ###############################################################################################
+    # Constructor
+    def __init__(self):
+        """Create an indexed queue of jobs waiting to run. Ready jobs are kept in one heap per job type and
+        remote host, ordered by (priority, retry class, enqueue time) so that picking the next job to launch
+        never requires looking at all the jobs. Jobs that may not run before some time, such as retries
+        that are backing off or jobs for a host that is on hold, wait in a delay heap ordered by that time.
+        The number of jobs running against each host may be limited, and free slots are shared round-robin
+        among the hosts that have jobs waiting, so that one slow host cannot take all of them
+        """
+        self.ready_heaps = {}
+        self.max_running_jobs_per_host = 0
+        self.max_running_jobs_by_host = {}
+        self.n_running_slots_by_host = {}
+        self.host_last_served = {}
+        self.delayed_heap = []
+        self.queued_job_ids = {}
+        self.job_slots = {}
+        self.job_hosts = {}
+        self.host_holds = {}
+        self.running_job_ids = set()
+        self.sequence = 0
+
+
+    ###############################################################################################
+    def enqueue(self, job_id, job):
+        """Public method that adds a job to the ready heap of its type
+
+        :param job_id: Index of the job in the agent's jobs dict
+        :type job_id: int
+        :param job: The job dict. Its 'type', 'status', optional 'priority' (lower runs sooner) and
+            optional 'slots' (how many of its type's running slots it occupies, default 1),
+            optional 'not_before' (a time before which it must not be launched) and optional 'host' are used
+        :type job: dict
+        """
+
+        retry_class = self.RETRY_CLASS_NEW
+        if job['status'] == 'redo':
+            retry_class = self.RETRY_CLASS_REDO
+        self.sequence += 1
+        key = ( job.get('priority', 0), retry_class, time.time(), self.sequence, job_id )
+
+        job_type = job['type']
+        self.queued_job_ids[job_id] = key
+        self.job_slots[job_id] = job.get('slots', 1)
+        self.job_hosts[job_id] = job.get('host')
+        if job.get('not_before', 0) > time.time():
+            heapq.heappush(self.delayed_heap, ( job['not_before'], self.sequence, job_type, key ))
+        else:
+            self.push_ready(job_type, key)
+
+
+    ###############################################################################################
+    def push_ready(self, job_type, key):
+        """Internal method that puts a job's heap key on the ready heap of its type and host
+        """
+        host = self.job_hosts.get(key[-1])
+        if job_type not in self.ready_heaps:
+            self.ready_heaps[job_type] = {}
+        if host not in self.ready_heaps[job_type]:
+            self.ready_heaps[job_type][host] = []
+        heapq.heappush(self.ready_heaps[job_type][host], key)
+
+
+    ###############################################################################################
+    def release_delayed(self, now):
+        """Public method that moves the delayed jobs whose time has come to the ready heaps
+
+        :param now: The current time
+        :type now: float
+        """
+        while len(self.delayed_heap) > 0 and self.delayed_heap[0][0] <= now:
+            not_before, sequence, job_type, key = heapq.heappop(self.delayed_heap)
+            if self.queued_job_ids.get(key[-1]) is key:
+                self.push_ready(job_type, key)
+
+
+    ###############################################################################################
+    def next_release_time(self):
+        """Public method that returns the time at which the next delayed job becomes ready, or None
+        """
+        while len(self.delayed_heap) > 0:
+            not_before, sequence, job_type, key = self.delayed_heap[0]
+            if self.queued_job_ids.get(key[-1]) is key:
+                return not_before
+            heapq.heappop(self.delayed_heap)
+        return None
+
+
+    ###############################################################################################
+    def hold_host(self, host, until):
+        """Public method that keeps all jobs for a host from being launched until the given time
+
+        :param host: Host name, as in the jobs' 'host'
+        :type host: str
+        :param until: Time at which jobs for the host may be launched again
+        :type until: float
+        """
+        self.host_holds[host] = until
+
+
+    ###############################################################################################
+    def get_host_limit(self, host):
+        """Public method that returns the maximum number of slots that jobs for a host may occupy at once, or None if unlimited
+
+        :param host: Host name, as in the jobs' 'host'
+        :type host: str
+        """
+        if host is None:
+            return None
+        limit = self.max_running_jobs_by_host.get(host, self.max_running_jobs_per_host)
+        if limit is None or limit <= 0:
+            return None
+        return limit
+
+
+    ###############################################################################################
+    def remove(self, job_id):
+        """Public method that forgets a job, whether it is waiting or running. Heap entries of removed
+        jobs are discarded lazily when they reach the top of their heap
+
+        :param job_id: Index of the job in the agent's jobs dict
+        :type job_id: int
+        """
+        if job_id in self.running_job_ids:
+            self.running_job_ids.discard(job_id)
+            host = self.job_hosts.get(job_id)
+            if host is not None:
+                self.n_running_slots_by_host[host] -= self.job_slots.get(job_id, 1)
+                if self.n_running_slots_by_host[host] <= 0:
+                    del self.n_running_slots_by_host[host]
+        self.queued_job_ids.pop(job_id, None)
+        self.job_slots.pop(job_id, None)
+        self.job_hosts.pop(job_id, None)
+
+
+    ###############################################################################################
+    def mark_running(self, job_id):
+        """Public method that moves a job from the ready heaps to the running set
+
+        :param job_id: Index of the job in the agent's jobs dict
+        :type job_id: int
+        """
+        self.queued_job_ids.pop(job_id, None)
+        if job_id in self.running_job_ids:
+            return
+        self.running_job_ids.add(job_id)
+        host = self.job_hosts.get(job_id)
+        if host is not None:
+            self.n_running_slots_by_host[host] = self.n_running_slots_by_host.get(host, 0) + self.job_slots.get(job_id, 1)
+
+
+    ###############################################################################################
+    def peek(self, job_type):
+        """Public method that returns the heap key of the next job of the given type, or None
+
+        :param job_type: Type of job, e.g. 'download'
+        :type job_type: str
+        :return: The heap key tuple whose last element is the job_id
+        :rtype: tuple
+        """
+
+        best_key = None
+        for host in list(self.ready_heaps.get(job_type, {})):
+            key = self.peek_host(job_type, host)
+            if key is not None and ( best_key is None or key < best_key ):
+                best_key = key
+        return best_key
+
+
+    ###############################################################################################
+    def peek_host(self, job_type, host):
+        """Public method that returns the heap key of the next job of the given type for the given host, or None.
+        Heaps that have run empty are dropped
+
+        :param job_type: Type of job, e.g. 'download'
+        :type job_type: str
+        :param host: Host name, as in the jobs' 'host'
+        :type host: str
+        :return: The heap key tuple whose last element is the job_id
+        :rtype: tuple
+        """
+
+        heap = self.ready_heaps[job_type][host]
+        while len(heap) > 0:
+            key = heap[0]
+            if self.queued_job_ids.get(key[-1]) is key:
+                return key
+            heapq.heappop(heap)
+        del self.ready_heaps[job_type][host]
+        return None
+
+
+    ###############################################################################################
+    def select_jobs_to_launch(self, n_free_slots, n_free_slots_by_type, job_types=None, admit=None):
+        """Public method that pops the jobs that should be launched now from the ready heaps.
+        Each pick compares only the heads of the heaps of the types and hosts that still have a free slot,
+        so the cost is proportional to the number of slots filled, not the number of jobs waiting.
+        A job that needs more slots than are free holds back the jobs of its type and host behind it until they are.
+
+        :param n_free_slots: Number of jobs that may still be started overall
+        :type n_free_slots: int
+        :param n_free_slots_by_type: Number of jobs that may still be started for each job type.
+            Types that are not listed are unconstrained. Modified in place as slots are taken
+        :type n_free_slots_by_type: dict
+        :param job_types: If given, only jobs of these types are considered, so that different pools
+            of slots can be filled separately
+        :type job_types: list
+        :param admit: If given, a function that is passed each job_id about to be selected and returns None if the job
+            may be launched, or the time until which it must wait, in which case it steps aside into the delay heap
+        :type admit: function
+        :return: List of job_ids in the order they should be launched
+        :rtype: list
+        """
+
+        now = time.time()
+        self.release_delayed(now)
+        selected_job_ids = []
+        while n_free_slots > 0:
+
+            # Find the best job among the heads of the heaps with available slots. Among jobs of equal priority,
+            # the host with the fewest slots in use goes first, then the one served longest ago, so hosts take turns
+            best_rank = None
+            best_type = None
+            best_host = None
+            for job_type in self.ready_heaps:
+                if job_types is not None and job_type not in job_types:
+                    continue
+                if n_free_slots_by_type.get(job_type, n_free_slots) <= 0:
+                    continue
+                for host in list(self.ready_heaps[job_type]):
+                    key = self.peek_host(job_type, host)
+                    if key is None:
+                        continue
+
+                    # Jobs for a host on hold step aside into the delay heap until the hold ends
+                    if self.host_holds.get(host, 0) > now:
+                        while key is not None:
+                            heapq.heappop(self.ready_heaps[job_type][host])
+                            self.sequence += 1
+                            heapq.heappush(self.delayed_heap, ( self.host_holds[host], self.sequence, job_type, key ))
+                            key = self.peek_host(job_type, host)
+                        continue
+
+                    n_slots = self.job_slots.get(key[-1], 1)
+                    if n_slots > n_free_slots or n_slots > n_free_slots_by_type.get(job_type, n_free_slots):
+                        continue
+                    n_host_slots = self.n_running_slots_by_host.get(host, 0)
+                    host_limit = self.get_host_limit(host)
+                    if host_limit is not None and n_host_slots + n_slots > host_limit:
+                        continue
+                    rank = ( key[0], n_host_slots, self.host_last_served.get(host, 0), key )
+                    if best_rank is None or rank < best_rank:
+                        best_rank = rank
+                        best_type = job_type
+                        best_host = host
+
+            if best_rank is None:
+                break
+
+            best_key = heapq.heappop(self.ready_heaps[best_type][best_host])
+            job_id = best_key[-1]
+            if admit is not None:
+                wait_until = admit(job_id)
+                if wait_until is not None:
+                    self.sequence += 1
+                    heapq.heappush(self.delayed_heap, ( wait_until, self.sequence, best_type, best_key ))
+                    continue
+            n_slots = self.job_slots.get(job_id, 1)
+            self.sequence += 1
+            self.host_last_served[best_host] = self.sequence
+            self.mark_running(job_id)
+            selected_job_ids.append(job_id)
+            n_free_slots -= n_slots
+            if best_type in n_free_slots_by_type:
+                n_free_slots_by_type[best_type] -= n_slots
+
+        return selected_job_ids
+
+
+    ###############################################################################################
+    def n_queued(self):
+        """Public method that returns the number of jobs waiting to be launched
+        """
+        return len(self.queued_job_ids)
+
+
+class CircuitBreaker:
+
+    ###############################################################################################
+    # Constructor
+    def __init__(self, failure_threshold=5, cooldown=60, max_cooldown=3600):
+        """Create a per-host circuit breaker. After failure_threshold consecutive failures for a host,
+        the circuit opens and jobs for that host should be held for the cooldown period. When the hold
+        ends, the next result decides: a success closes the circuit, while another failure opens it again
+        for twice as long, up to max_cooldown
+
+        :param failure_threshold: Number of consecutive failures that opens the circuit
+        :type failure_threshold: int
+        :param cooldown: Number of seconds the circuit stays open the first time
+        :type cooldown: float
+        :param max_cooldown: Maximum number of seconds the circuit stays open
+        :type max_cooldown: float
+        """
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.hosts = {}
+
+
+    ###############################################################################################
+    def record_success(self, host):
+        """Public method that notes a successful job for a host, closing its circuit
+        """
+        self.hosts.pop(host, None)
+
+
+    ###############################################################################################
+    def record_failure(self, host, now):
+        """Public method that notes a failed job for a host
+
+        :return: The time until which the host should be held if this failure opened the circuit, otherwise None
+        :rtype: float
+        """
+        state = self.hosts.setdefault(host, { 'n_failures': 0, 'cooldown': self.cooldown, 'open_until': 0 })
+        state['n_failures'] += 1
+        if state['n_failures'] < self.failure_threshold or state['open_until'] > now:
+            return None
+        if state['open_until'] > 0:
+            state['cooldown'] = min(state['cooldown'] * 2, self.max_cooldown)
+        state['open_until'] = now + state['cooldown']
+        return state['open_until']
+
+
+class DiskSpaceAdmission:
+
+    ###############################################################################################
+    # Constructor
+    def __init__(self, watermark=0.95, recheck_interval=30):
+        """Create the admission control for jobs that write to a file system. The bytes that running jobs are
+        still expected to write are reserved, and a job is only admitted if the projected usage of the
+        file system, with its own expected bytes added, stays below the watermark. Jobs that are not admitted
+        should be tried again after recheck_interval seconds, by which time space may have been freed
+
+        :param watermark: Fraction of the file system that may be used, including reservations
+        :type watermark: float
+        :param recheck_interval: Number of seconds a job that was not admitted waits before it is tried again
+        :type recheck_interval: float
+        """
+        self.watermark = watermark
+        self.recheck_interval = recheck_interval
+        self.total_bytes = 0
+        self.free_bytes = 0
+        self.reserved_bytes = 0
+
+
+    ###############################################################################################
+    def update(self, total_bytes, free_bytes, reserved_bytes):
+        """Public method that sets the current size and free space of the file system and the number of bytes
+        that the running jobs are still expected to write
+        """
+        self.total_bytes = total_bytes
+        self.free_bytes = free_bytes
+        self.reserved_bytes = reserved_bytes
+
+
+    ###############################################################################################
+    def get_headroom(self):
+        """Public method that returns the number of bytes that may still be reserved before the watermark is reached
+        """
+        return self.watermark * self.total_bytes - ( self.total_bytes - self.free_bytes ) - self.reserved_bytes
+
+
+    ###############################################################################################
+    def admit(self, n_bytes, now):
+        """Public method that decides whether a job that is expected to write n_bytes may start, and reserves them if so
+
+        :return: None if the job is admitted, otherwise the time at which to try again
+        :rtype: float
+        """
+        if n_bytes > self.get_headroom():
+            return now + self.recheck_interval
+        self.reserved_bytes += n_bytes
+        return None
+
+
+class ConcurrencyTuner:
+
+    ###############################################################################################
+    # Constructor
+    def __init__(self, minimum=1, maximum=16, initial=2, window=30, tolerance=0.05, decrease_factor=0.5):
+        """Create a controller that adjusts a concurrency limit to the throughput it achieves, AIMD-style.
+        At the end of each window, the aggregate throughput is compared with that of the previous window.
+        Only windows in which the limit was actually in the way (all slots busy, or jobs waiting for one) are
+        judged. If the throughput fell, the last step hurt or the link has become congested, so the limit is cut
+        by decrease_factor. Otherwise it is raised by one. When raising the limit brought no gain, it is held
+        for a window before it is probed again
+
+        :param minimum: Lowest limit that may be chosen
+        :type minimum: int
+        :param maximum: Highest limit that may be chosen
+        :type maximum: int
+        :param initial: Limit to start from
+        :type initial: int
+        :param window: Number of seconds over which the throughput is measured
+        :type window: float
+        :param tolerance: Fraction by which the throughput must change to count as a gain or a loss
+        :type tolerance: float
+        :param decrease_factor: Factor by which the limit is multiplied when the throughput falls
+        :type decrease_factor: float
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(min(initial, maximum), minimum)
+        self.window = window
+        self.tolerance = tolerance
+        self.decrease_factor = decrease_factor
+        self.window_start = None
+        self.n_bytes = 0
+        self.is_saturated = False
+        self.throughput = None
+        self.last_step = None
+
+
+    ###############################################################################################
+    def record(self, n_bytes, is_saturated):
+        """Public method that adds bytes transferred to the current window and notes whether the limit was reached
+
+        :param n_bytes: Number of bytes transferred since the previous call
+        :type n_bytes: int
+        :param is_saturated: True if all slots were in use or jobs were waiting for one
+        :type is_saturated: bool
+        """
+        self.n_bytes += n_bytes
+        self.is_saturated = self.is_saturated or is_saturated
+
+
+    ###############################################################################################
+    def update(self, now):
+        """Public method that closes the current window if it has run its length and chooses the next limit
+
+        :param now: The current time
+        :type now: float
+        :return: True if the limit was changed
+        :rtype: bool
+        """
+
+        if self.window_start is None:
+            self.window_start = now
+            return False
+        elapsed = now - self.window_start
+        if elapsed < self.window:
+            return False
+
+        throughput = self.n_bytes / elapsed
+        previous_throughput = self.throughput
+        previous_limit = self.limit
+        if not self.is_saturated:
+            # There was less to do than the limit allows, so the throughput says nothing about the limit
+            self.last_step = None
+        elif previous_throughput is not None and throughput < previous_throughput * (1 - self.tolerance):
+            self.limit = max(int(self.limit * self.decrease_factor), self.minimum)
+            self.last_step = 'decrease'
+        elif self.last_step == 'increase' and throughput < previous_throughput * (1 + self.tolerance):
+            self.last_step = 'hold'
+        else:
+            self.limit = min(self.limit + 1, self.maximum)
+            self.last_step = 'increase'
+
+        self.throughput = throughput
+        self.window_start = now
+        self.n_bytes = 0
+        self.is_saturated = False
+        return self.limit != previous_limit
+
+
+    ###############################################################################################
+    def next_update_time(self):
+        """Public method that returns the time at which the current window ends, or None if none has started
+        """
+        if self.window_start is None:
+            return None
+        return self.window_start + self.window
+
+
+##########################################################################################
+import unittest
+class JobSchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = JobScheduler()
+        self.scheduler.enqueue(1, { 'type': 'download', 'status': 'qw' })
+        self.scheduler.enqueue(2, { 'type': 'download', 'status': 'qw' })
+        self.scheduler.enqueue(3, { 'type': 'download', 'status': 'redo' })
+        self.scheduler.enqueue(4, { 'type': 'convert', 'status': 'qw' })
+        self.scheduler.enqueue(5, { 'type': 'convert', 'status': 'qw', 'priority': -1 })
+
+    def test_redo_first(self):
+        self.assertEqual(self.scheduler.select_jobs_to_launch(1, { 'download': 1, 'convert': 0 }), [ 3 ])
+
+    def test_priority(self):
+        self.assertEqual(self.scheduler.select_jobs_to_launch(2, { 'download': 0, 'convert': 2 }), [ 5, 4 ])
+
+    def test_type_limits(self):
+        self.assertEqual(self.scheduler.select_jobs_to_launch(10, { 'download': 2, 'convert': 0 }), [ 3, 1 ])
+        self.assertEqual(self.scheduler.n_queued(), 3)
+
+    def test_remove(self):
+        self.scheduler.remove(3)
+        self.assertEqual(self.scheduler.select_jobs_to_launch(1, { 'download': 1, 'convert': 0 }), [ 1 ])
+
+    def test_slots(self):
+        self.scheduler.enqueue(6, { 'type': 'download', 'status': 'redo', 'priority': -1, 'slots': 3 })
+        self.assertEqual(self.scheduler.select_jobs_to_launch(4, { 'download': 2, 'convert': 2 }), [ 5, 4 ])
+        self.assertEqual(self.scheduler.select_jobs_to_launch(4, { 'download': 4, 'convert': 0 }), [ 6, 3 ])
+
+
+    def test_not_before(self):
+        self.scheduler.enqueue(6, { 'type': 'download', 'status': 'redo', 'not_before': time.time() + 0.05 })
+        self.assertEqual(self.scheduler.select_jobs_to_launch(1, { 'download': 1, 'convert': 0 }), [ 3 ])
+        self.assertIsNotNone(self.scheduler.next_release_time())
+        time.sleep(0.06)
+        self.assertEqual(self.scheduler.select_jobs_to_launch(1, { 'download': 1, 'convert': 0 }), [ 6 ])
+        self.assertIsNone(self.scheduler.next_release_time())
+
+    def test_hold_host(self):
+        self.scheduler.enqueue(6, { 'type': 'download', 'status': 'redo', 'priority': -1, 'host': 'ftp.pride.ebi.ac.uk' })
+        self.scheduler.hold_host('ftp.pride.ebi.ac.uk', time.time() + 60)
+        self.assertEqual(self.scheduler.select_jobs_to_launch(1, { 'download': 1, 'convert': 0 }), [ 3 ])
+        self.assertEqual(self.scheduler.n_queued(), 5)
+
+    def test_job_types(self):
+        self.assertEqual(self.scheduler.select_jobs_to_launch(1, {}, job_types=[ 'convert' ]), [ 5 ])
+
+    def test_admit(self):
+        self.assertEqual(self.scheduler.select_jobs_to_launch(2, { 'download': 2, 'convert': 0 }, admit=lambda job_id: None if job_id != 3 else time.time() + 60), [ 1, 2 ])
+        self.assertEqual(self.scheduler.n_queued(), 3)
+        self.assertIsNotNone(self.scheduler.next_release_time())
+
+    def test_disk_space_admission(self):
+        admission = DiskSpaceAdmission(watermark=0.9, recheck_interval=10)
+        admission.update(1000, 500, 100)
+        self.assertIsNone(admission.admit(150, 100))
+        self.assertEqual(admission.admit(151, 100), 110)
+        self.assertIsNone(admission.admit(150, 100))
+
+    def test_host_limits(self):
+        self.scheduler.max_running_jobs_per_host = 2
+        self.scheduler.max_running_jobs_by_host = { 'b': 1 }
+        for job_id in range(6, 12):
+            self.scheduler.enqueue(job_id, { 'type': 'upload', 'status': 'qw', 'host': 'a' if job_id < 10 else 'b' })
+        self.assertEqual(self.scheduler.select_jobs_to_launch(10, {}, job_types=[ 'upload' ]), [ 6, 10, 7 ])
+        self.scheduler.remove(10)
+        self.assertEqual(self.scheduler.select_jobs_to_launch(10, {}, job_types=[ 'upload' ]), [ 11 ])
+
+    def test_round_robin(self):
+        for job_id in range(6, 12):
+            self.scheduler.enqueue(job_id, { 'type': 'upload', 'status': 'qw', 'host': 'a' if job_id < 9 else 'b' })
+        self.assertEqual(self.scheduler.select_jobs_to_launch(4, {}, job_types=[ 'upload' ]), [ 6, 9, 7, 10 ])
+
+    def test_concurrency_tuner(self):
+        tuner = ConcurrencyTuner(minimum=1, maximum=4, initial=2, window=10)
+        tuner.update(0)
+        tuner.record(1000, True)
+        self.assertTrue(tuner.update(10))
+        self.assertEqual(tuner.limit, 3)
+        tuner.record(1500, True)
+        self.assertTrue(tuner.update(20))
+        self.assertEqual(tuner.limit, 4)
+        tuner.record(1500, True)
+        self.assertFalse(tuner.update(30))
+        self.assertEqual(tuner.last_step, 'hold')
+        tuner.record(500, True)
+        self.assertTrue(tuner.update(40))
+        self.assertEqual(tuner.limit, 2)
+        tuner.record(500, False)
+        self.assertFalse(tuner.update(50))
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, cooldown=10)
+        self.assertIsNone(breaker.record_failure('host', 100))
+        self.assertEqual(breaker.record_failure('host', 101), 111)
+        self.assertIsNone(breaker.record_failure('host', 105))
+        self.assertEqual(breaker.record_failure('host', 112), 132)
+        breaker.record_success('host')
+        self.assertIsNone(breaker.record_failure('host', 140))
+
+
+##########################################################################################
+def main():
+    unittest.main()
+
+
+if __name__ == "__main__": main()
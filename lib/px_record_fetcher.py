@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+import sys
+def eprint(*args, **kwargs): print(*args, file=sys.stderr, **kwargs)
+
+import os
+import json
+import time
+import threading
+import concurrent.futures
+
+import requests
+
+from response import Response
+
+
+class PxRecordFetcher:
+
+    # Class variables
+    url_template = "http://proteomecentral.proteomexchange.org/cgi/GetDataset?ID={dataset_id}&outputMode=json"
+
+
+    ###############################################################################################
+    # Constructor
+    def __init__(self, cache_dir, max_workers=4, timeout=60, max_age=24 * 60 * 60):
+        """Create a fetcher that retrieves ProteomeXchange records from ProteomeCentral in a bounded pool of threads
+        over one pooled requests.Session, so that the main loop never waits on the network. Records are cached on disk
+        by dataset identifier. A cached record younger than max_age is used without asking the server at all, and an
+        older one is revalidated with its ETag and Last-Modified, so that an unchanged record is not transferred again
+
+        :param cache_dir: Directory in which the records and their validators are cached
+        :type cache_dir: str
+        :param max_workers: Maximum number of records fetched at once
+        :type max_workers: int
+        :param timeout: Number of seconds to wait for the server to connect or to send more of a record
+        :type timeout: float
+        :param max_age: Number of seconds for which a cached record is used without revalidation
+        :type max_age: float
+        """
+        self.status = 'OK'
+        self.response = Response()
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.max_age = max_age
+        self.on_complete = None
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(max_workers, 1))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(max_workers, 1), thread_name_prefix='px_fetch')
+        self.futures = {}
+        self.completed_dataset_ids = []
+        self.lock = threading.Lock()
+
+
+    ###############################################################################################
+    def get_record(self, dataset_id):
+        """Public method that returns the record of a dataset if it is at hand, and otherwise starts fetching it.
+        Call again once the dataset shows up in collect_completed()
+
+        :param dataset_id: PXD identifier of the dataset
+        :type dataset_id: str
+        :return: A dict with 'status' 'OK' and the record 'text', 'ERROR' and a 'message', or 'PENDING' while it is being fetched
+        :rtype: dict
+        """
+
+        # A fetch that has finished is handed over once
+        with self.lock:
+            future = self.futures.get(dataset_id)
+            if future is not None:
+                if not future.done():
+                    return { 'status': 'PENDING' }
+                del self.futures[dataset_id]
+        if future is not None:
+            return future.result()
+
+        # A fresh cached record costs nothing to get
+        metadata = self.read_cache_metadata(dataset_id)
+        if metadata is not None and time.time() - metadata.get('validated_timestamp', 0) < self.max_age:
+            text = self.read_cached_record(dataset_id)
+            if text is not None:
+                return { 'status': 'OK', 'text': text, 'source': 'cache' }
+
+        future = self.executor.submit(self.fetch, dataset_id)
+        with self.lock:
+            self.futures[dataset_id] = future
+        future.add_done_callback(lambda future: self.handle_fetch_done(dataset_id))
+        return { 'status': 'PENDING' }
+
+
+    ###############################################################################################
+    def fetch(self, dataset_id):
+        """Internal method, run in a pool thread, that fetches a record from the server, revalidating the cached
+        copy if there is one. It never raises: failures are returned as a result with 'status' 'ERROR'
+        """
+
+        try:
+            return self.fetch_from_server(dataset_id)
+        except Exception as error:
+            return { 'status': 'ERROR', 'message': f"Unable to fetch ProteomeCentral record for dataset '{dataset_id}' - {error}" }
+
+
+    ###############################################################################################
+    def handle_fetch_done(self, dataset_id):
+        """Internal callback, run once the result of a fetch can be had, that lists the dataset for collect_completed()
+        and calls on_complete, e.g. to wake up the main loop
+        """
+        with self.lock:
+            self.completed_dataset_ids.append(dataset_id)
+        if self.on_complete is not None:
+            try:
+                self.on_complete(dataset_id)
+            except Exception as error:
+                eprint(f"ERROR: PxRecordFetcher callback failed: {error}")
+
+
+    ###############################################################################################
+    def fetch_from_server(self, dataset_id):
+        """Internal method that performs the request for a record and updates the cache
+        """
+
+        url = self.url_template.format(dataset_id=dataset_id)
+        headers = { 'accept': 'application/json' }
+        metadata = self.read_cache_metadata(dataset_id)
+        cached_text = None
+        if metadata is not None:
+            cached_text = self.read_cached_record(dataset_id)
+        if cached_text is not None:
+            if metadata.get('etag') is not None:
+                headers['If-None-Match'] = metadata['etag']
+            if metadata.get('last_modified') is not None:
+                headers['If-Modified-Since'] = metadata['last_modified']
+
+        http_response = self.session.get(url, headers=headers, timeout=self.timeout)
+
+        # The cached copy is still current
+        if http_response.status_code == 304 and cached_text is not None:
+            metadata['validated_timestamp'] = time.time()
+            self.write_cache_file(self.get_cache_file(dataset_id, 'meta.json'), json.dumps(metadata))
+            return { 'status': 'OK', 'text': cached_text, 'source': 'revalidated' }
+
+        if http_response.status_code != 200:
+            return { 'status': 'ERROR', 'message': f"Unable to fetch ProteomeCentral record for dataset '{dataset_id}', " +
+                f"status_code={http_response.status_code}. Not a publicly released dataset?" }
+
+        # Only a well-formed record is worth keeping. A broken one is passed on to be reported by the caller
+        text = str(http_response.text)
+        try:
+            json.loads(text)
+        except ValueError:
+            return { 'status': 'OK', 'text': text, 'source': 'server' }
+        self.write_cache_file(self.get_cache_file(dataset_id, 'json'), text)
+        metadata = { 'etag': http_response.headers.get('ETag'), 'last_modified': http_response.headers.get('Last-Modified'),
+            'validated_timestamp': time.time() }
+        self.write_cache_file(self.get_cache_file(dataset_id, 'meta.json'), json.dumps(metadata))
+        return { 'status': 'OK', 'text': text, 'source': 'server' }
+
+
+    ###############################################################################################
+    def collect_completed(self):
+        """Public method that returns the identifiers of the datasets whose fetch has finished since the last call
+        """
+        with self.lock:
+            completed_dataset_ids = self.completed_dataset_ids
+            self.completed_dataset_ids = []
+        return completed_dataset_ids
+
+
+    ###############################################################################################
+    def get_cache_file(self, dataset_id, extension):
+        """Public method that returns the path of a cache file of a dataset
+        """
+        return f"{self.cache_dir}/{dataset_id}.{extension}"
+
+
+    ###############################################################################################
+    def read_cache_metadata(self, dataset_id):
+        """Public method that returns the validators and time of last validation of a cached record, or None
+        """
+        try:
+            with open(self.get_cache_file(dataset_id, 'meta.json')) as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return None
+
+
+    ###############################################################################################
+    def read_cached_record(self, dataset_id):
+        """Public method that returns the text of a cached record, or None
+        """
+        try:
+            with open(self.get_cache_file(dataset_id, 'json'), encoding='utf-8') as infile:
+                return infile.read()
+        except OSError:
+            return None
+
+
+    ###############################################################################################
+    def write_cache_file(self, filename, text):
+        """Internal method that writes a cache file through a temporary file, so that a reader never sees half of one
+        """
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temporary_file = f"{filename}.{threading.get_ident()}.tmp"
+            with open(temporary_file, 'w', encoding='utf-8') as outfile:
+                outfile.write(text)
+            os.replace(temporary_file, filename)
+        except OSError as error:
+            eprint(f"WARNING: Unable to write PX record cache file {filename} - {error}")
+
+
+    ###############################################################################################
+    def close(self):
+        """Public method that abandons the fetches that have not started and closes the session
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+
+##########################################################################################
+def main():
+
+    # Parse command line options
+    import argparse
+    argparser = argparse.ArgumentParser(description='Fetch ProteomeXchange records concurrently through the on-disk cache')
+    argparser.add_argument('--cache_dir', type=str, default='px_cache', help='Directory in which records are cached (default px_cache)' )
+    argparser.add_argument('--threads', type=int, default=4, help='Number of records fetched at once (default 4)' )
+    argparser.add_argument('--timeout', type=float, default=60, help='Number of seconds to wait on the server (default 60)' )
+    argparser.add_argument('dataset_ids', type=str, nargs='+', help='PXD identifiers of the datasets')
+    params = argparser.parse_args()
+
+    fetcher = PxRecordFetcher(params.cache_dir, max_workers=params.threads, timeout=params.timeout)
+    pending_dataset_ids = set(params.dataset_ids)
+    while len(pending_dataset_ids) > 0:
+        for dataset_id in sorted(pending_dataset_ids):
+            result = fetcher.get_record(dataset_id)
+            if result['status'] == 'PENDING':
+                continue
+            pending_dataset_ids.discard(dataset_id)
+            if result['status'] == 'OK':
+                print(f"{dataset_id}: {len(result['text'])} characters from {result['source']}")
+            else:
+                print(f"{dataset_id}: {result['message']}")
+        time.sleep(0.1)
+    fetcher.close()
+
+
+if __name__ == "__main__": main()